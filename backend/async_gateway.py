@@ -0,0 +1,136 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import db_pool
+import notifications
+from framing import StreamChannel, is_hello
+from static_gateway import HOST, PORT, handle_request, handle_quit, tag_response
+
+# Event-loop flavour of static_gateway: sockets are served by asyncio and the
+# blocking handlers (sqlite3, requests.get, ...) run on a bounded thread pool.
+
+WORKERS = 32
+MAX_CONCURRENCY = 256
+PIPELINE_DEPTH = 32
+
+
+class PeerSocket:
+    """Stand-in for the client socket handed to handlers that expect one"""
+
+    def __init__(self, loop, channel):
+        self._loop = loop
+        self._channel = channel
+
+    def getpeername(self):
+        return self._channel.getpeername()
+
+    @property
+    def framed(self):
+        return self._channel.framed
+
+    def send(self, data):
+        # handlers run on executor threads, the transport belongs to the loop
+        self._loop.call_soon_threadsafe(self._channel.write, data)
+        return len(data)
+
+    def new_pusher(self, hub):
+        """Server push for this connection, written and drained on the event loop"""
+        return notifications.LoopPusher(hub, self, self._loop, self._channel)
+
+
+class AsyncGateway:
+    def __init__(self, workers=None, max_concurrency=None):
+        self.workers = workers or WORKERS
+        self.max_concurrency = max_concurrency or MAX_CONCURRENCY
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gateway")
+        # every worker can hold a connection, none should wait for another's
+        db_pool.get_pool().reserve(self.workers)
+        self.limiter = None
+
+    async def run_blocking(self, func, *args):
+        """Run a blocking handler on the executor, at most max_concurrency at a time"""
+        async with self.limiter:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    async def answer(self, channel, peer, data, slots):
+        """Serve one pipelined request and write its tagged response"""
+        try:
+            response = await self.run_blocking(handle_request, data, peer)
+        except Exception as e:
+            response = {"status": "500", "message": f"Server error: {str(e)}"}
+        try:
+            await channel.send_json(tag_response(data, response))
+        except ConnectionError:
+            pass
+        finally:
+            slots.release()
+
+    async def handle_connection(self, reader, writer):
+        channel = StreamChannel(reader, writer)
+        peer = PeerSocket(asyncio.get_running_loop(), channel)
+        slots = asyncio.Semaphore(PIPELINE_DEPTH)
+        in_flight = set()
+        try:
+            while True:
+                data = await channel.receive()
+                if data is None:
+                    break
+                if is_hello(data):
+                    await channel.negotiate(data)
+                    continue
+                if data.get("action") == "quit":
+                    if in_flight:
+                        await asyncio.gather(*in_flight, return_exceptions=True)
+                    response = await self.run_blocking(handle_quit, peer.getpeername()[0])
+                    await channel.send_json(tag_response(data, response))
+                    if response["status"] == "200":
+                        break
+                    continue
+                if channel.framed and "request_id" in data:
+                    # tagged requests are served concurrently and answered as
+                    # they complete; stop reading once PIPELINE_DEPTH are pending
+                    await slots.acquire()
+                    task = asyncio.create_task(self.answer(channel, peer, data, slots))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                    continue
+                response = await self.run_blocking(handle_request, data, peer)
+                await channel.send_json(tag_response(data, response))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            error_response = {"status": "500", "message": f"Server error: {str(e)}"}
+            try:
+                await channel.send_json(error_response)
+            except ConnectionError:
+                pass
+        finally:
+            notifications.forget(peer)
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+            writer.close()
+
+    async def serve(self, host=HOST, port=PORT, ready=None):
+        self.limiter = asyncio.Semaphore(self.max_concurrency)
+        server = await asyncio.start_server(self.handle_connection, host, port, reuse_address=True, backlog=1024)
+        print(f"Async server started on port {port} "
+              f"({self.workers} workers, {self.max_concurrency} concurrent requests, "
+              f"{db_pool.get_pool().size} database connections)")
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def run(host=HOST, port=PORT, workers=None, max_concurrency=None):
+    gateway = AsyncGateway(workers=workers, max_concurrency=max_concurrency)
+    try:
+        asyncio.run(gateway.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.close()
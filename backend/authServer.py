@@ -1,6 +1,7 @@
 import json
 import sqlite3
-import time
+from db_pool import connection
+import id_generator
 
 
 def emaiIsCorrect(email):
@@ -14,25 +15,23 @@ def emaiIsCorrect(email):
     return False
 
 def generate_ID(username):
-    return int(time.time())
+    return id_generator.next_id()
 
 def handle_login(data, client_socket):
     username = data.get("userName")
     password = data.get("password")
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM "user" WHERE username=? AND password=?', (username, password))
-        user = cur.fetchone()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM "user" WHERE username=? AND password=?', (username, password))
+            user = cur.fetchone()
     except sqlite3.Error as e:
         return {"status": "400", "message": str("an unexpected error occurred: it seems that the service is down")}
     if user:
         try:
-            conn = sqlite3.connect('aubus.db')
-            cur = conn.cursor()
-            cur.execute("INSERT INTO IpInfos (userID, userCurrentIP) VALUES (?, ?) ON CONFLICT(userID) DO UPDATE SET userCurrentIP=excluded.userCurrentIP", (0, client_socket.getpeername()[0]))
-            conn.close()
+            with connection() as conn:
+                cur = conn.cursor()
+                cur.execute("INSERT INTO IpInfos (userID, userCurrentIP) VALUES (?, ?) ON CONFLICT(userID) DO UPDATE SET userCurrentIP=excluded.userCurrentIP", (0, client_socket.getpeername()[0]))
         except sqlite3.Error as e:
             error_response = {"status": "500", "message": "Database connection error"}
             client_socket.send(json.dumps(error_response).encode('utf-8'))
@@ -55,33 +54,32 @@ def handle_sign_up(data, client_socket):
     aubID = data.get("aubID", None)
     zone = data.get("zone", None)
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM "user" WHERE username=? OR email=? OR aubID=?', (username, email, aubID))
-        existing_user = cur.fetchone()
-        if existing_user:
-            conn.close()
-            return {"status": "400", "message": "Username or email already exists"}
-        if not emaiIsCorrect(email):
-            return {"status": "400", "message": "Email is not valid please provide a valid email"}
-        userID = generate_ID(username)
-        cur.execute('INSERT INTO "user" (username, password, email, isDriver, aubID, userID) VALUES (?, ?, ?, ?, ?, ?)', (username, password, email, bool(isDriver), int(aubID), int(userID)))
-        cur.execute('INSERT INTO "Zone" (zoneID, zoneName, UserID) VALUES (?, ?, ?)', (generate_ID(zone), zone, int(userID)))
-        cur.execute('INSERT INTO "schedule" (scheduleID, userID) VALUES (?, ?)', (int(userID), int(userID)))
-        cur.execute('SELECT * FROM "user" WHERE username=?', (username,))
-        new_user = cur.fetchone()
-        print(new_user)
-        conn.commit()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM "user" WHERE username=? OR email=? OR aubID=?', (username, email, aubID))
+            existing_user = cur.fetchone()
+            if existing_user:
+                return {"status": "400", "message": "Username or email already exists"}
+            if not emaiIsCorrect(email):
+                return {"status": "400", "message": "Email is not valid please provide a valid email"}
+            userID = generate_ID(username)
+            cur.execute('INSERT INTO "user" (username, password, email, isDriver, aubID, userID) VALUES (?, ?, ?, ?, ?, ?)', (username, password, email, bool(isDriver), int(aubID), int(userID)))
+            cur.execute('INSERT INTO "Zone" (zoneID, zoneName, UserID) VALUES (?, ?, ?)', (generate_ID(zone), zone, int(userID)))
+            cur.execute('INSERT INTO "schedule" (scheduleID, userID) VALUES (?, ?)', (int(userID), int(userID)))
+            cur.execute('SELECT * FROM "user" WHERE username=?', (username,))
+            new_user = cur.fetchone()
+            print(new_user)
+            conn.commit()
         print("here")
         try:
-            conn = sqlite3.connect('aubus.db')
-            cur = conn.cursor()
-            cur.execute("INSERT INTO IpInfos (userID, userCurrentIP) VALUES (?, ?) ON CONFLICT(userID) DO UPDATE SET userCurrentIP=excluded.userCurrentIP", (0, client_socket.getpeername()[0]))
-            conn.close()
+            with connection() as conn:
+                cur = conn.cursor()
+                cur.execute("INSERT INTO IpInfos (userID, userCurrentIP) VALUES (?, ?) ON CONFLICT(userID) DO UPDATE SET userCurrentIP=excluded.userCurrentIP", (0, client_socket.getpeername()[0]))
         except sqlite3.Error as e:
             error_response = {"status": "500", "message": "Database connection error"}
             client_socket.send(json.dumps(error_response).encode('utf-8'))
         return {"status": "201", "message": "User created successfully", "data":{"username": username, "email": email, "isDriver": isDriver, "aubID": aubID, "userID": userID}}
+    except id_generator.NoWorkerId as e:
+        return id_generator.unavailable(e)
     except sqlite3.Error as e:
         return {"status": "400", "message": str("an unexpected error occurred: it seems that the service is down")}
@@ -0,0 +1,1378 @@
+"""
+Benchmarks for the AUBus backend.
+
+Run from the backend folder:
+    python benchmarks.py <name> [--clients N] [--duration S] [--size N]
+
+Every benchmark works on a scratch copy of aubus.db in a temporary folder so
+the real database is never touched.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BACKEND_DIR, os.pardir, "common"))   # http_client
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len("bench_"):]] = func
+    return func
+
+
+def use_scratch_db():
+    """Copy aubus.db to a temporary folder, migrate it and make it the working directory"""
+    import db_schema
+    scratch = tempfile.mkdtemp(prefix="aubus_bench_")
+    shutil.copy(os.path.join(BACKEND_DIR, "aubus.db"), scratch)
+    os.chdir(scratch)
+    db_schema.create_schema("aubus.db")
+    return scratch
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def quiet():
+    """Silence the per-connection logging of the servers under test"""
+    return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+
+def run_clients(worker, clients, duration):
+    """Call `worker()` in a loop on `clients` threads, return (completed, failed)"""
+    stop_time = time.perf_counter() + duration
+    counts = [0] * clients
+    errors = [0] * clients
+
+    def loop(i):
+        while time.perf_counter() < stop_time:
+            try:
+                worker()
+                counts[i] += 1
+            except OSError:
+                errors[i] += 1
+
+    threads = [threading.Thread(target=loop, args=(i,), daemon=True) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts), sum(errors)
+
+
+def gateway_round_trip(port, payload):
+    s = socket.create_connection(("127.0.0.1", port), timeout=10)
+    try:
+        s.sendall(json.dumps(payload).encode('utf-8'))
+        json.loads(s.recv(65536).decode('utf-8'))
+    finally:
+        s.close()
+
+
+@benchmark
+def bench_gateway(args):
+    """Connections per second: thread-per-connection gateway vs asyncio gateway"""
+    use_scratch_db()
+    import static_gateway
+    import async_gateway
+
+    threaded_port = free_port()
+    threading.Thread(target=static_gateway.start_server, args=("127.0.0.1", threaded_port, args.workers), daemon=True).start()
+
+    async_port = free_port()
+    gateway = async_gateway.AsyncGateway(workers=args.workers, max_concurrency=args.max_concurrency)
+    ready = threading.Event()
+    threading.Thread(target=lambda: asyncio.run(gateway.serve("127.0.0.1", async_port, ready)), daemon=True).start()
+    ready.wait()
+    time.sleep(0.2)
+
+    payload = {"action": "get_ip", "userID": 1}
+    for name, port in (("threaded", threaded_port), ("asyncio", async_port)):
+        with quiet():
+            done, failed = run_clients(lambda: gateway_round_trip(port, payload), args.clients, args.duration)
+        print(f"{name:>9}: {done / args.duration:8.0f} connections/s "
+              f"({args.clients} clients, {failed} failed)")
+
+
+@benchmark
+def bench_db_pool(args):
+    """Handler-style reads: sqlite3.connect per request vs the shared pool"""
+    use_scratch_db()
+    import sqlite3
+    import db_pool
+
+    query = 'SELECT userCurrentIP FROM IpInfos WHERE userID=?'
+
+    def per_request():
+        conn = sqlite3.connect('aubus.db')
+        conn.execute(query, (1,)).fetchone()
+        conn.close()
+
+    def pooled():
+        with db_pool.connection() as conn:
+            conn.execute(query, (1,)).fetchone()
+
+    for name, worker in (("connect", per_request), ("pool", pooled)):
+        done, failed = run_clients(worker, args.clients, args.duration)
+        print(f"{name:>8}: {done / args.duration:8.0f} queries/s ({args.clients} threads, {failed} failed)")
+    print("pool stats:", db_pool.get_pool().stats())
+
+
+def fill_zones_and_rides(count, seed=351, first=0):
+    """Add `count` zones around Beirut, each the source of one ride"""
+    import random
+    import sqlite3
+    rng = random.Random(seed + first)
+    conn = sqlite3.connect("aubus.db")
+    conn.execute('INSERT OR IGNORE INTO "user" (userID, username, isDriver) VALUES (1, ?, 1)', ("bench_driver",))
+    conn.executemany('INSERT INTO "Zone" (zoneID, zoneX, zoneY, zoneName, UserID) VALUES (?, ?, ?, ?, 1)',
+                     ((f"bench_zone_{i}", 33.70 + rng.random() * 0.4, 35.35 + rng.random() * 0.4, f"Zone {i}")
+                      for i in range(first, first + count)))
+    conn.executemany('INSERT INTO Ride (rideID, ownerID, sourceID, destinationID, startTime, endTime) '
+                     'VALUES (?, 1, ?, ?, ?, ?)',
+                     ((f"bench_ride_{i}", f"bench_zone_{i}", f"bench_zone_{first + rng.randrange(count)}", start, start + 45)
+                      for i, start in ((i, rng.randrange(6 * 60, 20 * 60)) for i in range(first, first + count))))
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) / repeat, result
+
+
+@benchmark
+def bench_zone_rtree(args):
+    """ride_filter distance lookup: full Zone scan vs R*Tree bounding box"""
+    import sqlite3
+    use_scratch_db()
+    zones = args.size or 100000
+    fill_zones_and_rides(zones)
+    from rideManagement import give_rides_using_filter
+
+    lat, lon, dist_km = 33.8993, 35.4839, 2.0
+    deg = dist_km / 111.0
+    full_scan = """
+        SELECT Ride.rideID FROM Ride JOIN Zone AS Zsrc ON Ride.sourceID = Zsrc.zoneID
+        WHERE Ride.startTime >= ? AND Ride.endTime <= ?
+          AND ((Zsrc.zoneX - ?) * (Zsrc.zoneX - ?) + (Zsrc.zoneY - ?) * (Zsrc.zoneY - ?)) <= ?
+    """
+    conn = sqlite3.connect("aubus.db")
+    scan_time, scan_rows = timed(lambda: conn.execute(full_scan, (0, 1440, lat, lat, lon, lon, deg * deg)).fetchall(), 5)
+    conn.close()
+
+    request = {"userID": 1, "filter": {"rating": [0, 5], "distance": dist_km, "date": [0, 1440]},
+               "userLocation": {"lat": lat, "lon": lon}}
+    with quiet():
+        rtree_time, response = timed(lambda: give_rides_using_filter(request), 5)
+    print(f"{zones} zones, {dist_km} km radius")
+    print(f"  full scan: {scan_time * 1000:8.2f} ms/query ({len(scan_rows)} rides)")
+    print(f"  R*Tree   : {rtree_time * 1000:8.2f} ms/query ({len(response['data'])} rides)")
+
+
+@benchmark
+def bench_ride_index(args):
+    """request_ride matching: time-window scan + Python filter vs grid index, as rides grow"""
+    import sqlite3
+    use_scratch_db()
+    import ride_index
+
+    legacy = """
+        SELECT r.rideID, r.ownerID, r.carId, r.sourceID, r.destinationID,
+               r.startTime, r.endTime, r.scheduleID, u.username, u.email,
+               zs.zoneName, zs.zoneX, zs.zoneY, zd.zoneName, zd.zoneX, zd.zoneY
+        FROM Ride r
+        JOIN "user" u ON r.ownerID = u.userID
+        LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
+        LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
+        WHERE r.startTime <= ? AND r.endTime >= ?
+    """
+    lat, lng, minute = 33.8993, 35.4839, 8 * 60
+
+    def legacy_match():
+        rows = conn.execute(legacy, (minute + 30, minute - 30)).fetchall()
+        return [row for row in rows
+                if not (row[11] and row[12]) or ((lat - row[11]) ** 2 + (lng - row[12]) ** 2) ** 0.5 * 111 <= 5]
+
+    total = 0
+    final = args.size or 100000
+    for size in (final // 10, final // 2, final):
+        fill_zones_and_rides(size - total, first=total)
+        total = size
+        ride_index.get_index().load(sqlite3.connect("aubus.db"))
+        conn = sqlite3.connect("aubus.db")
+        scan_time, scan_rows = timed(legacy_match, 5)
+        conn.close()
+        index = ride_index.get_index()
+        index_time, found = timed(lambda: index.candidates(minute - 30, minute + 30, lat, lng, radius_km=5), 5)
+        print(f"{size:>8} rides: scan {scan_time * 1000:8.2f} ms ({len(scan_rows)} matches)   "
+              f"grid index {index_time * 1000:8.2f} ms ({len(found)} candidates in the 5 km box)")
+
+
+@benchmark
+def bench_ranking(args):
+    """Ranking candidates: per-row Python loop vs one NumPy pass (and top-k)"""
+    import random
+    import numpy as np
+    import ranking
+    count = args.size or 100000
+    rng = random.Random(351)
+    lats = [33.70 + rng.random() * 0.4 for _ in range(count)]
+    lngs = [35.35 + rng.random() * 0.4 for _ in range(count)]
+    dest_lats = [33.70 + rng.random() * 0.4 for _ in range(count)]
+    dest_lngs = [35.35 + rng.random() * 0.4 for _ in range(count)]
+    starts = [rng.randrange(6 * 60, 20 * 60) for _ in range(count)]
+    lat, lng, minute = 33.8993, 35.4839, 8 * 60
+
+    def loop():
+        kept = []
+        for i in range(count):
+            distance_km = ((abs(lat - lats[i]) ** 2 + abs(lng - lngs[i]) ** 2) ** 0.5) * 111
+            if distance_km <= 5:
+                kept.append((distance_km, i))
+        kept.sort()
+        return kept
+
+    loop_time, kept = timed(loop, 5)
+    rank_time, ranked = timed(lambda: ranking.rank(lat, lng, lats, lngs, starts, minute, max_km=5), 5)
+    top_time, top = timed(lambda: ranking.rank(lat, lng, lats, lngs, starts, minute, max_km=5, k=20), 5)
+    arrays = [np.asarray(column, dtype=float) for column in (lats, lngs, starts)]
+    array_time, _ = timed(lambda: ranking.rank(lat, lng, *arrays, minute, max_km=5, k=20), 5)
+    print(f"{count} candidates")
+    print(f"  python loop      : {loop_time * 1000:8.2f} ms ({len(kept)} within 5 km, flat-earth)")
+    print(f"  numpy rank       : {rank_time * 1000:8.2f} ms ({len(ranked.order)} within 5 km, great-circle)")
+    print(f"  numpy rank top-20: {top_time * 1000:8.2f} ms")
+    print(f"  top-20 from arrays: {array_time * 1000:7.2f} ms (no list conversion)")
+
+    import math
+
+    def km(lat1, lng1, lat2, lng2):
+        return ranking.EARTH_RADIUS_KM * 2 * math.asin(math.sqrt(
+            math.sin(math.radians(lat2 - lat1) / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2))
+            * math.sin(math.radians(lng2 - lng1) / 2) ** 2))
+
+    def detour_loop():
+        kept = []
+        for i in range(count):
+            extra = (km(lats[i], lngs[i], lat, lng) + km(lat, lng, dest_lats[i], dest_lngs[i])
+                     - km(lats[i], lngs[i], dest_lats[i], dest_lngs[i]))
+            minutes = ranking.drive_minutes(extra)
+            if minutes <= 10:
+                kept.append((minutes + abs(starts[i] - minute), i))
+        kept.sort()
+        return kept
+
+    detour_loop_time, kept = timed(detour_loop, 1)
+    detour_time, ranked = timed(lambda: ranking.rank(lat, lng, lats, lngs, starts, minute, dest_lats=dest_lats,
+                                                     dest_lngs=dest_lngs, max_detour_minutes=10), 5)
+    assert [i for _, i in kept] == ranked.order.tolist()
+    print(f"  detour, python loop: {detour_loop_time * 1000:6.2f} ms ({len(kept)} within a 10 min detour)")
+    print(f"  detour, numpy rank : {detour_time * 1000:6.2f} ms")
+
+
+@benchmark
+def bench_ride_batch(args):
+    """Peak-hour matching: N sequential request_ride calls vs one request_ride_batch"""
+    import random
+    use_scratch_db()
+    fill_zones_and_rides(args.size or 100000)
+    from update_personal_info import request_ride, request_ride_batch
+
+    rng = random.Random(351)
+    passengers = args.clients or 300
+    queries = [{"riderID": 2, "direction": "to_aub", "time": f"0{7 + rng.randrange(2)}:{rng.randrange(60):02d}",
+                "area": f"{33.85 + rng.random() * 0.1},{35.45 + rng.random() * 0.1}"}
+               for _ in range(passengers)]
+    with quiet():
+        request_ride(queries[0])  # load the ride index outside the timings
+        started = time.perf_counter()
+        sequential = [request_ride(query) for query in queries]
+        sequential_time = time.perf_counter() - started
+        started = time.perf_counter()
+        batch = request_ride_batch({"queries": queries})["data"]["results"]
+        batch_time = time.perf_counter() - started
+        started = time.perf_counter()
+        request_ride_batch({"queries": [dict(query, limit=10) for query in queries]})
+        top_time = time.perf_counter() - started
+
+    same = all([c["rideID"] for c in a["data"]["candidates"]] == [c["rideID"] for c in b["data"]["candidates"]]
+               for a, b in zip(sequential, batch))
+    print(f"{passengers} passengers, {args.size or 100000} rides (identical results: {same})")
+    print(f"  sequential request_ride: {sequential_time:6.2f} s ({passengers / sequential_time:8.1f} queries/s)")
+    print(f"  request_ride_batch     : {batch_time:6.2f} s ({passengers / batch_time:8.1f} queries/s)")
+    print(f"  batch, limit 10 each   : {top_time:6.2f} s ({passengers / top_time:8.1f} queries/s)")
+
+
+def fill_peak_requests(count, seed=351):
+    """Peak-hour dataset: about `count` pending requests from passengers to nearby 7-9am rides"""
+    import random
+    import sqlite3
+    rng = random.Random(seed)
+    conn = sqlite3.connect("aubus.db")
+    drivers = max(1, count // 6)
+    riders = max(1, count // 2)
+    places = {}
+    for user in range(10000, 10000 + drivers + riders):
+        places[user] = (33.85 + rng.random() * 0.1, 35.45 + rng.random() * 0.1)
+    conn.executemany('INSERT INTO "user" (userID, username, isDriver) VALUES (?, ?, ?)',
+                     ((user, f"peak{user}", user < 10000 + drivers) for user in places))
+    conn.executemany('INSERT INTO "Zone" (zoneID, zoneX, zoneY, zoneName, UserID) VALUES (?, ?, ?, ?, ?)',
+                     ((f"peak_zone_{user}", lat, lng, f"Peak {user}", user) for user, (lat, lng) in places.items()))
+    conn.executemany('INSERT INTO "Car" (carId, cartype, carPlate, capacity, ownerID) VALUES (?, ?, ?, ?, ?)',
+                     ((f"peak_car_{d}", "sedan", f"PK{d}", rng.randint(1, 4), d) for d in range(10000, 10000 + drivers)))
+    rides = [(f"peak_ride_{d}", d, f"peak_car_{d}", f"peak_zone_{d}", rng.randrange(7 * 60, 9 * 60))
+             for d in range(10000, 10000 + drivers)]
+    conn.executemany('INSERT INTO Ride (rideID, ownerID, carId, sourceID, destinationID, startTime, endTime) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)', ((r, o, c, z, z, t, t + 30) for r, o, c, z, t in rides))
+    requests = []
+    for rider in range(10000 + drivers, 10000 + drivers + riders):
+        lat, lng = places[rider]
+        nearby = sorted(rides, key=lambda ride: (places[ride[1]][0] - lat) ** 2 + (places[ride[1]][1] - lng) ** 2)[:6]
+        for ride in rng.sample(nearby, rng.randint(1, 3)):
+            requests.append((f"peak_req_{len(requests)}", rider, ride[0], "pending", len(requests)))
+    rng.shuffle(requests)
+    conn.executemany('INSERT INTO Request (requestID, riderID, rideID, status, requestTime) VALUES (?, ?, ?, ?, ?)',
+                     requests)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return len(requests)
+
+
+@benchmark
+def bench_seat_optimizer(args):
+    """Peak-hour seat assignment: greedy first-come acceptance vs min-cost flow"""
+    import random
+    import sqlite3
+    use_scratch_db()
+    import seat_optimizer
+    requests = fill_peak_requests(args.size or 3000)
+    conn = sqlite3.connect("aubus.db")
+    started = time.perf_counter()
+    pending, edges, seats = seat_optimizer.load_problem(conn, 7 * 60, 9 * 60)
+    load_time = time.perf_counter() - started
+
+    arrival = list(range(len(edges)))
+    random.Random(7).shuffle(arrival)
+    free = dict(seats)
+    seated = set()
+    greedy = []
+    for i in arrival:
+        rider, ride, _ = edges[i]
+        if rider not in seated and free.get(ride, 0) > 0:
+            free[ride] -= 1
+            seated.add(rider)
+            greedy.append(i)
+
+    started = time.perf_counter()
+    optimal = seat_optimizer.assign(edges, seats)
+    solve_time = time.perf_counter() - started
+    conn.close()
+
+    riders = len({rider for rider, _, _ in edges})
+    print(f"{requests} pending requests from {riders} passengers for {len(seats)} rides "
+          f"({sum(seats.values())} seats), loaded in {load_time * 1000:.0f} ms")
+    for name, chosen in (("greedy first-come", greedy), ("min-cost flow", optimal)):
+        cost = sum(edges[i][2] for i in chosen) / seat_optimizer.COST_SCALE
+        print(f"  {name:18}: {len(chosen):5} seated, avg cost {cost / max(1, len(chosen)):6.1f} min")
+    print(f"  solve time: {solve_time * 1000:.0f} ms")
+
+
+def fill_contended_ride(ride_id, capacity, requests, first_user):
+    """One ride with `capacity` seats and `requests` pending requests from distinct passengers"""
+    import sqlite3
+    conn = sqlite3.connect("aubus.db")
+    driver = first_user
+    riders = range(first_user + 1, first_user + 1 + requests)
+    conn.executemany('INSERT INTO "user" (userID, username, isDriver) VALUES (?, ?, ?)',
+                     [(driver, f"hot{driver}", 1)] + [(rider, f"hot{rider}", 0) for rider in riders])
+    conn.execute('INSERT INTO "Car" (carId, cartype, carPlate, capacity, ownerID) VALUES (?, ?, ?, ?, ?)',
+                 (f"{ride_id}_car", "bus", ride_id, capacity, driver))
+    conn.execute('INSERT INTO Ride (rideID, ownerID, carId, startTime, endTime) VALUES (?, ?, ?, ?, ?)',
+                 (ride_id, driver, f"{ride_id}_car", 480, 540))
+    conn.executemany('INSERT INTO Request (requestID, riderID, rideID, status, requestTime) VALUES (?, ?, ?, ?, ?)',
+                     ((f"{ride_id}_req_{rider}", rider, ride_id, "pending", rider) for rider in riders))
+    conn.commit()
+    conn.close()
+    return driver, [(f"{ride_id}_req_{rider}", rider) for rider in riders]
+
+
+def hammer(accept, requests, clients):
+    """Run accept(requestID, riderID) for every request from `clients` threads, return (outcomes, seconds)"""
+    import queue
+    todo = queue.Queue()
+    for item in requests:
+        todo.put(item)
+    outcomes = {}
+    lock = threading.Lock()
+
+    def loop():
+        while True:
+            try:
+                request_id, rider_id = todo.get_nowait()
+            except queue.Empty:
+                return
+            outcome = accept(request_id, rider_id)
+            with lock:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return outcomes, time.perf_counter() - started
+
+
+@benchmark
+def bench_seat_reservation(args):
+    """Many threads accepting requests for one ride: read-count-update vs seats.reserve_seat"""
+    import sqlite3
+    use_scratch_db()
+    import db_pool
+    import update_personal_info
+
+    capacity = args.size or 200
+    requests = capacity * 4
+
+    # the accept path before seats.reserve_seat: check, then write, with nothing in between held
+    driver, unguarded = fill_contended_ride("hot_ride_unguarded", capacity, requests, 20000)
+
+    def unguarded_accept(request_id, rider_id):
+        try:
+            with db_pool.connection() as conn:
+                ride_id = "hot_ride_unguarded"
+                max_capacity = conn.execute('SELECT c.capacity FROM Ride r JOIN Car c ON r.carId = c.carId '
+                                            'WHERE r.rideID = ?', (ride_id,)).fetchone()[0]
+                taken = conn.execute('SELECT COUNT(*) FROM Rider WHERE rideID = ?', (ride_id,)).fetchone()[0]
+                if taken >= max_capacity:
+                    return "400"
+                conn.execute('UPDATE Request SET status = ? WHERE requestID = ?', ('accepted', request_id))
+                conn.execute('INSERT OR IGNORE INTO Rider (userID, rideID) VALUES (?, ?)', (rider_id, ride_id))
+                conn.commit()
+                return "200"
+        except sqlite3.Error:
+            return "500"
+
+    guarded_driver, guarded = fill_contended_ride("hot_ride", capacity, requests, 30000)
+
+    def guarded_accept(request_id, rider_id):
+        response = update_personal_info.accept_ride_request({"requestID": request_id, "driver_userid": guarded_driver})
+        return response["status"]
+
+    print(f"{requests} requests for one ride with {capacity} seats, {args.clients} threads")
+    conn = sqlite3.connect("aubus.db")
+    for name, accept, items, ride_id in (("read-count-update", unguarded_accept, unguarded, "hot_ride_unguarded"),
+                                         ("reserve_seat", guarded_accept, guarded, "hot_ride")):
+        with quiet():
+            outcomes, elapsed = hammer(accept, items, args.clients)
+        seated = conn.execute('SELECT COUNT(*) FROM Rider WHERE rideID = ?', (ride_id,)).fetchone()[0]
+        accepted = conn.execute("SELECT COUNT(*) FROM Request WHERE rideID = ? AND status = 'accepted'",
+                                (ride_id,)).fetchone()[0]
+        counter = conn.execute('SELECT seats_taken FROM Ride WHERE rideID = ?', (ride_id,)).fetchone()[0]
+        print(f"  {name:17}: {len(items) / elapsed:7.0f} attempts/s, {accepted:4} accepted, {seated:4} seated "
+              f"of {capacity} (seats_taken {counter}), outcomes {dict(sorted(outcomes.items()))}")
+    conn.close()
+
+
+def _lease_and_generate(count):
+    # runs in a child process: lease a worker id of its own, return the IDs as int64 bytes and the time taken
+    import numpy as np
+    import id_generator
+    generator = id_generator.get_generator()
+    started = time.perf_counter()
+    ids = generator.next_ids(count)
+    elapsed = time.perf_counter() - started
+    return np.array(ids, dtype=np.int64).tobytes(), elapsed
+
+
+@benchmark
+def bench_id_generator(args):
+    """Snowflake IDs per second: one thread, many threads, batches, many processes; checks for duplicates"""
+    import multiprocessing
+    import numpy as np
+    use_scratch_db()
+    import id_generator
+
+    count = args.size or 1000000
+    generator = id_generator.get_generator()
+
+    def report(name, ids, elapsed):
+        ids = np.asarray(ids, dtype=np.int64)
+        duplicates = len(ids) - len(np.unique(ids))
+        print(f"  {name:28}: {len(ids) / elapsed / 1e6:6.2f} M ids/s, {duplicates} duplicates")
+
+    started = time.perf_counter()
+    ids = [generator.next_id() for _ in range(count)]
+    report("next_id, 1 thread", ids, time.perf_counter() - started)
+
+    per_thread = count // args.clients
+    results = [None] * args.clients
+
+    def worker(i):
+        results[i] = [generator.next_id() for _ in range(per_thread)]
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    report(f"next_id, {args.clients} threads", [i for chunk in results for i in chunk], time.perf_counter() - started)
+
+    started = time.perf_counter()
+    ids = generator.next_ids(count)
+    report("next_ids, 1 call", ids, time.perf_counter() - started)
+
+    processes = 4
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_lease_and_generate, [count // processes] * processes, chunksize=1)
+    chunks = [np.frombuffer(chunk, dtype=np.int64) for chunk, _ in results]
+    workers = sorted({id_generator.parse_id(int(chunk[0]))[1] for chunk in chunks})
+    # the processes run side by side, so the slowest one bounds the aggregate rate
+    report(f"next_ids, {processes} processes", np.concatenate(chunks), max(elapsed for _, elapsed in results))
+    print(f"  worker ids leased by the processes: {workers} (this process: "
+          f"{id_generator.parse_id(generator.next_id())[1]})")
+
+
+def stub_http_server(respond, delay=0.0):
+    """
+    Local HTTP server standing in for an external API: respond(path, query) returns
+    (status, JSON body). Returns (base URL, stats dict, server); stats counts the calls,
+    the connections and the most calls in progress at once, and stats["delay"] can be
+    changed while it runs.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlsplit
+    stats = {"calls": 0, "connections": 0, "active": 0, "max_active": 0, "delay": delay}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        wbufsize = 65536                  # headers and body leave in one segment...
+        disable_nagle_algorithm = True    # ...right away, keep-alive clients do not wait on delayed ACKs
+
+        def setup(self):
+            super().setup()
+            with lock:
+                stats["connections"] += 1
+
+        def do_GET(self):
+            with lock:
+                stats["calls"] += 1
+                stats["active"] += 1
+                stats["max_active"] = max(stats["max_active"], stats["active"])
+            try:
+                if stats["delay"]:
+                    time.sleep(stats["delay"])
+                url = urlsplit(self.path)
+                status, body = respond(url.path, {k: v[0] for k, v in parse_qs(url.query).items()})
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            finally:
+                with lock:
+                    stats["active"] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        request_queue_size = 256    # the default backlog of 5 drops bursts of connections
+
+    server = Server(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}", stats, server
+
+
+def fake_weather(path, query):
+    return 200, {"weather": [{"description": "clear sky"}],
+                 "main": {"temp": 24.5, "feels_like": 25.1, "humidity": 60},
+                 "coord": {"lat": float(query["lat"]), "lon": float(query["lon"])}}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float("nan")
+
+
+@benchmark
+def bench_weather_cache(args):
+    """get_weather against a fake upstream (50 ms): direct calls vs the cell cache, stampede and stale reads"""
+    import random
+    import weather
+    from ttl_cache import TTLCache
+
+    base_url, upstream, server = stub_http_server(fake_weather, delay=0.05)
+    weather.WEATHER_URL = base_url + "/data/2.5/weather"
+    weather.WEATHER_API_KEY = "bench"
+    rng = random.Random(351)
+    # clicks around campus: a few dozen ~1 km cells
+    spots = [(33.89 + rng.random() * 0.05, 35.47 + rng.random() * 0.05) for _ in range(2000)]
+    cells = len({weather.weather_cell(lat, lng) for lat, lng in spots})
+
+    def run(name, lookup):
+        latencies = []
+        lock = threading.Lock()
+
+        def one():
+            lat, lng = spots[rng.randrange(len(spots))]
+            started = time.perf_counter()
+            response = lookup({"latitude": lat, "longitude": lng})
+            elapsed = time.perf_counter() - started
+            if "main" not in response:
+                raise OSError(response.get("message"))
+            with lock:
+                latencies.append(elapsed)
+
+        before = upstream["calls"]
+        done, failed = run_clients(one, args.clients, args.duration)
+        print(f"  {name:9}: {done / args.duration:7.0f} lookups/s, p50 {percentile(latencies, 0.5) * 1000:6.1f} ms, "
+              f"p95 {percentile(latencies, 0.95) * 1000:6.1f} ms, {upstream['calls'] - before:5} upstream calls, "
+              f"{failed} failed")
+
+    def direct(data):
+        try:
+            return weather.fetch_weather(data["latitude"], data["longitude"])
+        except weather.WeatherError as e:
+            return {"status": e.status, "message": e.message}
+
+    print(f"{args.clients} clients for {args.duration:.0f}s over {cells} cells, upstream answers in 50 ms")
+    run("direct", direct)
+    run("cached", weather.get_weather_info)
+    print(f"  cache: {weather.weather_cache.stats()}")
+
+    # stampede: every client misses the same cold cell at once
+    weather.weather_cache = TTLCache(weather.WEATHER_TTL, weather.WEATHER_STALE)
+    before = upstream["calls"]
+    start = threading.Barrier(args.clients)
+
+    def stampede():
+        start.wait()
+        weather.get_weather_info({"latitude": 33.9, "longitude": 35.48})
+
+    threads = [threading.Thread(target=stampede) for _ in range(args.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(f"  stampede: {args.clients} concurrent misses on one cell -> {upstream['calls'] - before} upstream call(s)")
+
+    # stale-while-revalidate: a 0.5 s TTL, readers never wait for the refreshes
+    weather.weather_cache = TTLCache(0.5, 60)
+    weather.get_weather_info({"latitude": 33.9, "longitude": 35.48})
+    before = upstream["calls"]
+    latencies = []
+    stop = time.perf_counter() + 2.0
+    while time.perf_counter() < stop:
+        started = time.perf_counter()
+        weather.get_weather_info({"latitude": 33.9, "longitude": 35.48})
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.01)
+    print(f"  stale reads: {len(latencies)} lookups over 2 s with a 0.5 s TTL, max {max(latencies) * 1000:.2f} ms, "
+          f"{upstream['calls'] - before} background refreshes")
+    server.shutdown()
+
+
+@benchmark
+def bench_http_client(args):
+    """Outbound HTTP against a local stub: keep-alive reuse, per-host limit, circuit breaker during an outage"""
+    import requests
+    import http_client
+    import weather
+    from ttl_cache import TTLCache
+
+    state = {"failing": False}
+
+    def respond(path, query):
+        if state["failing"]:
+            return 503, {"message": "upstream down"}
+        return fake_weather(path, query)
+
+    base_url, upstream, server = stub_http_server(respond)
+    url = base_url + "/data/2.5/weather"
+    query = {"lat": 33.9, "lon": 35.48}
+    calls = args.size or 500
+
+    # 1. connection reuse
+    client = http_client.HttpClient()
+    for name, get in (("requests.get", lambda: requests.get(url, params=query, timeout=5)),
+                      ("http_client", lambda: client.get(url, params=query))):
+        before = upstream["connections"]
+        started = time.perf_counter()
+        for _ in range(calls):
+            get()
+        elapsed = time.perf_counter() - started
+        print(f"  {name:18}: {elapsed / calls * 1000:6.2f} ms/call, {upstream['connections'] - before:4} connections "
+              f"for {calls} calls")
+
+    # 2. per-host concurrency limit with a slow upstream
+    client = http_client.HttpClient(max_per_host=8, slot_timeout=0.5)
+    upstream["delay"], upstream["max_active"] = 0.2, 0
+    with quiet():
+        done, failed = run_clients(lambda: client.get(url, params=query), args.clients, args.duration)
+    print(f"  per-host limit 8  : {args.clients} threads, at most {upstream['max_active']} calls in flight upstream, "
+          f"{done} answered, {failed} failed fast after waiting 0.5 s for a slot")
+
+    # 3. outage: the cached readings have expired and every upstream call hangs 2 s, then fails
+    import random
+    rng = random.Random(351)
+    spots = [(33.89 + rng.random() * 0.05, 35.47 + rng.random() * 0.05) for _ in range(500)]
+    weather.WEATHER_URL, weather.WEATHER_API_KEY, weather.WEATHER_TIMEOUT = url, "bench", 5.0
+    upstream["delay"] = 0.0
+    for name, breaker in (("no breaker", lambda: http_client.CircuitBreaker(min_calls=10 ** 9)),
+                          ("circuit breaker", http_client.CircuitBreaker)):
+        http_client.client = http_client.HttpClient(breaker_factory=breaker)
+        weather.weather_cache = TTLCache(0.0, 0.0, error_grace=weather.WEATHER_ERROR_GRACE)
+        for lat, lng in spots:      # readings from before the outage, already past their TTL
+            weather.get_weather_info({"latitude": lat, "longitude": lng})
+        state["failing"], upstream["delay"] = True, 2.0
+        latencies = []
+        lock = threading.Lock()
+
+        def lookup():
+            lat, lng = spots[rng.randrange(len(spots))]
+            started = time.perf_counter()
+            response = weather.get_weather_info({"latitude": lat, "longitude": lng})
+            with lock:
+                latencies.append(time.perf_counter() - started)
+            if "main" not in response:
+                raise OSError(response.get("message"))
+
+        before = upstream["calls"]
+        with quiet():
+            done, failed = run_clients(lookup, args.clients, args.duration)
+        state["failing"], upstream["delay"] = False, 0.0
+        print(f"  outage, {name:15}: {done / args.duration:7.0f} lookups/s served from cache, "
+              f"p50 {percentile(latencies, 0.5) * 1000:7.1f} ms, p95 {percentile(latencies, 0.95) * 1000:7.1f} ms, "
+              f"{upstream['calls'] - before:3} upstream calls, "
+              f"{failed} failed, breaker {http_client.client.breaker(url).state}")
+    server.shutdown()
+
+
+def write_synthetic_osm(path, side, seed=351):
+    """
+    A side x side street grid over Beirut as OSM XML: every 10th street a primary
+    road, a fifth of the others one-way, and streets interrupted here and there
+    """
+    import random
+    rng = random.Random(seed)
+    lat0, lng0, span = 33.80, 35.44, 0.2
+    step = span / side
+
+    def node_id(row, col):
+        return row * side + col + 1
+
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for row in range(side):
+            for col in range(side):
+                f.write(f'<node id="{node_id(row, col)}" lat="{lat0 + (row + rng.uniform(-.3, .3)) * step:.7f}" '
+                        f'lon="{lng0 + (col + rng.uniform(-.3, .3)) * step:.7f}"/>\n')
+        way_id = 0
+        for line in range(side):
+            for cells in ([(line, col) for col in range(side)], [(row, line) for row in range(side)]):
+                highway = "primary" if line % 10 == 0 else "residential"
+                oneway = highway == "residential" and rng.random() < 0.2
+                pieces, piece = [], [cells[0]]
+                for cell in cells[1:]:
+                    if highway == "residential" and rng.random() < 0.03:
+                        pieces.append(piece)
+                        piece = []
+                    piece.append(cell)
+                pieces.append(piece)
+                for piece in pieces:
+                    if len(piece) < 2:
+                        continue
+                    way_id += 1
+                    refs = "".join(f'<nd ref="{node_id(*cell)}"/>' for cell in piece)
+                    tags = f'<tag k="highway" v="{highway}"/>' + ('<tag k="oneway" v="yes"/>' if oneway else "")
+                    f.write(f'<way id="{way_id}">{refs}{tags}</way>\n')
+        f.write("</osm>\n")
+
+
+@benchmark
+def bench_routing(args):
+    """Offline routing on a synthetic Beirut-sized street grid: load, A* vs Dijkstra, detours per request"""
+    import math
+    import random
+    import routing
+
+    side = args.size or 200
+    scratch = tempfile.mkdtemp(prefix="aubus_bench_")
+    osm_path = os.path.join(scratch, "beirut.osm")
+    write_synthetic_osm(osm_path, side)
+    started = time.perf_counter()
+    graph = routing.load_graph(osm_path)
+    parse_time = time.perf_counter() - started
+    started = time.perf_counter()
+    graph = routing.load_graph(osm_path)
+    load_time = time.perf_counter() - started
+    print(f"{graph.node_count} nodes, {graph.edge_count} edges "
+          f"({os.path.getsize(osm_path) / 1e6:.0f} MB of OSM XML)")
+    print(f"  parse OSM + build CSR: {parse_time:6.2f} s,  load .npz: {load_time * 1000:6.1f} ms")
+
+    rng = random.Random(351)
+    pairs = [(rng.randrange(graph.node_count), rng.randrange(graph.node_count)) for _ in range(40)]
+    astar_time, astar = timed(lambda: [graph.route(a, b)[0] for a, b in pairs], 1)
+    dijkstra_time, dijkstra = timed(lambda: [graph.costs(a, [b])[b] for a, b in pairs], 1)
+    assert all(math.isclose(x, y, rel_tol=1e-6) or x == y for x, y in zip(astar, dijkstra)), "A* disagrees"
+    reachable = [x for x in astar if x != math.inf]
+    print(f"  random pairs, mean {sum(reachable) / len(reachable) / 60:.1f} min drive:")
+    print(f"    Dijkstra: {len(pairs) / dijkstra_time:7.1f} queries/s")
+    print(f"    A*      : {len(pairs) / astar_time:7.1f} queries/s")
+
+    # request_ride: the rides picking up within 5 km of the passenger, out of a day's 500 rides
+    router = routing.Router(graph)
+    rides = [((33.80 + rng.random() * 0.2, 35.44 + rng.random() * 0.2),
+              (33.80 + rng.random() * 0.2, 35.44 + rng.random() * 0.2)) for _ in range(500)]
+    ride_lats = [source[0] for source, _ in rides]
+    ride_lngs = [source[1] for source, _ in rides]
+    from ranking import great_circle_km
+    sizes, cold, warm = [], [], []
+    started = time.perf_counter()
+    while time.perf_counter() - started < args.duration:
+        lat, lng = 33.85 + rng.random() * 0.1, 35.49 + rng.random() * 0.1
+        near = [rides[i] for i in (great_circle_km(lat, lng, ride_lats, ride_lngs) <= 5).nonzero()[0]]
+        cached = len(router._direct)
+        elapsed, _ = timed(lambda: router.detours((lat, lng), [s for s, _ in near], [d for _, d in near]), 1)
+        (cold if len(router._direct) > cached else warm).append(elapsed)
+        sizes.append(len(near))
+    print(f"  detours per request_ride ({sum(sizes) / len(sizes):.0f} rides within 5 km on average):")
+    if cold:
+        print(f"    new rides (A* per ride)      : {sum(cold) / len(cold) * 1000:7.1f} ms/request ({len(cold)} requests)")
+    if warm:
+        print(f"    known rides (2 searches only): {sum(warm) / len(warm) * 1000:7.1f} ms/request ({len(warm)} requests)")
+    shutil.rmtree(scratch, ignore_errors=True)
+
+
+@benchmark
+def bench_p2p_server(args):
+    """Load test of the asyncio P2P management server: register N idle peers, heartbeats, evictions"""
+    import resource
+    import struct
+    import subprocess
+    import sys
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    peers = min(args.size or 20000, hard - 64)        # the server process needs one descriptor per peer too
+    if peers < (args.size or 20000):
+        print(f"(open file limit {hard}: testing {peers} peers)")
+    timeout = 30.0
+    silent_every = 10                                # every 10th peer stops sending heartbeats
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, "p2p_server.py"), "--host", "127.0.0.1",
+                               "--port", str(port), "--heartbeat-timeout", str(timeout)],
+                              stdout=subprocess.DEVNULL, preexec_fn=lambda: resource.setrlimit(
+                                  resource.RLIMIT_NOFILE, (hard, hard)))
+    header = struct.Struct("!I")
+
+    def rss_mb():
+        with open(f"/proc/{server.pid}/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmRSS")) / 1024
+
+    def frame(obj):
+        body = json.dumps(obj).encode()
+        return header.pack(len(body)) + body
+
+    async def read_frame(reader):
+        length, = header.unpack(await reader.readexactly(header.size))
+        return json.loads(await reader.readexactly(length))
+
+    async def run():
+        for _ in range(50):
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        idle_rss = rss_mb()
+        gate = asyncio.Semaphore(256)
+        stats = {"registered": 0, "online": 0, "pushed": 0, "pongs": 0, "failed": 0, "evicted": [], "dropped": 0}
+        stop = asyncio.Event()
+        all_registered = asyncio.Event()
+
+        async def peer(i):
+            try:
+                async with gate:
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                    writer.write(json.dumps({"action": "hello", "framing": "length_prefixed"}).encode())
+                    await reader.read(4096)
+                    writer.write(frame({"UserID": f"peer{i}", "P2P_Port": 20000 + i % 40000,
+                                        "DestinationID": f"peer{i ^ 1}", "heartbeat": True}))
+                    reply = await read_frame(reader)
+                    stats["registered"] += 1
+                    stats["online"] += reply["message"] == "destination_online"
+                    interval = reply["heartbeat_interval"]
+                    registered_at = time.perf_counter()
+                if stats["registered"] + stats["failed"] == peers:
+                    all_registered.set()
+            except (OSError, asyncio.IncompleteReadError, KeyError):
+                stats["failed"] += 1
+                if stats["registered"] + stats["failed"] == peers:
+                    all_registered.set()
+                return
+
+            async def listen():
+                try:
+                    while True:
+                        message = await read_frame(reader)
+                        if message.get("type") == "pong":
+                            stats["pongs"] += 1
+                        else:
+                            stats["pushed"] += 1
+                except (OSError, asyncio.IncompleteReadError):
+                    if not stop.is_set():
+                        (stats["evicted"] if i % silent_every == 0 else []).append(time.perf_counter() - registered_at)
+                        stats["dropped"] += i % silent_every != 0
+
+            listener = asyncio.create_task(listen())
+            while not stop.is_set() and not listener.done():
+                if i % silent_every:
+                    writer.write(frame({"type": "ping"}))
+                await asyncio.sleep(interval * (0.5 + (i % 7) / 14))
+            listener.cancel()
+            writer.close()
+
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(peer(i)) for i in range(peers)]
+        await all_registered.wait()
+        elapsed = time.perf_counter() - started
+        print(f"{stats['registered']} peers registered in {elapsed:.1f} s ({stats['registered'] / elapsed:.0f}/s, "
+              f"{stats['failed']} failed), {stats['online']} found their partner online")
+        print(f"  server RSS: {idle_rss:.0f} MB empty, {rss_mb():.0f} MB with every peer registered "
+              f"({(rss_mb() - idle_rss) * 1024 / max(stats['registered'], 1):.1f} KB per peer)")
+        registered_at = time.perf_counter()
+        pongs = stats["pongs"]
+        await asyncio.sleep(timeout * 1.5)
+        window = time.perf_counter() - registered_at
+        evicted = stats["evicted"]
+        print(f"  heartbeats: {(stats['pongs'] - pongs) / window:.0f} pongs/s, "
+              f"{stats['dropped']} live peers dropped")
+        if evicted:
+            print(f"  {len(evicted)} of {(peers + silent_every - 1) // silent_every} silent peers evicted, "
+                  f"{min(evicted):.1f}-{max(evicted):.1f} s after registering (timeout {timeout:.0f} s)")
+        stop.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        asyncio.run(run())
+    finally:
+        server.terminate()
+        server.wait()
+
+
+class ScanningWaitingLists:
+    """The original registry: waiting lists rebuilt by scanning all of them on every disconnect"""
+
+    def __init__(self):
+        self.clients = {}
+        self.waiting = {}
+
+    def register(self, session):
+        self.clients[session.user] = session
+        self.waiting.pop(session.user, [])
+        if session.destination in self.clients:
+            return self.clients[session.destination]
+        self.waiting.setdefault(session.destination, []).append((session.user, session))
+        return None
+
+    def unregister(self, session):
+        self.clients.pop(session.user, None)
+        for dest, lst in list(self.waiting.items()):
+            self.waiting[dest] = [pair for pair in lst if pair[0] != session.user]
+            if not self.waiting[dest]:
+                self.waiting.pop(dest, None)
+
+
+@benchmark
+def bench_p2p_churn(args):
+    """Connect/disconnect churn on the P2P registry, in process and through the server"""
+    import random
+    import struct
+    import subprocess
+    import sys
+    from p2p_server import Registry, Session
+
+    idle = args.size or 10000
+    rng = random.Random(351)
+
+    def churn(registry, seconds):
+        # `idle` peers wait for someone who never comes; churners come and go for a random idle peer
+        for i in range(idle):
+            registry.register(Session(f"idle{i}", f"away{i}", None, "127.0.0.1", 20000))
+        ops = 0
+        live = []
+        stop_time = time.perf_counter() + seconds
+        while time.perf_counter() < stop_time:
+            for _ in range(100):
+                if live and (len(live) > 1000 or rng.random() < 0.5):
+                    registry.unregister(live.pop(rng.randrange(len(live))))
+                else:
+                    session = Session(f"churn{ops}", f"idle{rng.randrange(idle)}", None, "127.0.0.1", 20000)
+                    registry.register(session)
+                    live.append(session)
+                ops += 1
+        return ops / seconds
+
+    print(f"in process, {idle} peers waiting, register/unregister churn:")
+    scanning = churn(ScanningWaitingLists(), args.duration)
+    print(f"  scan on disconnect: {scanning:10.0f} ops/s")
+    indexed = churn(Registry(), args.duration)
+    print(f"  indexed registry  : {indexed:10.0f} ops/s ({indexed / scanning:.0f}x)")
+
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, "p2p_server.py"), "--host", "127.0.0.1",
+                               "--port", str(port)], stdout=subprocess.DEVNULL)
+    header = struct.Struct("!I")
+
+    def frame(obj):
+        body = json.dumps(obj).encode()
+        return header.pack(len(body)) + body
+
+    async def read_frame(reader):
+        length, = header.unpack(await reader.readexactly(header.size))
+        return json.loads(await reader.readexactly(length))
+
+    async def connect(user, destination):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(json.dumps({"action": "hello", "framing": "length_prefixed"}).encode())
+        await reader.read(4096)
+        writer.write(frame({"UserID": user, "P2P_Port": 20000, "DestinationID": destination}))
+        return reader, writer, await read_frame(reader)
+
+    async def run():
+        for _ in range(50):
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        waiters = min(idle, 2000)
+        held = [await connect(f"idle{i}", f"churn{i}") for i in range(waiters)]
+        cycles = []
+        matched = [0]
+        stop_time = time.perf_counter() + args.duration
+
+        async def churner(c):
+            n = 0
+            while time.perf_counter() < stop_time:
+                started = time.perf_counter()
+                # every other cycle pairs with a waiting idle peer, the rest wait for nobody
+                target = c * 1000 + n
+                reader, writer, reply = await connect(f"churn{target % waiters if n % 2 else target}",
+                                                      f"idle{target % waiters}")
+                matched[0] += reply["message"] == "destination_online"
+                writer.close()
+                await writer.wait_closed()
+                cycles.append(time.perf_counter() - started)
+                n += 1
+
+        await asyncio.gather(*(churner(c) for c in range(args.clients)))
+        for _, writer, _ in held:
+            writer.close()
+        return cycles, matched[0], waiters
+
+    try:
+        cycles, matched, waiters = asyncio.run(run())
+    finally:
+        server.terminate()
+        server.wait()
+    print(f"through the server, {waiters} peers waiting, {args.clients} churning clients:")
+    print(f"  {len(cycles) / args.duration:.0f} connect/register/disconnect cycles/s, {matched} matched, "
+          f"p50 {percentile(cycles, 0.5) * 1000:.1f} ms, p95 {percentile(cycles, 0.95) * 1000:.1f} ms")
+
+
+@benchmark
+def bench_p2p_relay(args):
+    """Many concurrent conversations relayed through the P2P management server"""
+    import struct
+    import subprocess
+    import sys
+
+    pairs = args.size or 500
+    window = args.max_concurrency or 1  # messages each sender may have in flight
+    text = "x" * 200
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, "p2p_server.py"), "--host", "127.0.0.1",
+                               "--port", str(port)], stdout=subprocess.DEVNULL)
+    header = struct.Struct("!I")
+
+    def rss_mb():
+        with open(f"/proc/{server.pid}/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmRSS")) / 1024
+
+    def frame(obj):
+        body = json.dumps(obj).encode()
+        return header.pack(len(body)) + body
+
+    async def read_frame(reader):
+        length, = header.unpack(await reader.readexactly(header.size))
+        return json.loads(await reader.readexactly(length))
+
+    async def connect(user, destination):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(json.dumps({"action": "hello", "framing": "length_prefixed"}).encode())
+        await reader.read(4096)
+        writer.write(frame({"UserID": user, "P2P_Port": 20000, "DestinationID": destination}))
+        await read_frame(reader)
+        return reader, writer
+
+    async def run():
+        for _ in range(50):
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        idle_rss = rss_mb()
+        peers = []
+        for i in range(pairs):
+            peers.append(await connect(f"a{i}", f"b{i}"))
+            peers.append(await connect(f"b{i}", f"a{i}"))
+        in_flight = {f"{side}{i}": asyncio.Semaphore(window) for i in range(pairs) for side in "ab"}
+        latencies = []
+        counts = {"sent": 0, "delivered": 0, "errors": 0}
+        stop_time = time.perf_counter() + args.duration
+        peak = [rss_mb()]
+
+        async def sender(user, writer):
+            slots = in_flight[user]
+            while time.perf_counter() < stop_time:
+                await slots.acquire()
+                writer.write(frame({"type": "relay", "payload": {"type": "chat", "text": text,
+                                                                 "sent": time.perf_counter()}}))
+                counts["sent"] += 1
+                await writer.drain()
+
+        async def receiver(reader):
+            try:
+                while True:
+                    message = await read_frame(reader)
+                    if message.get("type") == "relay":
+                        counts["delivered"] += 1
+                        latencies.append(time.perf_counter() - message["payload"]["sent"])
+                        in_flight[message["from"]].release()
+                    elif message.get("type") == "relay_error":
+                        counts["errors"] += 1
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+
+        async def sample():
+            while time.perf_counter() < stop_time:
+                peak[0] = max(peak[0], rss_mb())
+                await asyncio.sleep(0.2)
+
+        receivers = [asyncio.create_task(receiver(reader)) for reader, _ in peers]
+        started = time.perf_counter()
+        await asyncio.gather(sample(), *(sender(f"{'ab'[k % 2]}{k // 2}", writer)
+                                         for k, (_, writer) in enumerate(peers)))
+        elapsed = time.perf_counter() - started
+        for _ in range(50):                 # let the last messages arrive
+            if counts["delivered"] + counts["errors"] >= counts["sent"]:
+                break
+            await asyncio.sleep(0.1)
+        for task in receivers:
+            task.cancel()
+        for _, writer in peers:
+            writer.close()
+        return latencies, counts, elapsed, idle_rss, peak[0]
+
+    try:
+        latencies, counts, elapsed, idle_rss, peak = asyncio.run(run())
+    finally:
+        server.terminate()
+        server.wait()
+    print(f"{pairs} conversations, both sides sending {len(text)}-character messages for {args.duration:.0f} s "
+          f"({window} in flight each):")
+    print(f"  {counts['delivered'] / elapsed:.0f} messages/s relayed ({counts['delivered']} of {counts['sent']} "
+          f"delivered, {counts['errors']} errors)")
+    print(f"  latency p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p95 {percentile(latencies, 0.95) * 1000:.1f} ms")
+    print(f"  server RSS {idle_rss:.0f} MB idle, {peak:.0f} MB peak")
+
+
+@benchmark
+def bench_message_store(args):
+    """Store-and-forward chat log: appends, batch delivery on registration, compaction"""
+    import random
+    from message_store import MessageStore
+
+    conversations = args.size or 1000
+    per_conversation = 20
+    scratch = tempfile.mkdtemp(prefix="aubus_messages_")
+    store = MessageStore(scratch)
+    rng = random.Random(351)
+    payload = {"type": "chat", "text": "x" * 120}
+
+    started = time.perf_counter()
+    for n in range(conversations * per_conversation):
+        ride = rng.randrange(conversations)
+        store.append(ride, f"driver{ride}", f"rider{ride}", payload)
+    elapsed = time.perf_counter() - started
+    print(f"append: {conversations * per_conversation / elapsed:.0f} messages/s "
+          f"({conversations} conversations, {store.stats()['bytes'] / 1024:.0f} KB on disk)")
+
+    fresh = MessageStore(scratch)          # as after a server restart
+    timings = []
+    batch_sizes = []
+    for ride in range(conversations):
+        started = time.perf_counter()
+        messages = fresh.pending(ride, f"rider{ride}", f"driver{ride}")
+        if messages:
+            fresh.mark_delivered(ride, f"rider{ride}", f"driver{ride}", messages[-1]["seq"])
+        timings.append(time.perf_counter() - started)
+        batch_sizes.append(len(messages))
+    print(f"delivery on registration: p50 {percentile(timings, 0.5) * 1000:.2f} ms, "
+          f"p95 {percentile(timings, 0.95) * 1000:.2f} ms for batches of {sum(batch_sizes) / len(batch_sizes):.0f} "
+          f"messages, {fresh.stats()['conversations']} files left")
+
+    store = MessageStore(scratch, max_pending=50)
+    started = time.perf_counter()
+    for n in range(20000):
+        store.append("flood", "driver", "rider", payload)
+    elapsed = time.perf_counter() - started
+    stats = store.stats()
+    print(f"one conversation, 20000 messages to an offline peer: {20000 / elapsed:.0f} appends/s with compaction, "
+          f"{stats['pending']} kept, {stats['bytes'] / 1024:.0f} KB on disk")
+    shutil.rmtree(scratch, ignore_errors=True)
+
+
+@benchmark
+def bench_p2p_cluster(args):
+    """P2P management servers as a cluster of local processes: every pair matched across nodes"""
+    import random
+    import struct
+    import subprocess
+    import sys
+    from p2p_cluster import HashRing
+
+    pairs = args.size or 2000
+    header = struct.Struct("!I")
+
+    def frame(obj):
+        body = json.dumps(obj).encode()
+        return header.pack(len(body)) + body
+
+    async def read_frame(reader):
+        length, = header.unpack(await reader.readexactly(header.size))
+        return json.loads(await reader.readexactly(length))
+
+    def run_cluster(node_count):
+        ports = [free_port() for _ in range(node_count)]
+        spec = ",".join(f"n{i}=127.0.0.1:{port}" for i, port in enumerate(ports))
+        scratch = tempfile.mkdtemp(prefix="aubus_cluster_")
+        servers = [subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, "p2p_server.py"), "--host", "127.0.0.1",
+                                     "--port", str(port), "--node-id", f"n{i}", "--cluster", spec,
+                                     "--message-dir", scratch], stdout=subprocess.DEVNULL)
+                   for i, port in enumerate(ports)]
+        rng = random.Random(351)
+
+        async def connect(port, user, destination, p2p_port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(json.dumps({"action": "hello", "framing": "length_prefixed"}).encode())
+            await reader.read(4096)
+            writer.write(frame({"UserID": user, "P2P_Port": p2p_port, "DestinationID": destination}))
+            return reader, writer, await read_frame(reader)
+
+        async def run():
+            for port in ports:
+                for _ in range(50):
+                    try:
+                        _, writer = await asyncio.open_connection("127.0.0.1", port)
+                        writer.close()
+                        break
+                    except OSError:
+                        await asyncio.sleep(0.1)
+            gate = asyncio.Semaphore(128)
+            latencies = []
+            failures = []
+
+            async def pair(k):
+                async with gate:
+                    started = time.perf_counter()
+                    try:
+                        reader_a, writer_a, reply = await connect(rng.choice(ports), f"rider{k}", f"driver{k}", 1)
+                        ok = reply["message"] == "registered_waiting"
+                        reader_b, writer_b, reply = await connect(rng.choice(ports), f"driver{k}", f"rider{k}", 2)
+                        ok = ok and reply["message"] == "destination_online" and reply["destination_port"] == 1
+                        seen = [(await read_frame(reader_a)).get("type") for _ in range(2)]
+                        writer_b.write(frame({"type": "relay", "payload": {"type": "chat", "text": "on my way"}}))
+                        relayed = await read_frame(reader_a)
+                        ok = ok and seen[1] == "connection_request" and relayed.get("from") == f"driver{k}"
+                        writer_a.close()
+                        writer_b.close()
+                    except (OSError, asyncio.IncompleteReadError, KeyError):
+                        ok = False
+                    latencies.append(time.perf_counter() - started)
+                    if not ok:
+                        failures.append(k)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(pair(k) for k in range(pairs)))
+            return time.perf_counter() - started, latencies, failures
+
+        try:
+            elapsed, latencies, failures = asyncio.run(run())
+        finally:
+            for server in servers:
+                server.terminate()
+                server.wait()
+            shutil.rmtree(scratch, ignore_errors=True)
+        ring = HashRing([f"n{i}" for i in range(node_count)])
+        homes = {}
+        for k in range(pairs):
+            node = ring.node_for(min(f"rider{k}", f"driver{k}"))
+            homes[node] = homes.get(node, 0) + 1
+        local = 1 / node_count
+        print(f"{node_count} node(s): {pairs} pairs matched and relayed in {elapsed:.1f} s "
+              f"({pairs / elapsed:.0f} pairs/s), {len(failures)} failed, "
+              f"p50 {percentile(latencies, 0.5) * 1000:.0f} ms, p95 {percentile(latencies, 0.95) * 1000:.0f} ms")
+        print(f"  conversations per node: {dict(sorted(homes.items()))}; "
+              f"~{(1 - local) * 100:.0f}% of peers reach their conversation through another node")
+
+    for node_count in sorted({1, args.workers or 3}):
+        run_cluster(node_count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AUBus backend benchmarks")
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--size", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Shared SQLite connections for every backend handler.
+#
+# Connections are opened lazily up to POOL_SIZE, tuned once when they are
+# opened, and checked out for the duration of one handler. Settings can be
+# overridden with environment variables; a server running handlers on a
+# fixed thread pool reserves one connection per thread on top of that.
+
+DB_PATH = os.environ.get("AUBUS_DB_PATH", "aubus.db")
+POOL_SIZE = int(os.environ.get("AUBUS_DB_POOL_SIZE", "8"))
+CACHE_SIZE_KB = int(os.environ.get("AUBUS_DB_CACHE_KB", "16384"))
+MMAP_SIZE = int(os.environ.get("AUBUS_DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+BUSY_TIMEOUT = 5.0
+ACQUIRE_TIMEOUT = 10.0
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """No connection became free in time; handlers treat it like any database error"""
+
+
+class ConnectionPool:
+    def __init__(self, path=DB_PATH, size=POOL_SIZE):
+        self.path = path
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._checkouts = 0
+        self._waits = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def reserve(self, size):
+        """Let the pool grow to at least `size` connections, e.g. one per executor thread"""
+        with self._lock:
+            self.size = max(self.size, size)
+
+    def acquire(self, timeout=ACQUIRE_TIMEOUT):
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._opened < self.size:
+                    self._opened += 1
+                    open_new = True
+                else:
+                    open_new = False
+            if open_new:
+                try:
+                    conn = self._open()
+                except sqlite3.Error:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise PoolTimeout(f"no database connection free after {timeout}s")
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._checkouts += 1
+            if waited > 0.001:
+                self._waits += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+        return conn
+
+    def release(self, conn):
+        try:
+            # never hand the next handler a half-finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "opened": self._opened,
+                "idle": self._idle.qsize(),
+                "checkouts": self._checkouts,
+                "waited": self._waits,
+                "avg_wait_ms": 1000 * self._total_wait / self._checkouts if self._checkouts else 0.0,
+                "max_wait_ms": 1000 * self._max_wait,
+                "timeouts": self._timeouts,
+            }
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def connection():
+    """Check a connection out of the shared pool: `with connection() as conn:`"""
+    return get_pool().connection()
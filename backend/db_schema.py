@@ -96,13 +96,238 @@ CREATE TABLE IF NOT EXISTS IpInfos (
 
 """
 
+# Versioned changes applied on top of SQL_SCHEMA. The version reached is kept
+# in PRAGMA user_version, so every migration runs exactly once per database.
+MIGRATIONS = [
+    (1, """
+    -- hot lookups: login, sign-up duplicate check, ride matching, requests, ratings
+    CREATE INDEX IF NOT EXISTS idx_user_username ON "user"(username);
+    CREATE INDEX IF NOT EXISTS idx_user_aubID ON "user"(aubID);
+    CREATE INDEX IF NOT EXISTS idx_zone_user ON "Zone"(UserID);
+    CREATE INDEX IF NOT EXISTS idx_car_owner ON "Car"(ownerID);
+    CREATE INDEX IF NOT EXISTS idx_car_plate ON "Car"(carPlate);
+    CREATE INDEX IF NOT EXISTS idx_ride_time ON Ride(startTime, endTime);
+    CREATE INDEX IF NOT EXISTS idx_ride_owner ON Ride(ownerID, startTime);
+    CREATE INDEX IF NOT EXISTS idx_ride_schedule ON Ride(scheduleID);
+    CREATE INDEX IF NOT EXISTS idx_ride_car ON Ride(carId);
+    CREATE INDEX IF NOT EXISTS idx_rider_ride ON Rider(rideID);
+    CREATE INDEX IF NOT EXISTS idx_request_ride_status ON Request(rideID, status);
+    CREATE INDEX IF NOT EXISTS idx_request_rider_status ON Request(riderID, status);
+    CREATE INDEX IF NOT EXISTS idx_rating_ratee ON Rating(rateeID);
+    CREATE INDEX IF NOT EXISTS idx_ipinfos_ip ON IpInfos(userCurrentIP);
+    """),
+    (2, """
+    -- R*Tree mirror of the Zone coordinates (zoneX = latitude, zoneY = longitude)
+    -- keyed by Zone's rowid; the triggers keep it in sync with every write to
+    -- Zone (sign-up, add_ride, edit_ride, update_zone, ...) and create_schema
+    -- rebuilds it if a VACUUM renumbered the rowids
+    CREATE VIRTUAL TABLE IF NOT EXISTS ZoneRTree USING rtree(id, minX, maxX, minY, maxY);
+    INSERT OR REPLACE INTO ZoneRTree (id, minX, maxX, minY, maxY)
+        SELECT rowid, zoneX, zoneX, zoneY, zoneY FROM "Zone"
+        WHERE zoneX IS NOT NULL AND zoneY IS NOT NULL;
+
+    CREATE TRIGGER IF NOT EXISTS zone_rtree_insert AFTER INSERT ON "Zone"
+    WHEN NEW.zoneX IS NOT NULL AND NEW.zoneY IS NOT NULL
+    BEGIN
+        INSERT OR REPLACE INTO ZoneRTree (id, minX, maxX, minY, maxY)
+        VALUES (NEW.rowid, NEW.zoneX, NEW.zoneX, NEW.zoneY, NEW.zoneY);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS zone_rtree_update AFTER UPDATE OF zoneX, zoneY ON "Zone"
+    BEGIN
+        DELETE FROM ZoneRTree WHERE id = OLD.rowid;
+        INSERT INTO ZoneRTree (id, minX, maxX, minY, maxY)
+        SELECT NEW.rowid, NEW.zoneX, NEW.zoneX, NEW.zoneY, NEW.zoneY
+        WHERE NEW.zoneX IS NOT NULL AND NEW.zoneY IS NOT NULL;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS zone_rtree_delete AFTER DELETE ON "Zone"
+    BEGIN
+        DELETE FROM ZoneRTree WHERE id = OLD.rowid;
+    END;
+
+    CREATE INDEX IF NOT EXISTS idx_ride_source ON Ride(sourceID);
+    """),
+    (3, """
+    -- Change log of Request/Ride/Rider mutations for delta sync. seq only grows
+    -- (AUTOINCREMENT never reuses a number), so a client's cursor is the last
+    -- seq it has seen. Every row records the ride's owner and, for requests and
+    -- riders, the passenger, so both sides can read their own changes by index.
+    -- A ride edit or removal also logs an update for each request on that ride,
+    -- since the route shown with those requests changes with it.
+    CREATE TABLE IF NOT EXISTS ChangeLog (
+        seq       INTEGER PRIMARY KEY AUTOINCREMENT,
+        tableName TEXT NOT NULL,
+        rowKey    TEXT NOT NULL,
+        op        TEXT NOT NULL,
+        rideID    TEXT,
+        ownerID   INTEGER,
+        riderID   INTEGER,
+        changedAt INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
+    );
+    CREATE INDEX IF NOT EXISTS idx_changelog_owner ON ChangeLog(ownerID, seq);
+    CREATE INDEX IF NOT EXISTS idx_changelog_rider ON ChangeLog(riderID, seq);
+
+    CREATE TRIGGER IF NOT EXISTS changelog_request_insert AFTER INSERT ON Request
+    BEGIN
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID, riderID)
+        VALUES ('Request', NEW.requestID, 'insert', NEW.rideID,
+                (SELECT ownerID FROM Ride WHERE rideID = NEW.rideID), NEW.riderID);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS changelog_request_update AFTER UPDATE ON Request
+    BEGIN
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID, riderID)
+        VALUES ('Request', NEW.requestID, 'update', NEW.rideID,
+                (SELECT ownerID FROM Ride WHERE rideID = NEW.rideID), NEW.riderID);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS changelog_request_delete AFTER DELETE ON Request
+    BEGIN
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID, riderID)
+        VALUES ('Request', OLD.requestID, 'delete', OLD.rideID,
+                (SELECT ownerID FROM Ride WHERE rideID = OLD.rideID), OLD.riderID);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS changelog_ride_insert AFTER INSERT ON Ride
+    BEGIN
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID)
+        VALUES ('Ride', NEW.rideID, 'insert', NEW.rideID, NEW.ownerID);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS changelog_ride_update AFTER UPDATE ON Ride
+    BEGIN
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID)
+        VALUES ('Ride', NEW.rideID, 'update', NEW.rideID, NEW.ownerID);
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID, riderID)
+        SELECT 'Request', requestID, 'update', rideID, NEW.ownerID, riderID
+        FROM Request WHERE rideID = NEW.rideID;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS changelog_ride_delete AFTER DELETE ON Ride
+    BEGIN
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID)
+        VALUES ('Ride', OLD.rideID, 'delete', OLD.rideID, OLD.ownerID);
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID, riderID)
+        SELECT 'Request', requestID, 'update', rideID, OLD.ownerID, riderID
+        FROM Request WHERE rideID = OLD.rideID;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS changelog_rider_insert AFTER INSERT ON Rider
+    BEGIN
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID, riderID)
+        VALUES ('Rider', NEW.userID || ':' || NEW.rideID, 'insert', NEW.rideID,
+                (SELECT ownerID FROM Ride WHERE rideID = NEW.rideID), NEW.userID);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS changelog_rider_delete AFTER DELETE ON Rider
+    BEGIN
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID, riderID)
+        VALUES ('Rider', OLD.userID || ':' || OLD.rideID, 'delete', OLD.rideID,
+                (SELECT ownerID FROM Ride WHERE rideID = OLD.rideID), OLD.userID);
+    END;
+    """),
+    (4, """
+    -- Denormalized passenger count, kept by seats.reserve_seat with a conditional
+    -- UPDATE so concurrent accepts cannot over-book a car. The ride change-log
+    -- trigger now ignores this column: a seat change is already logged through
+    -- its Rider row, and every accept would otherwise log all the ride's requests.
+    DROP TRIGGER IF EXISTS changelog_ride_update;
+    ALTER TABLE Ride ADD COLUMN seats_taken INTEGER NOT NULL DEFAULT 0;
+    UPDATE Ride SET seats_taken = (SELECT COUNT(*) FROM Rider WHERE Rider.rideID = Ride.rideID);
+
+    CREATE TRIGGER IF NOT EXISTS changelog_ride_update
+    AFTER UPDATE OF ownerID, carId, sourceID, destinationID, startTime, endTime, scheduleID ON Ride
+    BEGIN
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID)
+        VALUES ('Ride', NEW.rideID, 'update', NEW.rideID, NEW.ownerID);
+        INSERT INTO ChangeLog (tableName, rowKey, op, rideID, ownerID, riderID)
+        SELECT 'Request', requestID, 'update', rideID, NEW.ownerID, riderID
+        FROM Request WHERE rideID = NEW.rideID;
+    END;
+    """),
+    (5, """
+    -- worker ids of the processes generating IDs (see id_generator.py)
+    CREATE TABLE IF NOT EXISTS WorkerLease (
+        workerID  INTEGER PRIMARY KEY,
+        owner     TEXT NOT NULL,
+        expiresAt INTEGER NOT NULL
+    );
+    """),
+    (6, """
+    -- ride_index re-reads the rides dropping off in a zone that moved too
+    CREATE INDEX IF NOT EXISTS idx_ride_destination ON Ride(destinationID);
+    """),
+]
+
+# ChangeLog rows older than this are pruned when the schema is opened; a
+# client whose cursor falls behind the oldest kept row gets a full resync.
+CHANGELOG_RETENTION_SECONDS = 7 * 24 * 3600
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def zone_rtree_in_sync(conn):
+    """True when every located Zone row has its own box in ZoneRTree, and nothing else does"""
+    # the R*Tree keeps 32-bit floats rounded outwards, so a box contains its point rather than equals it
+    return bool(conn.execute("""
+        SELECT (SELECT COUNT(*) FROM "Zone" WHERE zoneX IS NOT NULL AND zoneY IS NOT NULL)
+             = (SELECT COUNT(*) FROM ZoneRTree)
+           AND NOT EXISTS (
+               SELECT 1 FROM "Zone" AS z
+               WHERE z.zoneX IS NOT NULL AND z.zoneY IS NOT NULL AND NOT EXISTS (
+                   SELECT 1 FROM ZoneRTree AS zr
+                   WHERE zr.id = z.rowid AND zr.minX <= z.zoneX AND zr.maxX >= z.zoneX
+                     AND zr.minY <= z.zoneY AND zr.maxY >= z.zoneY))
+    """).fetchone()[0])
+
+
+def rebuild_zone_rtree(conn):
+    """Re-mirror Zone into ZoneRTree, needed after a VACUUM renumbers Zone's rowids"""
+    conn.execute("DELETE FROM ZoneRTree")
+    conn.execute("""
+        INSERT INTO ZoneRTree (id, minX, maxX, minY, maxY)
+        SELECT rowid, zoneX, zoneX, zoneY, zoneY FROM "Zone"
+        WHERE zoneX IS NOT NULL AND zoneY IS NOT NULL
+    """)
+    conn.commit()
+
+
+def migrate(conn):
+    """Bring an open database up to SCHEMA_VERSION"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, script in MIGRATIONS:
+        if target > version:
+            conn.executescript(script)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+            version = target
+    return version
+
+
+def prune_changelog(conn, retention=CHANGELOG_RETENTION_SECONDS):
+    """Drop old ChangeLog rows, always keeping the newest so the sequence can be told apart from a reset"""
+    conn.execute("""
+        DELETE FROM ChangeLog
+        WHERE changedAt < strftime('%s', 'now') - ? AND seq < (SELECT MAX(seq) FROM ChangeLog)
+    """, (retention,))
+    conn.commit()
+
+
 def create_schema(db_path: str = "aubus.db") -> None:
     conn = sqlite3.connect(db_path)
     try:
         conn.executescript(SQL_SCHEMA)
         conn.commit()
+        migrate(conn)
+        # ZoneRTree is keyed by Zone's rowid, which a VACUUM may renumber
+        if not zone_rtree_in_sync(conn):
+            print("[schema] ZoneRTree out of sync with Zone, rebuilding it")
+            rebuild_zone_rtree(conn)
+        prune_changelog(conn)
     finally:
         conn.close()
 
-create_schema()
 
+if __name__ == "__main__":
+    create_schema()
@@ -0,0 +1,205 @@
+import asyncio
+import codecs
+import json
+import struct
+import threading
+
+# Gateway wire protocol.
+#
+# Connections start in the legacy mode: one JSON object per send(), no
+# delimiters. A client that understands framing sends
+#     {"action": "hello", "framing": "length_prefixed"}
+# as its first legacy message; the gateway answers in legacy JSON and from
+# then on every message in both directions is a 4-byte big-endian length
+# followed by that many bytes of UTF-8 JSON. Servers that do not know the
+# hello action answer "Invalid action" and the client stays on legacy JSON.
+
+FRAMING = "length_prefixed"
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+LEGACY_CHUNK = 4096
+
+
+class FrameError(Exception):
+    pass
+
+
+def encode_frame(payload):
+    """Frame raw JSON bytes"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_message(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def parse_header(header):
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise FrameError(f"frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+    return length
+
+
+def is_hello(data):
+    return isinstance(data, dict) and data.get("action") == "hello"
+
+
+def hello_response(data):
+    if data.get("framing") == FRAMING:
+        return {"status": "200", "message": "Framing enabled", "framing": FRAMING}
+    return {"status": "400", "message": f"Unsupported framing, use {FRAMING}"}
+
+
+class LegacyDecoder:
+    """Splits a legacy byte stream into JSON objects, keeping partial data buffered"""
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ""
+
+    def feed(self, chunk):
+        self._buffer += self._utf8.decode(chunk)
+
+    def next_message(self, more_expected):
+        """Pop the next complete object, or None if the buffer holds only part of one"""
+        text = self._buffer.lstrip()
+        if not text:
+            self._buffer = ""
+            return None
+        try:
+            obj, end = self._decoder.raw_decode(text)
+        except json.JSONDecodeError:
+            # old clients write each request with a single send(); a full
+            # read means the object was split across reads, anything else
+            # is a malformed request
+            if more_expected:
+                return None
+            raise
+        self._buffer = text[end:]
+        return obj
+
+
+class SocketChannel:
+    """Message channel over a blocking socket, handed to handlers as their client_socket"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.framed = False
+        self._legacy = LegacyDecoder()
+        self._send_lock = threading.Lock()   # responses and pushed events share the socket
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def _recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                if data:
+                    raise FrameError("connection closed in the middle of a frame")
+                return None
+            data += chunk
+        return bytes(data)
+
+    def receive(self):
+        """Return the next request object, or None once the peer has closed"""
+        if self.framed:
+            header = self._recv_exactly(HEADER.size)
+            if header is None:
+                return None
+            body = self._recv_exactly(parse_header(header))
+            if body is None:
+                raise FrameError("connection closed in the middle of a frame")
+            return json.loads(body.decode('utf-8'))
+        more_expected = False
+        while True:
+            obj = self._legacy.next_message(more_expected)
+            if obj is not None:
+                return obj
+            chunk = self.sock.recv(LEGACY_CHUNK)
+            if not chunk:
+                return None
+            self._legacy.feed(chunk)
+            more_expected = len(chunk) == LEGACY_CHUNK
+
+    def send(self, payload):
+        """Send one message given as JSON bytes"""
+        if self.framed:
+            payload = encode_frame(payload)
+        with self._send_lock:
+            self.sock.sendall(payload)
+        return len(payload)
+
+    def send_json(self, obj):
+        return self.send(encode_message(obj))
+
+    def negotiate(self, data):
+        """Answer a hello request and switch to framing if it was accepted"""
+        response = hello_response(data)
+        self.send_json(response)
+        self.framed = response["status"] == "200"
+
+    def close(self):
+        self.sock.close()
+
+
+class StreamChannel:
+    """Message channel over an asyncio stream pair"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.framed = False
+        self._legacy = LegacyDecoder()
+        self._drain_lock = asyncio.Lock()
+
+    def getpeername(self):
+        return self.writer.get_extra_info("peername")
+
+    async def receive(self):
+        if self.framed:
+            try:
+                header = await self.reader.readexactly(HEADER.size)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise FrameError("connection closed in the middle of a frame")
+                return None
+            body = await self.reader.readexactly(parse_header(header))
+            return json.loads(body.decode('utf-8'))
+        more_expected = False
+        while True:
+            obj = self._legacy.next_message(more_expected)
+            if obj is not None:
+                return obj
+            chunk = await self.reader.read(LEGACY_CHUNK)
+            if not chunk:
+                return None
+            self._legacy.feed(chunk)
+            more_expected = len(chunk) == LEGACY_CHUNK
+
+    def write(self, payload):
+        """Queue one message given as JSON bytes, must run on the event loop"""
+        if self.framed:
+            payload = encode_frame(payload)
+        self.writer.write(payload)
+
+    async def drain(self):
+        """Wait until the socket's write buffer is below its limit again"""
+        async with self._drain_lock:
+            await self.writer.drain()
+
+    async def send_json(self, obj):
+        self.write(encode_message(obj))
+        await self.drain()
+
+    async def negotiate(self, data):
+        response = hello_response(data)
+        await self.send_json(response)
+        self.framed = response["status"] == "200"
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,210 @@
+import atexit
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import db_pool
+
+# Snowflake-style IDs for every row the backend creates.
+#
+#     | 41 bits: ms since EPOCH_MS | 10 bits: worker id | 12 bits: sequence |
+#
+# IDs are unique as long as no two generators share a worker id, so every
+# process leases one from the WorkerLease table; the lease is taken inside
+# BEGIN IMMEDIATE, so gateways starting together cannot pick the same id. A
+# background thread renews it, and a generator whose lease has run out
+# refuses to hand out IDs rather than risk sharing its worker id. Inside a
+# process a lock serializes the (millisecond, sequence) pair: 4096 IDs per
+# millisecond, after which the generator waits for the next millisecond. If
+# the clock steps back, IDs keep counting on the last millisecond seen.
+
+EPOCH_MS = 1704067200000        # 2024-01-01 UTC
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKERS = 1 << WORKER_BITS
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+LEASE_SECONDS = 60
+RENEW_SECONDS = 20
+LEASE_MARGIN = 5                # stop using a lease this long before it expires (clock skew between hosts)
+
+
+class NoWorkerId(sqlite3.OperationalError):
+    """No worker id could be leased or the lease ran out; handlers answer unavailable(error)"""
+
+
+def _now_ms():
+    return time.time_ns() // 1_000_000
+
+
+class IdGenerator:
+    def __init__(self, worker_id, valid_until=float("inf")):
+        if not 0 <= worker_id < MAX_WORKERS:
+            raise ValueError(f"worker id must be in [0, {MAX_WORKERS})")
+        self._lock = threading.Lock()
+        self._worker_id = worker_id
+        self._valid_until_ms = valid_until * 1000
+        self._last_ms = 0
+        self._sequence = 0
+
+    def switch(self, worker_id, valid_until):
+        """Continue under another (or a renewed) worker lease"""
+        with self._lock:
+            self._worker_id = worker_id
+            self._valid_until_ms = valid_until * 1000
+
+    def _take(self, wanted):
+        # (millisecond, first sequence, count) for up to `wanted` IDs; called with the lock held
+        now = _now_ms()
+        if now >= self._valid_until_ms:
+            raise NoWorkerId("worker id lease expired")
+        if now > self._last_ms:
+            self._last_ms, self._sequence = now, 0
+        elif self._sequence > SEQUENCE_MASK:
+            while now <= self._last_ms:     # this millisecond is used up
+                now = _now_ms()
+            self._last_ms, self._sequence = now, 0
+        first = self._sequence
+        count = min(wanted, SEQUENCE_MASK + 1 - first)
+        self._sequence += count
+        return self._last_ms, first, count
+
+    def next_id(self):
+        with self._lock:
+            # _take(1) inlined for the common cases: a new millisecond, or one with sequence numbers left
+            now = time.time_ns() // 1_000_000
+            if now > self._last_ms and now < self._valid_until_ms:
+                self._last_ms, self._sequence = now, 1
+                return ((now - EPOCH_MS) << TIMESTAMP_SHIFT) | (self._worker_id << SEQUENCE_BITS)
+            if self._sequence <= SEQUENCE_MASK and now < self._valid_until_ms:
+                sequence = self._sequence
+                self._sequence = sequence + 1
+            else:
+                _, sequence, _ = self._take(1)
+            return ((self._last_ms - EPOCH_MS) << TIMESTAMP_SHIFT) | (self._worker_id << SEQUENCE_BITS) | sequence
+
+    def next_ids(self, count):
+        """`count` IDs in one call, a block of sequence numbers per millisecond"""
+        ids = []
+        with self._lock:
+            while len(ids) < count:
+                ms, first, taken = self._take(count - len(ids))
+                base = ((ms - EPOCH_MS) << TIMESTAMP_SHIFT) | (self._worker_id << SEQUENCE_BITS)
+                ids.extend(range(base + first, base + first + taken))
+        return ids
+
+
+def parse_id(value):
+    """(unix ms, worker id, sequence) of an ID"""
+    value = int(value)
+    return ((value >> TIMESTAMP_SHIFT) + EPOCH_MS,
+            (value >> SEQUENCE_BITS) & (MAX_WORKERS - 1),
+            value & SEQUENCE_MASK)
+
+
+class WorkerLease:
+    """A worker id held in the WorkerLease table by this process"""
+
+    def __init__(self, path=None):
+        self.path = path or db_pool.DB_PATH
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.worker_id = None
+        self.expires = 0
+
+    def _connect(self):
+        # not a pooled connection: renewals must never wait for a handler's checkout
+        return sqlite3.connect(self.path, timeout=db_pool.BUSY_TIMEOUT)
+
+    def acquire(self):
+        now = int(time.time())
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            held = {row[0] for row in conn.execute('SELECT workerID FROM WorkerLease WHERE expiresAt > ?', (now,))}
+            free = next((worker for worker in range(MAX_WORKERS) if worker not in held), None)
+            if free is None:
+                conn.rollback()
+                raise NoWorkerId(f"all {MAX_WORKERS} worker ids are leased")
+            conn.execute('INSERT OR REPLACE INTO WorkerLease (workerID, owner, expiresAt) VALUES (?, ?, ?)',
+                         (free, self.owner, now + LEASE_SECONDS))
+            conn.commit()
+        finally:
+            conn.close()
+        self.worker_id, self.expires = free, now + LEASE_SECONDS
+        return free
+
+    def renew(self):
+        """Extend the lease, False if another process has taken the worker id over"""
+        now = int(time.time())
+        conn = self._connect()
+        try:
+            cur = conn.execute('UPDATE WorkerLease SET expiresAt = ? WHERE workerID = ? AND owner = ?',
+                               (now + LEASE_SECONDS, self.worker_id, self.owner))
+            conn.commit()
+        finally:
+            conn.close()
+        if cur.rowcount != 1:
+            return False
+        self.expires = now + LEASE_SECONDS
+        return True
+
+    def release(self):
+        try:
+            conn = self._connect()
+            try:
+                conn.execute('DELETE FROM WorkerLease WHERE workerID = ? AND owner = ?', (self.worker_id, self.owner))
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass    # it expires on its own
+
+
+_generator = None
+_generator_pid = None
+_generator_lock = threading.Lock()
+
+
+def _keep_lease(lease, generator):
+    while True:
+        time.sleep(RENEW_SECONDS)
+        try:
+            if not lease.renew():
+                print(f"[id_generator] worker id {lease.worker_id} was taken over, leasing a new one")
+                lease.acquire()
+            generator.switch(lease.worker_id, lease.expires - LEASE_MARGIN)
+        except sqlite3.Error as e:
+            # the generator stops on its own once the current lease runs out
+            print(f"[id_generator] could not renew worker id {lease.worker_id}: {e}")
+
+
+def get_generator():
+    """The process-wide generator, leasing a worker id on first use (and again in a forked child)"""
+    global _generator, _generator_pid
+    if _generator is None or _generator_pid != os.getpid():
+        with _generator_lock:
+            if _generator is None or _generator_pid != os.getpid():
+                lease = WorkerLease()
+                lease.acquire()
+                atexit.register(lease.release)
+                generator = IdGenerator(lease.worker_id, lease.expires - LEASE_MARGIN)
+                threading.Thread(target=_keep_lease, args=(lease, generator), daemon=True).start()
+                _generator, _generator_pid = generator, os.getpid()
+    return _generator
+
+
+def next_id():
+    return get_generator().next_id()
+
+
+def unavailable(error):
+    """Response of a handler that could not get an ID, the client may retry"""
+    return {"status": "503", "message": f"Cannot allocate an ID right now, please retry: {error}"}
+
+
+def next_ids(count):
+    return get_generator().next_ids(count)
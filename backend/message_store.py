@@ -0,0 +1,232 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+
+# Store-and-forward log for ride chats.
+#
+# A message relayed to a peer that is not online is appended to the log of
+# its conversation, one JSON object per line, and handed over in one batch
+# the next time the peer registers for that conversation. A conversation is
+# a rideID plus the two usernames, so each ride chat has its own file:
+#     {"seq": 7, "ride": "42", "from": "alice", "to": "bob", "at": 1700000000.0, "payload": {...}}
+#     {"delivered": 7, "to": "bob"}      every message to bob up to seq 7 was handed over
+# Files are only appended to while the server runs. Retention is bounded: a
+# message is kept for at most MAX_AGE seconds and a peer has at most
+# MAX_PENDING undelivered messages per conversation (the oldest go first).
+# Once delivered and expired lines outnumber the live ones the file is
+# rewritten with only the live messages, atomically through a temporary file;
+# a file with nothing left to deliver is removed. Conversations nobody comes
+# back to are cleaned up by compact_all, which p2p_server runs every
+# COMPACT_INTERVAL. Appends are flushed to the OS; pass fsync=True to also
+# survive power loss at the cost of a disk sync per message.
+#
+# The store is not thread-safe; the P2P server only uses it from its event loop.
+#
+#     python message_store.py stats
+#     python message_store.py compact
+
+STORE_DIR = os.environ.get("AUBUS_MESSAGE_DIR",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_messages"))
+MAX_AGE = 7 * 86400
+MAX_PENDING = 200
+COMPACT_SLACK = 64          # dead lines tolerated before a rewrite is considered
+
+
+def conversation_key(ride_id, user_a, user_b):
+    first, second = sorted((str(user_a), str(user_b)))
+    return ("" if ride_id is None else str(ride_id), first, second)
+
+
+class _Conversation:
+    __slots__ = ("path", "next_seq", "delivered", "live", "lines")
+
+    def __init__(self, path):
+        self.path = path
+        self.next_seq = 1
+        self.delivered = {}     # recipient -> highest delivered seq
+        self.live = {}          # recipient -> undelivered messages in the file
+        self.lines = 0
+
+
+class MessageStore:
+    def __init__(self, directory=STORE_DIR, max_age=MAX_AGE, max_pending=MAX_PENDING, fsync=False,
+                 clock=time.time):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self._clock = clock
+        self._conversations = {}    # file path -> _Conversation
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()[:16]
+        ride = re.sub(r"[^A-Za-z0-9_-]", "", key[0])[:32] or "none"
+        return os.path.join(self.directory, f"ride_{ride}_{digest}.jsonl")
+
+    def _read(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue        # a line cut short by a crash
+        except FileNotFoundError:
+            return
+
+    def _load(self, key):
+        return self._load_path(self._path(key))
+
+    def _load_path(self, path):
+        conversation = self._conversations.get(path)
+        if conversation is not None:
+            return conversation
+        conversation = _Conversation(path)
+        messages = []
+        for record in self._read(conversation.path):
+            conversation.lines += 1
+            if "delivered" in record:
+                to = record["to"]
+                conversation.delivered[to] = max(conversation.delivered.get(to, 0), record["delivered"])
+            else:
+                messages.append(record)
+                conversation.next_seq = max(conversation.next_seq, record["seq"] + 1)
+        for record in messages:
+            if record["seq"] > conversation.delivered.get(record["to"], 0):
+                conversation.live[record["to"]] = conversation.live.get(record["to"], 0) + 1
+        self._conversations[path] = conversation
+        return conversation
+
+    def _append(self, conversation, records):
+        with open(conversation.path, "a", encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        conversation.lines += len(records)
+
+    def append(self, ride_id, sender, recipient, payload, at=None):
+        """Keep a message for an offline recipient, return its sequence number"""
+        key = conversation_key(ride_id, sender, recipient)
+        conversation = self._load(key)
+        record = {"seq": conversation.next_seq, "ride": ride_id, "from": sender, "to": recipient,
+                  "at": self._clock() if at is None else at, "payload": payload}
+        self._append(conversation, [record])
+        conversation.next_seq += 1
+        conversation.live[recipient] = conversation.live.get(recipient, 0) + 1
+        if conversation.live[recipient] > self.max_pending + COMPACT_SLACK:
+            self._compact(conversation)
+        return record["seq"]
+
+    def pending(self, ride_id, recipient, sender):
+        """Undelivered messages from sender to recipient, oldest first"""
+        key = conversation_key(ride_id, sender, recipient)
+        conversation = self._load(key)
+        if not conversation.live.get(recipient):
+            return []
+        return self._live_messages(conversation, recipient)
+
+    def _live_messages(self, conversation, recipient):
+        cutoff = self._clock() - self.max_age
+        delivered = conversation.delivered.get(recipient, 0)
+        messages = [record for record in self._read(conversation.path)
+                    if record.get("to") == recipient and "seq" in record
+                    and record["seq"] > delivered and record["at"] > cutoff]
+        return messages[-self.max_pending:]
+
+    def mark_delivered(self, ride_id, recipient, sender, seq):
+        """Record that every message to recipient up to seq was handed over"""
+        key = conversation_key(ride_id, sender, recipient)
+        conversation = self._load(key)
+        if seq <= conversation.delivered.get(recipient, 0):
+            return
+        self._append(conversation, [{"delivered": seq, "to": recipient}])
+        conversation.delivered[recipient] = seq
+        conversation.live[recipient] = 0
+        live = sum(conversation.live.values())
+        if live == 0 or conversation.lines - live >= COMPACT_SLACK and conversation.lines > 2 * live:
+            self._compact(conversation)
+
+    def _compact(self, conversation):
+        # keep the live messages of both recipients, drop everything else
+        records = []
+        for recipient in list(conversation.live):
+            records.extend(self._live_messages(conversation, recipient))
+        records.sort(key=lambda record: record["seq"])
+        conversation.live = {}
+        for record in records:
+            conversation.live[record["to"]] = conversation.live.get(record["to"], 0) + 1
+        # delivery markers are kept so sequence numbers stay monotonic for the recipients
+        markers = [{"delivered": seq, "to": to} for to, seq in conversation.delivered.items()]
+        if not records:
+            try:
+                os.remove(conversation.path)
+            except FileNotFoundError:
+                pass
+            del self._conversations[conversation.path]
+            return
+        if len(markers) + len(records) == conversation.lines:
+            return      # nothing expired or delivered since the last rewrite
+        tmp = conversation.path + ".tmp"
+        with open(tmp, "w", encoding='utf-8') as f:
+            for record in markers + records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, conversation.path)
+        conversation.lines = len(markers) + len(records)
+
+    def conversation_files(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(".jsonl"))
+
+    def compact_file(self, name):
+        """Drop the expired and delivered messages of one conversation file"""
+        self._compact(self._load_path(os.path.join(self.directory, name)))
+
+    def live_messages(self, name):
+        """Undelivered, unexpired messages of one conversation file, oldest first"""
+        conversation = self._load_path(os.path.join(self.directory, name))
+        records = [record for recipient in list(conversation.live)
+                   for record in self._live_messages(conversation, recipient)]
+        return sorted(records, key=lambda record: record["seq"])
+
+    def discard_file(self, name):
+        """Forget a conversation whose messages were handed to another store"""
+        path = os.path.join(self.directory, name)
+        self._conversations.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def compact_all(self):
+        """Compact every conversation file now, return how many still hold messages"""
+        for name in self.conversation_files():
+            self.compact_file(name)
+        return len(self.conversation_files())
+
+    def stats(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".jsonl")]
+        pending = sum(min(live, self.max_pending) for path in files for live in self._load_path(path).live.values())
+        return {"directory": self.directory, "conversations": len(files), "pending": pending,
+                "bytes": sum(os.path.getsize(path) for path in files)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline chat message store")
+    parser.add_argument("command", choices=("stats", "compact"))
+    parser.add_argument("--dir", default=STORE_DIR)
+    args = parser.parse_args()
+    store = MessageStore(args.dir)
+    if args.command == "compact":
+        store.compact_all()
+    print(json.dumps(store.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
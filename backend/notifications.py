@@ -0,0 +1,216 @@
+import asyncio
+import queue
+import threading
+
+from framing import encode_message
+
+# Server push for gateway clients.
+#
+# A framed connection subscribes to topics: ["driver", userID] for the
+# requests sent to that driver's rides, ["rider", userID] for what happens to
+# that passenger's requests. Handlers publish after they commit, and every
+# subscribed connection receives an event frame
+#
+#     {"event": "ride_request", "topic": ["driver", 7], "data": {...}}
+#
+# Event frames carry no request_id, which is how clients tell them apart from
+# responses. Publishing never waits on a client: each subscribed connection
+# has a queue of up to PUSH_QUEUE events. The threaded gateway writes it from
+# a thread per subscribed connection; the async gateway's connections hand
+# out a LoopPusher that writes from a task on the event loop and waits for
+# the socket to drain. A connection is forgotten when it closes, a push to it
+# fails or its queue overflows because it stopped reading.
+
+TOPIC_KINDS = ("driver", "rider")
+PUSH_QUEUE = 64
+
+
+class _ThreadPusher:
+    """Writes the events queued for one blocking socket on a thread of its own"""
+
+    def __init__(self, hub, sink):
+        self.queue = queue.Queue(PUSH_QUEUE)
+        self.stopped = False
+        threading.Thread(target=self._run, args=(hub, sink), name="push", daemon=True).start()
+
+    def offer(self, payload):
+        """Queue an event, False when the connection is PUSH_QUEUE events behind"""
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self, hub, sink):
+        while not self.stopped:
+            payload = self.queue.get()
+            if payload is None:
+                return
+            try:
+                sink.send(payload)
+            except (OSError, RuntimeError):   # RuntimeError: the sink's event loop is gone
+                hub.unsubscribe(sink)
+                return
+            hub.count_delivered()
+
+    def stop(self):
+        self.stopped = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass        # the thread sees the flag after its current send
+
+
+class LoopPusher:
+    """Writes the events queued for one asyncio connection from a task on its event loop"""
+
+    def __init__(self, hub, sink, loop, channel):
+        self._loop = loop
+        self._channel = channel
+        self._queue = asyncio.Queue(PUSH_QUEUE)
+        self._lock = threading.Lock()
+        self._pending = 0       # offered and not yet taken by the task, never above PUSH_QUEUE
+        self._task = asyncio.run_coroutine_threadsafe(self._run(hub, sink), loop)
+
+    def offer(self, payload):
+        """Queue an event from any thread, False when the connection is PUSH_QUEUE events behind"""
+        with self._lock:
+            if self._pending >= PUSH_QUEUE:
+                return False
+            self._pending += 1
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, payload)
+        except RuntimeError:        # the event loop is gone
+            return False
+        return True
+
+    async def _run(self, hub, sink):
+        while True:
+            payload = await self._queue.get()
+            with self._lock:
+                self._pending -= 1
+            try:
+                self._channel.write(payload)
+                await self._channel.drain()
+            except (ConnectionError, RuntimeError):
+                hub.unsubscribe(sink)
+                return
+            hub.count_delivered()
+
+    def stop(self):
+        self._task.cancel()
+
+
+class NotificationHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}   # (kind, userID) -> set of sinks
+        self._topics = {}        # sink -> set of (kind, userID)
+        self._pushers = {}       # sink -> _Pusher
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, sink, topics):
+        with self._lock:
+            for topic in topics:
+                self._subscribers.setdefault(topic, set()).add(sink)
+                self._topics.setdefault(sink, set()).add(topic)
+            if sink in self._topics and sink not in self._pushers:
+                new_pusher = getattr(sink, "new_pusher", None)
+                self._pushers[sink] = new_pusher(self) if new_pusher else _ThreadPusher(self, sink)
+
+    def unsubscribe(self, sink, topics=None):
+        with self._lock:
+            owned = self._topics.get(sink, set())
+            for topic in list(owned if topics is None else topics):
+                owned.discard(topic)
+                sinks = self._subscribers.get(topic)
+                if sinks is not None:
+                    sinks.discard(sink)
+                    if not sinks:
+                        del self._subscribers[topic]
+            if not owned:
+                self._topics.pop(sink, None)
+                pusher = self._pushers.pop(sink, None)
+                if pusher is not None:
+                    pusher.stop()
+
+    def has_subscribers(self, kind, user_id):
+        return (kind, str(user_id)) in self._subscribers
+
+    def publish(self, kind, user_id, event, data):
+        """Queue an event for every connection subscribed to (kind, user_id), returns how many took it"""
+        topic = (kind, str(user_id))
+        with self._lock:
+            pushers = [(sink, self._pushers[sink]) for sink in self._subscribers.get(topic, ())]
+            self.published += 1
+        if not pushers:
+            return 0
+        payload = encode_message({"event": event, "topic": [kind, user_id], "data": data})
+        queued = 0
+        for sink, pusher in pushers:
+            if pusher.offer(payload):
+                queued += 1
+            else:
+                print(f"[PUSH] dropping a subscriber {PUSH_QUEUE} events behind")
+                self.unsubscribe(sink)
+        return queued
+
+    def count_delivered(self):
+        with self._lock:
+            self.delivered += 1
+
+    def stats(self):
+        with self._lock:
+            return {"topics": len(self._subscribers), "connections": len(self._topics),
+                    "published": self.published, "delivered": self.delivered}
+
+
+hub = NotificationHub()
+
+
+def parse_topics(data):
+    topics = []
+    for item in data.get("topics") or []:
+        if not (isinstance(item, (list, tuple)) and len(item) == 2 and item[0] in TOPIC_KINDS and item[1]):
+            return None
+        topics.append((item[0], str(item[1])))
+    return topics or None
+
+
+def handle_subscribe(data, client_socket):
+    """{"action": "subscribe", "topics": [["driver", userID], ["rider", userID]]}"""
+    if not getattr(client_socket, "framed", False):
+        return {"status": "400", "message": "Subscriptions need a framed connection (send hello first)"}
+    topics = parse_topics(data)
+    if topics is None:
+        return {"status": "400", "message": "topics must be a list of [driver|rider, userID]"}
+    hub.subscribe(client_socket, topics)
+    return {"status": "200", "message": f"Subscribed to {len(topics)} topics",
+            "topics": [list(topic) for topic in topics]}
+
+
+def handle_unsubscribe(data, client_socket):
+    topics = parse_topics(data) if data.get("topics") else None
+    hub.unsubscribe(client_socket, topics)
+    return {"status": "200", "message": "Unsubscribed"}
+
+
+def forget(client_socket):
+    """Drop every subscription of a closing connection"""
+    hub.unsubscribe(client_socket)
+
+
+def wants(kind, user_id):
+    """True when someone listens on this topic, so handlers can skip building the event"""
+    return hub.has_subscribers(kind, user_id)
+
+
+def publish(kind, user_id, event, data):
+    return hub.publish(kind, user_id, event, data)
+
+
+def publish_all(events):
+    """Publish (kind, userID, event, data) tuples built while a handler held its connection"""
+    for kind, user_id, event, data in events:
+        hub.publish(kind, user_id, event, data)
@@ -0,0 +1,295 @@
+import asyncio
+import bisect
+import hashlib
+import itertools
+
+from framing import FRAMING, FrameError, StreamChannel, encode_message
+
+# Several P2P management servers sharing the presence registry.
+#
+# Every node knows the whole cluster (--cluster n1=host:port,n2=host:port,...)
+# and places the UserIDs on a consistent hash ring, VNODES points per node, so
+# adding or removing a node only moves the users next to its points. A
+# conversation between two users lives on the node that owns the smaller of
+# the two UserIDs (its home): both registrations, the match between them,
+# relayed chat and the stored messages of that pair all happen on one node
+# and one event loop, exactly as with a single server.
+#
+# A peer may connect to any node. When the conversation's home is another
+# node, the node it connected to (its access node) answers heartbeats itself
+# and forwards everything else over a link to the home node, where the peer
+# is represented by a RemoteChannel; connection_request,
+# destination_now_online and the other events the home node pushes travel
+# back over the link and are written to the peer's socket. Links are normal
+# framed management connections that start with
+#     {"action": "node_hello", "node": <node id>}
+# and carry
+#     access -> home  {"op": "register" | "relay" | "unregister" | "ack", "sid": n, ...}
+#     home -> access  {"op": "registered" | "event" | "relayed" | "close", "sid": n, ...}
+#     any -> home     {"op": "store", "messages": [...]}      stored messages it no longer owns
+# where sid numbers the peer's session on the access node.
+#
+# Both directions are flow controlled per peer, so the relay backpressure of
+# a single server carries across nodes and one stalled peer never holds up
+# the others on the same link:
+#   - events: the access node queues them per peer and writes them out as
+#     fast as the peer reads, acking each batch it has written
+#     ({"op": "ack", "count": n}). The home node lets at most LINK_WINDOW
+#     unacked events per peer into the link; past that the receiver's outbox
+#     stops draining and fills, as if it were connected to the home node.
+#   - relay requests: the home node runs each peer's requests on its own task
+#     and acks them once handled ({"op": "relayed", "count": n}). The access
+#     node sends at most LINK_WINDOW unacked ones per peer and then stops
+#     reading that peer's socket, so a sender whose receiver is full is
+#     pushed back through TCP.
+# If a link drops, the home node unregisters its sessions and the access node
+# closes their peers' connections; they register again and land wherever the
+# ring says.
+
+VNODES = 64
+LINK_WINDOW = 64        # unacked events, and unhandled relay requests, per proxied peer
+
+
+def _point(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=VNODES):
+        self.nodes = sorted(nodes)
+        points = sorted((_point(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        i = bisect.bisect(self._hashes, _point(str(key)))
+        return self._owners[i % len(self._owners)]
+
+
+def parse_nodes(spec):
+    """"n1=host:port,n2=host:port" -> {"n1": ("host", port), ...}"""
+    nodes = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, address = item.strip().partition("=")
+        host, _, port = address.rpartition(":")
+        if not name or not host or not port:
+            raise ValueError(f"bad cluster node {item!r}, expected name=host:port")
+        nodes[name] = (host, int(port))
+    return nodes
+
+
+class RemoteChannel:
+    """Stands in, on the home node, for a peer connected to another node"""
+
+    def __init__(self, link, sid, framed):
+        self.link = link
+        self.sid = sid
+        self.framed = framed
+        self.credits = LINK_WINDOW
+        self._credit = asyncio.Event()
+        self._credit.set()
+
+    def write(self, payload):
+        self.credits -= 1
+        self.link.write(b'{"op":"event","sid":%d,"message":%s}' % (self.sid, payload))
+
+    async def drain(self):
+        """Wait for the link, then until the access node has written out enough of this peer's events"""
+        await self.link.drain()
+        while self.credits <= 0:
+            self._credit.clear()
+            await self._credit.wait()
+
+    def grant(self, count):
+        self.credits += count
+        self._credit.set()
+
+    async def send_json(self, obj):
+        # replies and notices are not held back by the peer's window, only by the link
+        self.write(encode_message(obj))
+        await self.link.drain()
+
+    def close(self):
+        self.link.write(encode_message({"op": "close", "sid": self.sid}))
+
+
+class ProxiedPeer:
+    """A peer on the access node whose conversation lives elsewhere: its events, queued and written in order"""
+
+    def __init__(self, link, sid, channel):
+        self.link = link
+        self.sid = sid
+        self.channel = channel
+        self.queue = asyncio.Queue()        # bounded by the home node's window
+        self.task = asyncio.create_task(self._run())
+        self.relay_credits = LINK_WINDOW
+        self._relay_credit = asyncio.Event()
+        self._closed = False
+
+    async def take_relay_credit(self):
+        while self.relay_credits <= 0 and not self._closed:
+            self._relay_credit.clear()
+            await self._relay_credit.wait()
+        if self._closed:
+            raise ConnectionError("node link closed")
+        self.relay_credits -= 1
+
+    def grant_relays(self, count):
+        self.relay_credits += count
+        self._relay_credit.set()
+
+    async def _run(self):
+        written = 0
+        try:
+            while True:
+                payload = await self.queue.get()
+                if payload is None:
+                    self.channel.close()
+                    return
+                self.channel.write(payload)
+                await self.channel.drain()
+                written += 1
+                if written >= LINK_WINDOW // 2 or self.queue.empty():
+                    self.link.ack(self.sid, written)
+                    written = 0
+        except (ConnectionError, RuntimeError):
+            pass
+
+    def close(self):
+        self._closed = True
+        self._relay_credit.set()
+        self.task.cancel()
+        self.channel.close()
+
+
+class NodeLink:
+    """Connection from an access node to a home node, carrying its peers' sessions"""
+
+    def __init__(self, node_id, host, port):
+        self.node_id = node_id
+        self.host = host
+        self.port = port
+        self.channel = None
+        self.clients = {}       # sid -> ProxiedPeer
+        self._pending = {}      # sid -> (Future, fields added to the reply)
+        self._reader = None
+
+    @property
+    def closed(self):
+        return self._reader is None or self._reader.done()
+
+    async def connect(self, local_node):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        channel = StreamChannel(reader, writer)
+        writer.write(encode_message({"action": "hello", "framing": FRAMING}))
+        reply = await channel.receive()
+        if not reply or reply.get("framing") != FRAMING:
+            writer.close()
+            raise ConnectionError(f"node {self.node_id} refused framing")
+        channel.framed = True
+        await channel.send_json({"action": "node_hello", "node": local_node})
+        self.channel = channel
+        self._reader = asyncio.create_task(self._read())
+
+    async def register(self, sid, client, fields, extra):
+        """Register a peer on the home node; its reply, with `extra` added, goes straight to the peer"""
+        future = asyncio.get_running_loop().create_future()
+        self.clients[sid] = ProxiedPeer(self, sid, client)
+        self._pending[sid] = (future, extra)
+        await self.channel.send_json(dict(fields, op="register", sid=sid))
+        return await future
+
+    async def relay(self, sid, payload):
+        """Forward a relay request, waiting while this peer has LINK_WINDOW of them unhandled"""
+        peer = self.clients.get(sid)
+        if peer is None:
+            raise ConnectionError("node link closed")
+        await peer.take_relay_credit()
+        await self.channel.send_json({"op": "relay", "sid": sid, "payload": payload})
+
+    def ack(self, sid, count):
+        if not self.closed:
+            self.channel.write(encode_message({"op": "ack", "sid": sid, "count": count}))
+
+    def unregister(self, sid):
+        peer = self.clients.pop(sid, None)
+        if peer is not None:
+            peer._closed = True
+            peer.task.cancel()
+        self._pending.pop(sid, None)
+        if not self.closed:
+            self.channel.write(encode_message({"op": "unregister", "sid": sid}))
+
+    async def _read(self):
+        try:
+            while True:
+                message = await self.channel.receive()
+                if message is None:
+                    break
+                sid = message.get("sid")
+                peer = self.clients.get(sid)
+                if message.get("op") == "registered":
+                    future, extra = self._pending.pop(sid, (None, None))
+                    response = dict(message["response"], **(extra or {}))
+                    # queued first, so nothing the home node pushes next can overtake it
+                    if peer is not None:
+                        peer.queue.put_nowait(encode_message(response))
+                    if future is not None and not future.done():
+                        future.set_result(response)
+                elif peer is None:
+                    continue
+                elif message.get("op") == "event":
+                    peer.queue.put_nowait(encode_message(message["message"]))
+                elif message.get("op") == "relayed":
+                    peer.grant_relays(int(message.get("count", 0)))
+                elif message.get("op") == "close":
+                    peer.queue.put_nowait(None)
+        except (ConnectionError, FrameError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            print(f"[CLUSTER] link to {self.node_id} closed")
+            for future, _ in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"node {self.node_id} went away"))
+            self._pending.clear()
+            for peer in self.clients.values():
+                peer.close()
+            self.clients.clear()
+            self.channel.writer.close()
+
+
+class Cluster:
+    def __init__(self, node_id, nodes, vnodes=VNODES):
+        if node_id not in nodes:
+            raise ValueError(f"node {node_id!r} is not in the cluster {sorted(nodes)}")
+        self.node_id = node_id
+        self.nodes = nodes
+        self.ring = HashRing(nodes, vnodes)
+        self._links = {}
+        self._connecting = {}
+        self._sids = itertools.count(1)
+
+    def home(self, user, destination):
+        """Node that holds the conversation between the two users"""
+        return self.ring.node_for(min(str(user), str(destination)))
+
+    def new_sid(self):
+        return next(self._sids)
+
+    async def link(self, node):
+        """The open link to `node`, connecting (once, however many callers ask) if needed"""
+        link = self._links.get(node)
+        if link is not None and not link.closed:
+            return link
+        lock = self._connecting.setdefault(node, asyncio.Lock())
+        async with lock:
+            link = self._links.get(node)
+            if link is None or link.closed:
+                link = NodeLink(node, *self.nodes[node])
+                await link.connect(self.node_id)
+                self._links[node] = link
+                print(f"[CLUSTER] {self.node_id} linked to {node}")
+        return link
+
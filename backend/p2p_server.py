@@ -1,133 +1,506 @@
-import socket
-import threading
+import argparse
+import asyncio
 import json
-import traceback
+import os
+import socket
+
+from framing import FrameError, StreamChannel, encode_message, is_hello
+from message_store import STORE_DIR, MessageStore
+from p2p_cluster import LINK_WINDOW, Cluster, RemoteChannel, parse_nodes
+
+# Management server for P2P chat: peers register who they are, the port their
+# chat listener is on and who they want to talk to, and are told the other
+# side's address as soon as both are online.
+#
+# All peers are served by one asyncio event loop; a registration that is just
+# waiting costs a socket and a coroutine, not a thread. The wire format is the
+# gateway's (see framing.py): bare JSON, or length-prefixed frames after a
+# hello. A peer that registers with "heartbeat": true must send
+# {"type": "ping"} at least every HEARTBEAT_INTERVAL seconds (the server
+# answers {"type": "pong"}); one that stays silent for HEARTBEAT_TIMEOUT seconds
+# is evicted from the registry. Older peers without heartbeats are only
+# dropped when TCP reports the connection dead (keepalive is switched on).
+#
+# Peers that cannot open a direct connection to each other can chat through
+# the server instead: a framed peer sends {"type": "relay", "payload": ...} and
+# its partner receives {"type": "relay", "from": user, "payload": ...}. Each
+# receiving connection has a bounded outbox written by its own task; when it
+# is full the sender's connection is not read until there is room again, so a
+# slow reader pushes back on its sender through TCP instead of growing the
+# server's memory.
+#
+# A chat message relayed while the partner is offline is kept in the message
+# store (message_store.py, one log per rideID and pair of users) and the
+# sender is told {"type": "relay_stored"}. When the partner next registers
+# for the conversation (with the same "RideID") it receives everything kept
+# for it in a single {"type": "stored_messages", "messages": [...]}. Every
+# COMPACT_INTERVAL the store is swept for messages that expired unread.
+#
+# Several servers can share the work, see p2p_cluster.py. Each node keeps
+# the stored messages of the conversations it is home to; when the cluster
+# changes, a node hands the ones it no longer owns to their new home over a
+# node link ({"op": "store", "messages": [...]}) when it starts, retrying
+# every HANDOVER_RETRY seconds while that node is unreachable.
+#
+#     python p2p_server.py --port 10000 --node-id n1 --cluster n1=127.0.0.1:10000,n2=127.0.0.1:10001
+#     python p2p_server.py --port 10001 --node-id n2 --cluster n1=127.0.0.1:10000,n2=127.0.0.1:10001
 
 HOST = "0.0.0.0"
 PORT = 10000
+HEARTBEAT_INTERVAL = 15.0
+HEARTBEAT_TIMEOUT = 45.0
+REGISTER_TIMEOUT = 8.0
+RELAY_QUEUE = 64                 # messages waiting for one receiving connection
+RELAY_SEND_TIMEOUT = 10.0        # give up on a receiver that stays full this long
+MAX_RELAY_BYTES = 64 * 1024
+COMPACT_INTERVAL = 3600.0        # seconds between sweeps of the message store
+HANDOVER_RETRY = 10.0            # seconds between attempts to reach a home node for its stored messages
 
-clients_lock = threading.Lock()
-clients = {}       
-client_info = {}
-waiting = {}      
 
-def send_json_raw(sock, obj):
-    try:
-        sock.sendall(json.dumps(obj).encode())
+class Session:
+    """One registration: `user` listening on ip:port for a chat with `destination`"""
+    __slots__ = ("user", "destination", "channel", "ip", "port", "ride_id", "outbox")
+
+    def __init__(self, user, destination, channel, ip, port, ride_id=None):
+        self.user = user
+        self.destination = destination
+        self.channel = channel
+        self.ip = ip
+        self.port = port
+        self.ride_id = ride_id
+        self.outbox = None      # created when the first relayed message arrives
+
+
+class Outbox:
+    """Bounded queue of relayed messages for one connection, written out by its own task"""
+
+    def __init__(self, channel, size=RELAY_QUEUE):
+        self.channel = channel
+        self.queue = asyncio.Queue(size)
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                payload = await self.queue.get()
+                self.channel.write(payload)
+                await self.channel.drain()
+        except (ConnectionError, RuntimeError):
+            pass
+
+    async def put(self, payload):
+        """Queue a message, waiting while the queue is full; TimeoutError after RELAY_SEND_TIMEOUT"""
+        await asyncio.wait_for(self.queue.put(payload), RELAY_SEND_TIMEOUT)
+
+    def close(self):
+        self.task.cancel()
+
+
+class Registry:
+    """
+    Registrations keyed by (user, destination), so a user can wait for several
+    peers at once (one chat window each). Two sessions match when each one's
+    destination is the other's user. Besides the main map it keeps
+        waiting_for: destination -> {user: Session} of sessions still unmatched
+        by_user:     user -> {destination: Session}, what each user waits on
+    so register, match and unregister are a few dict operations each, however
+    many peers are waiting. It is only touched from the event loop thread,
+    which owns it; no locks are needed.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.waiting_for = {}
+        self.by_user = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, user, destination):
+        return self.sessions.get((user, destination))
+
+    def partner(self, session):
+        """The session registered the other way round, if it is online"""
+        return self.sessions.get((session.destination, session.user))
+
+    def waiters(self, destination):
+        """Users waiting for `destination`"""
+        return list(self.waiting_for.get(destination, ()))
+
+    def destinations(self, user):
+        """Peers `user` has registered for"""
+        return list(self.by_user.get(user, ()))
+
+    def _unwait(self, session):
+        waiters = self.waiting_for.get(session.destination)
+        if waiters is not None and waiters.get(session.user) is session:
+            del waiters[session.user]
+            if not waiters:
+                del self.waiting_for[session.destination]
+
+    def register(self, session):
+        """Add the session, return (the session it replaced, the partner session or None)"""
+        key = (session.user, session.destination)
+        replaced = self.sessions.get(key)
+        if replaced is not None:
+            self._unwait(replaced)
+        self.sessions[key] = session
+        self.by_user.setdefault(session.user, {})[session.destination] = session
+        partner = self.sessions.get((session.destination, session.user))
+        if partner is None:
+            self.waiting_for.setdefault(session.destination, {})[session.user] = session
+        else:
+            self._unwait(partner)
+        return replaced, partner
+
+    def unregister(self, session):
+        """Remove the session unless a newer one for the same pair replaced it; False if it was not there"""
+        key = (session.user, session.destination)
+        if self.sessions.get(key) is not session:
+            return False
+        del self.sessions[key]
+        destinations = self.by_user[session.user]
+        del destinations[session.destination]
+        if not destinations:
+            del self.by_user[session.user]
+        self._unwait(session)
+        # the partner, if any, is alone again
+        partner = self.sessions.get((session.destination, session.user))
+        if partner is not None:
+            self.waiting_for.setdefault(partner.destination, {})[partner.user] = partner
         return True
-    except Exception:
-        return False
 
-def handle_management_connection(conn, addr):
-    username = None
+
+registry = Registry()
+store = None        # MessageStore for offline peers, set up by serve()
+cluster = None      # Cluster when this server is one of several nodes
+
+
+def push(channel, obj):
+    """Queue a message to another peer without waiting on its socket"""
     try:
-        conn.settimeout(8.0)
-        raw = conn.recv(8192)
-        if not raw:
-            return
-        data = json.loads(raw.decode())
-        username = data.get("UserID")
-        p2p_port = int(data.get("P2P_Port"))
-        destination = data.get("DestinationID")
+        channel.write(encode_message(obj))
+    except (ConnectionError, RuntimeError):
+        pass
+
+
+def register(session):
+    """Record the session and introduce it to its partner; returns the reply for the new peer"""
+    replaced, partner = registry.register(session)
+    if replaced is not None and replaced.channel is not session.channel:
+        replaced.channel.close()      # the same chat registering again: the old connection is stale
+    print(f"[REGISTER] {session.user} @ {session.ip}:{session.port} for {session.destination}")
+    if partner is None:
+        return {"status": "200", "message": "registered_waiting", "destination_name": session.destination}
+
+    push(partner.channel, {
+        "status": "200",
+        "message": "destination_now_online",
+        "destination_name": session.user,
+        "destination_ip": session.ip,
+        "destination_port": session.port
+    })
+    push(partner.channel, {
+        "type": "connection_request",
+        "from": session.user,
+        "source_name": session.user,
+        "source_ip": session.ip,
+        "source_port": session.port
+    })
+    return {
+        "status": "200",
+        "message": "destination_online",
+        "destination_name": partner.user,
+        "destination_ip": partner.ip,
+        "destination_port": partner.port
+    }
+
 
-        if not username or p2p_port is None or destination is None:
-            send_json_raw(conn, {"status":"400", "message":"UserID, P2P_Port, DestinationID required"})
+def unregister(session):
+    if session.outbox is not None:
+        session.outbox.close()
+    if registry.unregister(session):
+        print(f"[UNREGISTER] {session.user} for {session.destination}")
+        partner = registry.partner(session)
+        if partner is not None:
+            push(partner.channel, {"type": "destination_offline", "destination_name": session.user})
+
+
+async def relay(session, payload):
+    """Forward a chat payload to the session's partner, or tell the sender why not"""
+    partner = registry.partner(session)
+    data = encode_message({"type": "relay", "from": session.user, "payload": payload})
+    if not session.channel.framed:
+        error = "relay needs a framed connection"
+    elif len(data) > MAX_RELAY_BYTES:
+        error = f"message larger than {MAX_RELAY_BYTES} bytes"
+    elif partner is None:
+        if store is not None and isinstance(payload, dict) and payload.get("type") == "chat":
+            seq = store.append(session.ride_id, session.user, session.destination, payload)
+            await session.channel.send_json({"type": "relay_stored", "seq": seq,
+                                             "destination_name": session.destination})
             return
+        error = "destination_offline"
+    elif not partner.channel.framed:
+        error = "destination cannot receive relayed messages"
+    else:
+        if partner.outbox is None:
+            partner.outbox = Outbox(partner.channel)
+        try:
+            await partner.outbox.put(data)
+            return
+        except asyncio.TimeoutError:
+            error = "destination_busy"
+    await session.channel.send_json({"type": "relay_error", "message": error})
 
-        with clients_lock:
-            clients[username] = conn
-            client_info[username] = {"ip": addr[0], "port": p2p_port}
-
-        print(f"[REGISTER] {username} @ {addr[0]}:{p2p_port}")
-
-        with clients_lock:
-            waiting_list = waiting.pop(username, [])
-
-        for source_name, source_conn in waiting_list:
-            try:
-                payload = {
-                    "status": "200",
-                    "message": "destination_now_online",
-                    "destination_name": username,
-                    "destination_ip": addr[0],
-                    "destination_port": p2p_port
-                }
-                send_json_raw(source_conn, payload)
-            except Exception:
-                pass
-
-        with clients_lock:
-            dest_online = destination in clients
-            dest_info = client_info.get(destination)
-
-        if dest_online and dest_info:
-            resp = {
-                "status": "200",
-                "message": "destination_online",
-                "destination_name": destination,
-                "destination_ip": dest_info["ip"],
-                "destination_port": dest_info["port"]
-            }
-            send_json_raw(conn, resp)
-
-            try:
-                notify = {
-                    "type": "connection_request",
-                    "from": username,
-                    "source_name": username,
-                    "source_ip": addr[0],
-                    "source_port": p2p_port
-                }
-                dest_conn = clients.get(destination)
-                if dest_conn:
-                    send_json_raw(dest_conn, notify)
-            except Exception:
-                pass
-        else:
-            with clients_lock:
-                waiting.setdefault(destination, []).append( (username, conn) )
-            send_json_raw(conn, {"status":"200", "message":"registered_waiting", "destination_name": destination})
 
-        conn.settimeout(None)
+async def deliver_stored(session):
+    """Hand a framed peer everything kept for it in this conversation, in one message"""
+    if store is None or not session.channel.framed:
+        return
+    messages = store.pending(session.ride_id, session.user, session.destination)
+    if not messages:
+        return
+    await session.channel.send_json({
+        "type": "stored_messages",
+        "from": session.destination,
+        "messages": [{"payload": record["payload"], "at": record["at"]} for record in messages]
+    })
+    store.mark_delivered(session.ride_id, session.user, session.destination, messages[-1]["seq"])
+
+
+async def read_messages(channel, timeout, relay_to):
+    """Answer heartbeats and pass relay requests on until the peer leaves or goes silent"""
+    while True:
+        try:
+            message = await asyncio.wait_for(channel.receive(), timeout)
+        except asyncio.TimeoutError:
+            return "no heartbeat"
+        if message is None:
+            return None
+        if not isinstance(message, dict):
+            continue
+        if message.get("type") == "ping":
+            await channel.send_json({"type": "pong"})
+        elif message.get("type") == "relay":
+            await relay_to(message.get("payload"))
+
+
+async def serve_linked_session(channel, sid, session, inbox):
+    """Handle one proxied peer's relay requests in order, acking them to its access node"""
+    handled = 0
+    try:
+        while True:
+            payload = await inbox.get()
+            if payload is None:
+                break
+            await relay(session, payload)
+            handled += 1
+            if handled >= LINK_WINDOW // 2 or inbox.empty():
+                channel.write(encode_message({"op": "relayed", "sid": sid, "count": handled}))
+                handled = 0
+    except (ConnectionError, RuntimeError):
+        pass
+    finally:
+        unregister(session)
+
+
+async def handle_node_link(channel, node):
+    """Serve the sessions another node forwards to this one"""
+    print(f"[CLUSTER] node {node} linked")
+    sessions = {}       # sid -> (Session, queue of its relay requests, task handling them)
+    try:
         while True:
-            try:
-                chunk = conn.recv(1024)
-                if not chunk:
-                    break
-            except Exception:
+            message = await channel.receive()
+            if message is None:
                 break
+            op = message.get("op")
+            sid = message.get("sid")
+            if op == "store":
+                if store is not None:
+                    adopt_stored(message.get("messages") or [])
+            elif op == "register":
+                session = Session(message["user"], message["destination"],
+                                  RemoteChannel(channel, sid, message.get("framed", False)),
+                                  message["ip"], message["port"], message.get("ride_id"))
+                await channel.send_json({"op": "registered", "sid": sid, "response": register(session)})
+                await deliver_stored(session)
+                inbox = asyncio.Queue()         # bounded by the access node's window
+                sessions[sid] = (session, inbox,
+                                 asyncio.create_task(serve_linked_session(channel, sid, session, inbox)))
+            elif sid not in sessions:
+                continue
+            elif op == "relay":
+                sessions[sid][1].put_nowait(message.get("payload"))
+            elif op == "ack":
+                sessions[sid][0].channel.grant(int(message.get("count", 0)))
+            elif op == "unregister":
+                sessions.pop(sid)[1].put_nowait(None)     # after the relays already queued
+    finally:
+        print(f"[CLUSTER] node {node} link closed")
+        for session, _, task in sessions.values():
+            task.cancel()
+            unregister(session)
 
+
+async def handle_management_connection(reader, writer, heartbeat_timeout=None):
+    heartbeat_timeout = heartbeat_timeout or HEARTBEAT_TIMEOUT
+    channel = StreamChannel(reader, writer)
+    sock = writer.get_extra_info("socket")
+    if sock is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    addr = writer.get_extra_info("peername")
+    session = None
+    link = sid = None
+    try:
+        data = await asyncio.wait_for(channel.receive(), REGISTER_TIMEOUT)
+        if is_hello(data):
+            await channel.negotiate(data)
+            data = await asyncio.wait_for(channel.receive(), REGISTER_TIMEOUT)
+        if not isinstance(data, dict):
+            return
+        if data.get("action") == "node_hello" and channel.framed and cluster is not None:
+            await handle_node_link(channel, data.get("node"))
+            return
+        try:
+            p2p_port = int(data.get("P2P_Port"))
+        except (TypeError, ValueError):
+            p2p_port = None
+        destination = data.get("DestinationID")
+        if not data.get("UserID") or p2p_port is None or destination is None:
+            await channel.send_json({"status": "400", "message": "UserID, P2P_Port, DestinationID required"})
+            return
+        user = data["UserID"]
+        heartbeat = bool(data.get("heartbeat"))
+        extra = {}
+        if heartbeat:
+            extra = {"heartbeat_interval": min(HEARTBEAT_INTERVAL, heartbeat_timeout / 3),
+                     "heartbeat_timeout": heartbeat_timeout}
+
+        home = cluster.home(user, destination) if cluster is not None else None
+        if home is None or home == cluster.node_id:
+            session = Session(user, destination, channel, addr[0], p2p_port, data.get("RideID"))
+            await channel.send_json(dict(register(session), **extra))
+            await deliver_stored(session)
+            relay_to = lambda payload: relay(session, payload)
+        else:
+            # the conversation lives on another node: forward this peer's session there
+            link = await cluster.link(home)
+            sid = cluster.new_sid()
+            await link.register(sid, channel, {
+                "user": user, "destination": destination, "ip": addr[0], "port": p2p_port,
+                "ride_id": data.get("RideID"), "framed": channel.framed}, extra)
+            relay_to = lambda payload: link.relay(sid, payload)
+
+        reason = await read_messages(channel, heartbeat_timeout if heartbeat else None, relay_to)
+        if reason:
+            print(f"[EVICT] {user}: {reason} for {heartbeat_timeout:.0f} s")
+
+    except (asyncio.TimeoutError, ConnectionError, FrameError, json.JSONDecodeError, UnicodeDecodeError):
+        pass
     except Exception as e:
         print("[MANAGE ERROR]", e)
-        traceback.print_exc()
     finally:
-        if username:
-            print(f"[UNREGISTER] {username}")
-            with clients_lock:
-                clients.pop(username, None)
-                client_info.pop(username, None)
-                for dest, lst in list(waiting.items()):
-                    waiting[dest] = [pair for pair in lst if pair[0] != username]
-                    if not waiting[dest]:
-                        waiting.pop(dest, None)
+        if session is not None:
+            unregister(session)
+        if link is not None:
+            link.unregister(sid)
+        writer.close()
+
+
+async def hand_over_stored(retry=HANDOVER_RETRY):
+    """Send the stored conversations this node is not home to to the node that is, until none are left"""
+    while await _hand_over_once():
+        await asyncio.sleep(retry)
+
+
+async def _hand_over_once():
+    # returns how many conversations could not be handed over yet
+    moved = left = 0
+    for name in store.conversation_files():
+        messages = store.live_messages(name)
+        if not messages:
+            continue
+        home = cluster.home(messages[0]["from"], messages[0]["to"])
+        if home == cluster.node_id:
+            continue
         try:
-            conn.close()
-        except:
-            pass
+            link = await cluster.link(home)
+            await link.channel.send_json({"op": "store", "messages": messages})
+        except (OSError, ConnectionError) as e:
+            print(f"[STORE] cannot hand {name} to node {home} yet: {e}")
+            left += 1
+            continue
+        store.discard_file(name)
+        moved += 1
+    if moved:
+        print(f"[STORE] handed {moved} conversations to their home nodes")
+    return left
+
 
-def start_server():
-    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    srv.bind((HOST, PORT))
-    srv.listen(100)
-    print(f"[MANAGEMENT] listening on {HOST}:{PORT}")
+def adopt_stored(messages):
+    """Keep the messages another node handed over, with their original times"""
+    for record in messages:
+        store.append(record.get("ride"), record["from"], record["to"], record["payload"], at=record["at"])
+
+
+async def compact_store(interval=COMPACT_INTERVAL):
+    """Sweep the message store now and then, one file at a time so peers keep being served"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            for name in store.conversation_files():
+                store.compact_file(name)
+                await asyncio.sleep(0)
+            print(f"[STORE] compacted, {len(store.conversation_files())} conversations hold messages")
+        except OSError as e:
+            print(f"[STORE] sweep failed: {e}")
+
+
+async def serve(host=HOST, port=PORT, heartbeat_timeout=None, ready=None, message_dir=STORE_DIR,
+                node_id=None, nodes=None):
+    global store, cluster
+    if nodes:
+        cluster = Cluster(node_id, nodes)
+        if message_dir:
+            message_dir = os.path.join(message_dir, node_id)     # nodes may share a folder
+    store = MessageStore(message_dir) if message_dir else None
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_management_connection(reader, writer, heartbeat_timeout),
+        host, port, backlog=4096, reuse_address=True)
+    print(f"[MANAGEMENT] listening on {host}:{port}" + (f" as node {node_id}" if cluster else ""))
+    tasks = []
+    if store is not None:
+        tasks.append(asyncio.create_task(compact_store()))
+        if cluster is not None:
+            tasks.append(asyncio.create_task(hand_over_stored()))
+    if ready is not None:
+        ready.set()
     try:
-        while True:
-            conn, addr = srv.accept()
-            t = threading.Thread(target=handle_management_connection, args=(conn, addr), daemon=True)
-            t.start()
+        async with server:
+            await server.serve_forever()
     finally:
-        srv.close()
+        for task in tasks:
+            task.cancel()
+
+
+def start_server(host=HOST, port=PORT, heartbeat_timeout=None, message_dir=STORE_DIR, node_id=None, nodes=None):
+    asyncio.run(serve(host, port, heartbeat_timeout, message_dir=message_dir, node_id=node_id, nodes=nodes))
+
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="AUBus P2P management server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT,
+                        help="evict heartbeat peers silent for this many seconds")
+    parser.add_argument("--message-dir", default=STORE_DIR,
+                        help="where messages for offline peers are kept; empty to not keep them")
+    parser.add_argument("--node-id", help="this server's name in --cluster")
+    parser.add_argument("--cluster", default="",
+                        help="every node of the cluster as name=host:port,name=host:port,...")
+    args = parser.parse_args()
+    nodes = parse_nodes(args.cluster) if args.cluster else None
+    if nodes and args.node_id not in nodes:
+        parser.error("--node-id must name one of the --cluster nodes")
+    start_server(args.host, args.port, args.heartbeat_timeout, args.message_dir, args.node_id, nodes)
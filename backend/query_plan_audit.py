@@ -0,0 +1,190 @@
+"""
+Query-plan audit for the backend.
+
+Collects every SQL statement passed to .execute() in the backend modules,
+runs EXPLAIN QUERY PLAN on it against a scratch database built from
+db_schema, and exits with status 1 if a hot query scans a whole table.
+
+    python query_plan_audit.py                # empty scratch database
+    python query_plan_audit.py --rides 1000000  # synthetic data + ANALYZE
+    python query_plan_audit.py --db aubus.db    # plans on a copy of a real database
+"""
+import argparse
+import ast
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import db_schema
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SKIP_MODULES = {"query_plan_audit.py", "benchmarks.py", "db_schema.py"}
+
+# Statements that are allowed to scan: (module, function) pairs that are
+# administrative or run once, not per request.
+COLD_QUERIES = {("id_generator.py", "acquire"), ("ride_index.py", "load")}
+
+SCAN = re.compile(r"^SCAN (?:TABLE )?(\S+)")
+# a virtual-table scan with constraints (e.g. an R*Tree box query) is an index lookup
+VIRTUAL_LOOKUP = re.compile(r"^SCAN (?:TABLE )?\S+ VIRTUAL TABLE INDEX \d+:\S+")
+
+
+def _sql_text(node, strings):
+    """The SQL a string expression builds, or None when it cannot be told statically"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Name):
+        return strings.get(node.id)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = _sql_text(node.left, strings), _sql_text(node.right, strings)
+        return None if left is None or right is None else left + right
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mod):
+        # "... IN (%s)" % ",".join("?" * n): one placeholder plans like n of them
+        left = _sql_text(node.left, strings)
+        return None if left is None else left.replace("%s", "?")
+    return None
+
+
+def _string_assignments(nodes, strings):
+    for node in nodes:
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1
+                and isinstance(node.targets[0], ast.Name)):
+            sql = _sql_text(node.value, strings)
+            if sql is not None:
+                strings[node.targets[0].id] = sql
+    return strings
+
+
+def _is_pragma(node):
+    if isinstance(node, ast.JoinedStr) and node.values and isinstance(node.values[0], ast.Constant):
+        return str(node.values[0].value).lstrip().upper().startswith("PRAGMA")
+    return False
+
+
+def collect_queries(directory=BACKEND_DIR):
+    """
+    Yield (module, function, line, sql) for every query given to execute(): string
+    literals, module or local string names, and + / %s concatenations of them.
+    sql is None for a statement built some other way, which cannot be audited.
+    """
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".py") or name in SKIP_MODULES:
+            continue
+        tree = ast.parse(open(os.path.join(directory, name), encoding="utf-8").read())
+        module_strings = _string_assignments(tree.body, {})
+        for func in ast.walk(tree):
+            if not isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+            strings = _string_assignments(ast.walk(func), dict(module_strings))
+            for node in ast.walk(func):
+                if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                        and node.func.attr in ("execute", "executemany") and node.args):
+                    continue
+                sql = _sql_text(node.args[0], strings)
+                if sql is None:
+                    if not _is_pragma(node.args[0]):
+                        yield name, func.name, node.lineno, None
+                    continue
+                if sql.lstrip().split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+                    yield name, func.name, node.lineno, sql
+
+
+def populate(conn, rides):
+    """Fill the scratch database with synthetic rows proportional to `rides`"""
+    rng = random.Random(351)
+    users = max(10, rides // 10)
+    zones = max(10, rides // 5)
+    conn.executemany('INSERT INTO "user" (userID, username, email, password, aubID, isDriver) VALUES (?, ?, ?, ?, ?, ?)',
+                     ((i, f"user{i}", f"u{i}@mail.aub.edu", "pw", 200000000 + i, i % 3 == 0) for i in range(users)))
+    conn.executemany('INSERT INTO "Zone" (zoneID, zoneX, zoneY, zoneName, UserID) VALUES (?, ?, ?, ?, ?)',
+                     ((f"zone{i}", 33.85 + rng.random() * 0.1, 35.45 + rng.random() * 0.1, f"Zone {i}", i % users)
+                      for i in range(zones)))
+    conn.executemany('INSERT INTO "Car" (carId, cartype, carPlate, capacity, ownerID) VALUES (?, ?, ?, ?, ?)',
+                     ((f"car{i}", "sedan", f"P{i}", 4, i) for i in range(0, users, 3)))
+    conn.executemany('INSERT INTO schedule (scheduleID, userID) VALUES (?, ?)',
+                     ((str(i), i) for i in range(users)))
+
+    def ride_rows():
+        for i in range(rides):
+            owner = rng.randrange(0, users, 3)
+            start = rng.randrange(6 * 60, 20 * 60)
+            yield (str(i), owner, f"car{owner}", f"zone{rng.randrange(zones)}", f"zone{rng.randrange(zones)}",
+                   start, start + rng.randrange(20, 90), str(owner))
+    conn.executemany('INSERT INTO Ride (rideID, ownerID, carId, sourceID, destinationID, startTime, endTime, scheduleID) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', ride_rows())
+    conn.executemany('INSERT INTO Request (requestID, riderID, rideID, status, requestTime) VALUES (?, ?, ?, ?, ?)',
+                     ((f"REQ{i}", rng.randrange(users), str(rng.randrange(rides)), rng.choice(("pending", "accepted")), i)
+                      for i in range(rides // 2)))
+    conn.executemany('INSERT OR IGNORE INTO Rider (userID, rideID) VALUES (?, ?)',
+                     ((rng.randrange(users), str(rng.randrange(rides))) for _ in range(rides // 4)))
+    conn.executemany('INSERT INTO Rating (ratingID, raterID, rateeID, rideID, score) VALUES (?, ?, ?, ?, ?)',
+                     ((f"rating{i}", rng.randrange(users), rng.randrange(users), str(rng.randrange(rides)), rng.randint(0, 5))
+                      for i in range(rides // 4)))
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.commit()
+
+
+def explain(conn, sql):
+    params = (None,) * sql.count("?")
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def audit(conn, verbose=False):
+    failures = []
+    for module, func, line, sql in collect_queries():
+        if sql is None:
+            print(f"{module}:{line} {func}() [UNAUDITED] the statement is built at run time")
+            failures.append((module, func, line, ["unknown SQL"]))
+            continue
+        plan = explain(conn, sql)
+        scans = [SCAN.match(step).group(1) for step in plan
+                 if SCAN.match(step) and not VIRTUAL_LOOKUP.match(step)]
+        cold = (module, func) in COLD_QUERIES
+        if verbose or (scans and not cold):
+            status = "FULL SCAN" if scans and not cold else "ok"
+            print(f"{module}:{line} {func}() [{status}]")
+            print("    " + " ".join(sql.split()))
+            for step in plan:
+                print("    -> " + step)
+        if scans and not cold:
+            failures.append((module, func, line, scans))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EXPLAIN QUERY PLAN audit of the backend queries")
+    parser.add_argument("--rides", type=int, default=0, help="populate the scratch database with this many rides")
+    parser.add_argument("--db", default=None, help="audit a copy of an existing database instead")
+    parser.add_argument("--verbose", action="store_true", help="print every plan, not only failing ones")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="aubus_plans_")
+    path = os.path.join(scratch, "aubus.db")
+    if args.db:
+        shutil.copy(args.db, path)
+    db_schema.create_schema(path)
+    conn = sqlite3.connect(path)
+    try:
+        if args.rides:
+            print(f"populating {args.rides} rides...")
+            populate(conn, args.rides)
+        failures = audit(conn, args.verbose)
+    finally:
+        conn.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if failures:
+        print(f"\n{len(failures)} hot queries scan a full table:")
+        for module, func, line, scans in failures:
+            print(f"  {module}:{line} {func}() scans {', '.join(scans)}")
+        sys.exit(1)
+    print("all hot queries use an index")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Vectorized ranking of candidate rides.
+#
+# Handlers hand over the candidates as parallel arrays (pickup lat/lng and
+# departure minute). One pass computes the great-circle distance from the
+# passenger, the walking time to the pickup point and the gap between the
+# requested and the actual departure; rides are ordered by the total minutes
+# the passenger loses (walk + gap). Missing coordinates are NaN: such rides
+# are kept, have no distance, and rank after every ride that has one.
+#
+# Given the rides' destinations too, the driver picks the passenger up on the
+# way instead: the detour is the extra distance of source -> passenger ->
+# destination over source -> destination, converted to minutes at
+# DRIVE_SPEED_KMH with ROAD_CIRCUITY for streets not being straight lines.
+# Rides are then filtered by a maximum detour and ordered by detour + gap.
+
+EARTH_RADIUS_KM = 6371.0088
+WALK_SPEED_KMH = 5.0
+DRIVE_SPEED_KMH = 30.0
+ROAD_CIRCUITY = 1.3
+UNLOCATED_PENALTY = 1e9
+
+Ranking = namedtuple("Ranking", "order distance_km walk_minutes gap_minutes detour_km detour_minutes",
+                     defaults=(None, None))
+
+
+def great_circle_km(lat, lng, lats, lngs):
+    """Haversine distance in km from (lat, lng) to every (lats[i], lngs[i])"""
+    lat1 = np.radians(lat)
+    lat2 = np.radians(np.asarray(lats, dtype=float))
+    dlat = lat2 - lat1
+    dlng = np.radians(np.asarray(lngs, dtype=float) - lng)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def detour_km(lat, lng, src_lats, src_lngs, dst_lats, dst_lngs):
+    """Extra great-circle km of source -> (lat, lng) -> destination over source -> destination (broadcasts)"""
+    via = great_circle_km(lat, lng, src_lats, src_lngs) + great_circle_km(lat, lng, dst_lats, dst_lngs)
+    return np.maximum(via - great_circle_km(src_lats, src_lngs, dst_lats, dst_lngs), 0.0)
+
+
+def drive_minutes(km):
+    return km * ROAD_CIRCUITY / DRIVE_SPEED_KMH * 60.0
+
+
+def drive_km(minutes):
+    """Great-circle km that drive_minutes turns into `minutes`"""
+    return minutes / 60.0 * DRIVE_SPEED_KMH / ROAD_CIRCUITY
+
+
+def lng_degrees(km, lat):
+    """Longitude span in degrees of `km` at latitude `lat` (wider than km / 111 away from the equator)"""
+    return km / (111.0 * max(np.cos(np.radians(lat)), 0.01))
+
+
+def rank(lat, lng, lats, lngs, starts, requested_time=None, max_km=None, k=None,
+         dest_lats=None, dest_lngs=None, max_detour_minutes=None):
+    """
+    Order candidates by walk time + departure gap.
+
+    lat/lng is the passenger (None when unknown), requested_time is in minutes
+    after midnight (None ignores the gap). Rides farther than max_km are dropped,
+    k keeps only the best k. With dest_lats/dest_lngs the order is by pickup
+    detour + departure gap instead, and rides whose detour is longer than
+    max_detour_minutes are dropped. Returns a Ranking whose `order` indexes the
+    input arrays; the other fields are full-length arrays.
+    """
+    count = len(starts)
+    starts = np.asarray(starts, dtype=float)
+    if lat is None or lng is None:
+        distance = np.full(count, np.nan)
+    else:
+        distance = great_circle_km(lat, lng, lats, lngs)
+    walk = distance / WALK_SPEED_KMH * 60.0
+    detour = detour_time = None
+    if dest_lats is not None:
+        if lat is None or lng is None:
+            detour = np.full(count, np.nan)
+        else:
+            detour = detour_km(lat, lng, lats, lngs, dest_lats, dest_lngs)
+        detour_time = drive_minutes(detour)
+    if requested_time is None:
+        gap = np.zeros(count)
+    else:
+        gap = starts - requested_time
+
+    keep = np.ones(count, dtype=bool)
+    if max_km is not None:
+        keep &= ~(distance > max_km)          # NaN compares False: unlocated rides stay
+    if detour_time is not None and max_detour_minutes is not None:
+        keep &= ~(detour_time > max_detour_minutes)
+    candidates = np.flatnonzero(keep)
+
+    gap_minutes = np.abs(gap[candidates])
+    cost = (walk if detour_time is None else detour_time)[candidates]
+    # unlocated rides rank after every located one, by their gap among themselves
+    score = np.where(np.isnan(cost), UNLOCATED_PENALTY, cost) + gap_minutes
+    order = candidates[_best(score, k)]
+    return Ranking(order, distance, walk, gap, detour, detour_time)
+
+
+def rank_batch(lats, lngs, times, riders, ride_lats, ride_lngs, starts, ends, owners,
+               window, max_km=None, k=None, block=256, dest_lats=None, dest_lngs=None, max_detour_minutes=None):
+    """
+    Rank one set of rides for many passengers in a single matrix pass.
+
+    Passenger p matches the rides overlapping times[p] +/- window that riders[p]
+    does not own and that pick up within max_km (NaN passenger coordinates skip
+    the distance). With dest_lats/dest_lngs, rides are scored and filtered by
+    pickup detour as in rank(); max_detour_minutes is one limit for everyone or
+    one per passenger. Returns one Ranking per passenger, its arrays
+    are rows over the rides. Passengers are processed `block` at a time to
+    bound memory.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lngs = np.asarray(lngs, dtype=float)
+    times = np.asarray(times, dtype=float)
+    riders = np.asarray([str(rider) for rider in riders])
+    ride_lats = np.asarray(ride_lats, dtype=float)
+    ride_lngs = np.asarray(ride_lngs, dtype=float)
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+    owners = np.asarray([str(owner) for owner in owners])
+    if dest_lats is not None:
+        dest_lats = np.asarray(dest_lats, dtype=float)
+        dest_lngs = np.asarray(dest_lngs, dtype=float)
+        direct = great_circle_km(ride_lats, ride_lngs, dest_lats, dest_lngs)
+        if max_detour_minutes is not None:
+            max_detour_minutes = np.broadcast_to(np.asarray(max_detour_minutes, dtype=float), times.shape)
+
+    rankings = []
+    for first in range(0, len(times), block):
+        rows = slice(first, first + block)
+        t = times[rows, None]
+        distance = great_circle_km(lats[rows, None], lngs[rows, None], ride_lats[None, :], ride_lngs[None, :])
+        walk = distance / WALK_SPEED_KMH * 60.0
+        gap = starts[None, :] - t
+        match = (starts[None, :] <= t + window) & (ends[None, :] >= t - window)
+        match &= owners[None, :] != riders[rows, None]
+        if max_km is not None:
+            match &= ~(distance > max_km)
+        detour = detour_time = None
+        if dest_lats is not None:
+            to_dest = great_circle_km(lats[rows, None], lngs[rows, None], dest_lats[None, :], dest_lngs[None, :])
+            detour = np.maximum(distance + to_dest - direct[None, :], 0.0)
+            detour_time = drive_minutes(detour)
+            if max_detour_minutes is not None:
+                match &= ~(detour_time > max_detour_minutes[rows, None])
+        cost = walk if detour_time is None else detour_time
+        score = np.where(np.isnan(cost), UNLOCATED_PENALTY, cost) + np.abs(gap)
+        score[~match] = np.inf
+
+        for row in range(score.shape[0]):
+            candidates = np.flatnonzero(match[row])
+            order = candidates[_best(score[row, candidates], k)]
+            rankings.append(Ranking(order, distance[row], walk[row], gap[row],
+                                    None if detour is None else detour[row],
+                                    None if detour_time is None else detour_time[row]))
+    return rankings
+
+
+def _best(score, k=None):
+    """Positions of the k lowest scores in ascending order, ties by position, as a full stable sort gives"""
+    if k is None or k >= len(score):
+        return np.argsort(score, kind="stable")
+    if k <= 0:
+        return np.array([], dtype=int)
+    # argpartition picks among equal scores arbitrarily: take everything up to the k-th score instead
+    kth = np.partition(score, k - 1)[k - 1]
+    top = np.flatnonzero(score <= kth)
+    return top[np.argsort(score[top], kind="stable")][:k]
+
+
+def ranked_rows(ranked, order=None):
+    """(index, distance_km, walk_minutes, gap_minutes) of each ranked ride as JSON-friendly values, NaN -> None"""
+    order = ranked.order if order is None else order
+    distance = np.round(ranked.distance_km[order], 2).tolist()
+    walk = np.round(ranked.walk_minutes[order], 1).tolist()
+    gap = ranked.gap_minutes[order].astype(int).tolist()
+    return [(i, d if d == d else None, w if w == w else None, g)
+            for i, d, w, g in zip(order.tolist(), distance, walk, gap)]
+
+
+def detour_rows(ranked, order=None):
+    """(detour_km, detour_minutes) of each ranked ride as JSON-friendly values, None when unknown"""
+    order = ranked.order if order is None else order
+    if ranked.detour_km is None:
+        return [(None, None)] * len(order)
+    km = np.round(ranked.detour_km[order], 2).tolist()
+    minutes = np.round(ranked.detour_minutes[order], 1).tolist()
+    return [(d if d == d else None, m if m == m else None) for d, m in zip(km, minutes)]
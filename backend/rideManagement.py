@@ -1,6 +1,8 @@
 import json
 import sqlite3
 import time
+from db_pool import connection
+import ranking
 
 """
 what we can do is filter using different parameters
@@ -18,9 +20,6 @@ def give_rides_using_filter(data):
     data_filter = data.get("filter")
     userCurrentLocation = data.get("userLocation")
     try:
-        conn = sqlite3.connect("aubus.db")
-        curr = conn.cursor()
-        
         rating_range = data_filter.get("rating", [None, None])
         dist_km = data_filter.get("distance")
         date_range = data_filter.get("date")
@@ -38,8 +37,10 @@ def give_rides_using_filter(data):
         except Exception:
             return {"status": "400", "message": "invalid userLocation"}
         
-        deg_thresh = float(dist_km) / 111.0
-        deg_thresh_sq = deg_thresh * deg_thresh
+        dist_km = float(dist_km)
+        lat_deg = dist_km / 111.0
+        lon_deg = ranking.lng_degrees(dist_km, user_lat)
+        # bounding-box lookup on the Zone R*Tree first, great-circle distance after
         sql ="""
             SELECT 
             Ride.rideID,
@@ -49,28 +50,35 @@ def give_rides_using_filter(data):
             Ride.destinationID,
             Ride.startTime,
             Ride.endTime,
-            Ride.scheduleID
-        FROM Ride
-        JOIN Zone AS Zsrc ON Ride.sourceID = Zsrc.zoneID
+            Ride.scheduleID,
+            Zsrc.zoneX,
+            Zsrc.zoneY
+        FROM ZoneRTree AS zr
+        CROSS JOIN Zone AS Zsrc ON Zsrc.rowid = zr.id
+        CROSS JOIN Ride ON Ride.sourceID = Zsrc.zoneID
         WHERE 
-            Ride.startTime >= ?
-            AND Ride.endTime <= ?
-            AND ((Zsrc.zoneX - ?) * (Zsrc.zoneX - ?) +
-                 (Zsrc.zoneY - ?) * (Zsrc.zoneY - ?)) <= ?;
+            zr.minX >= ? AND zr.maxX <= ?
+            AND zr.minY >= ? AND zr.maxY <= ?
+            AND Ride.startTime >= ?
+            AND Ride.endTime <= ?;
         
         """
         params = (
-            start_ts, end_ts,
-            user_lat, user_lat,
-            user_lon, user_lon,
-            deg_thresh_sq
+            user_lat - lat_deg, user_lat + lat_deg,
+            user_lon - lon_deg, user_lon + lon_deg,
+            start_ts, end_ts
         )
-        curr.execute(sql, params)
-        rows = curr.fetchall()
+        with connection() as conn:
+            curr = conn.cursor()
+            curr.execute(sql, params)
+            rows = curr.fetchall()
         print(rows)
-        conn.close()
+        limit = data_filter.get("limit")
+        ranked = ranking.rank(user_lat, user_lon, [ride[8] for ride in rows], [ride[9] for ride in rows],
+                              [ride[5] for ride in rows], max_km=dist_km, k=int(limit) if limit else None)
         rides_list = []
-        for ride in rows:
+        for i, distance_km, walk_minutes, _ in ranking.ranked_rows(ranked):
+            ride = rows[i]
             rides_list.append({
                 "rideID": ride[0],
                 "ownerID": ride[1],
@@ -79,7 +87,9 @@ def give_rides_using_filter(data):
                 "destinationID": ride[4],
                 "startTime": ride[5],
                 "endTime": ride[6],
-                "scheduleID": ride[7]
+                "scheduleID": ride[7],
+                "distance_km": distance_km,
+                "walk_minutes": walk_minutes
             })
         return {"status": "200", "message": "Rides retrieved successfully", "data": rides_list}
 
@@ -90,11 +100,10 @@ def give_rides_using_filter(data):
 def get_IP(data):
     userID = data.get("userID")
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        cur.execute('SELECT userCurrentIP FROM IpInfos WHERE userID=?', (userID,))
-        ip_info = cur.fetchone()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT userCurrentIP FROM IpInfos WHERE userID=?', (userID,))
+            ip_info = cur.fetchone()
         if ip_info is None:
             return {"status": "404", "message": "IP information not found"}
         return {"status": "200", "message": "IP information retrieved successfully", "data": {"userCurrentIP": ip_info[0]}}
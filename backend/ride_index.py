@@ -0,0 +1,247 @@
+import math
+import threading
+
+import ranking
+from db_pool import connection
+
+# In-memory grid index of rides for request_ride.
+#
+# Rides are bucketed by the cell of their pickup zone (CELL_DEG degrees of
+# lat/lon, about 5.5 km) and by their departure minute (TIME_BUCKET minutes).
+# A passenger query only visits the cells around the pickup point and the
+# buckets that can overlap the requested time window. Rides whose pickup zone
+# has no coordinates live in an overflow set that every query checks.
+#
+# Matching by pickup detour (on_the_way) cannot stop at a fixed radius: a
+# ride passes the passenger when the passenger lies in the ellipse around its
+# pickup and drop-off, so the pickup can be as far as the longest ride plus
+# the allowed detour. The index keeps that longest ride length, visits the
+# cells within it and then applies the exact detour test.
+#
+# The index is loaded from the database on first use and kept up to date by
+# the ride handlers calling refresh_ride / refresh_zones / discard after they
+# commit.
+
+CELL_DEG = 0.05
+TIME_BUCKET = 30
+
+RIDE_QUERY = '''
+    SELECT r.rideID, r.ownerID, r.startTime, r.endTime, zs.zoneX, zs.zoneY, zd.zoneX, zd.zoneY
+    FROM Ride r
+    LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
+    LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
+'''
+
+
+def _cell(lat, lng):
+    return (math.floor(lat / CELL_DEG), math.floor(lng / CELL_DEG))
+
+
+class RideIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rides = {}          # rideID -> (ownerID, start, end, lat, lng)
+        self._destinations = {}   # rideID -> (lat, lng) of the drop-off, located rides only
+        self._grid = {}           # (cell, bucket) -> set of rideIDs
+        self._buckets = {}        # bucket -> set of rideIDs, every ride
+        self._unlocated = set()   # rides whose pickup has no coordinates
+        self._max_duration = 0
+        self._max_length_km = 0.0    # like _max_duration, only grows until the next load
+        self.loaded = False
+
+    # ---------------- maintenance ----------------
+    def _insert(self, ride_id, owner_id, start, end, lat, lng, dest_lat=None, dest_lng=None):
+        bucket = start // TIME_BUCKET
+        self._rides[ride_id] = (owner_id, start, end, lat, lng)
+        self._buckets.setdefault(bucket, set()).add(ride_id)
+        if lat is None or lng is None:
+            self._unlocated.add(ride_id)
+        else:
+            self._grid.setdefault((_cell(lat, lng), bucket), set()).add(ride_id)
+            if dest_lat is not None and dest_lng is not None:
+                self._destinations[ride_id] = (dest_lat, dest_lng)
+                length = float(ranking.great_circle_km(lat, lng, [dest_lat], [dest_lng])[0])
+                self._max_length_km = max(self._max_length_km, length)
+        self._max_duration = max(self._max_duration, end - start)
+
+    def _remove(self, ride_id):
+        entry = self._rides.pop(ride_id, None)
+        if entry is None:
+            return
+        self._destinations.pop(ride_id, None)
+        _, start, _, lat, lng = entry
+        bucket = start // TIME_BUCKET
+        self._discard_from(self._buckets, bucket, ride_id)
+        if lat is None or lng is None:
+            self._unlocated.discard(ride_id)
+        else:
+            self._discard_from(self._grid, (_cell(lat, lng), bucket), ride_id)
+
+    @staticmethod
+    def _discard_from(table, key, ride_id):
+        members = table.get(key)
+        if members is not None:
+            members.discard(ride_id)
+            if not members:
+                del table[key]
+
+    def _store(self, row):
+        ride_id, owner_id, start, end, *coordinates = row
+        self._remove(ride_id)
+        try:
+            start, end = int(start), int(end)
+            coordinates = [float(value) if value is not None else None for value in coordinates]
+        except (TypeError, ValueError):
+            return  # no usable times or coordinates, request_ride could not match it either
+        self._insert(ride_id, owner_id, start, end, *coordinates)
+
+    def load(self, conn):
+        rows = conn.execute(RIDE_QUERY).fetchall()
+        with self._lock:
+            self._rides.clear()
+            self._destinations.clear()
+            self._grid.clear()
+            self._buckets.clear()
+            self._unlocated.clear()
+            self._max_duration = 0
+            self._max_length_km = 0.0
+            for row in rows:
+                self._store(row)
+            self.loaded = True
+
+    def refresh_ride(self, conn, ride_id):
+        """Re-read one ride after it was added or edited"""
+        row = conn.execute(RIDE_QUERY + ' WHERE r.rideID = ?', (ride_id,)).fetchone()
+        with self._lock:
+            if row is None:
+                self._remove(ride_id)
+            else:
+                self._store(row)
+
+    def refresh_zones(self, conn, zone_ids):
+        """Re-read every ride picking up or dropping off in one of these zones after they moved"""
+        for zone_id in zone_ids:
+            rows = conn.execute(RIDE_QUERY + ' WHERE r.sourceID = ? OR r.destinationID = ?',
+                                (zone_id, zone_id)).fetchall()
+            with self._lock:
+                for row in rows:
+                    self._store(row)
+
+    def discard(self, ride_id):
+        with self._lock:
+            self._remove(ride_id)
+
+    def __len__(self):
+        return len(self._rides)
+
+    # ---------------- queries ----------------
+    def candidates(self, window_start, window_end, lat=None, lng=None, radius_km=5.0):
+        """
+        rideIDs whose [start, end] overlaps [window_start, window_end] and whose
+        pickup lies in the radius_km box around (lat, lng). Without a location every
+        ride in the window is returned. The caller still applies the exact distance.
+        """
+        with self._lock:
+            first = (window_start - self._max_duration) // TIME_BUCKET
+            last = window_end // TIME_BUCKET
+            found = []
+            if lat is None or lng is None:
+                for b in range(first, last + 1):
+                    for ride_id in self._buckets.get(b, ()):
+                        _, start, end, _, _ = self._rides[ride_id]
+                        if start <= window_end and end >= window_start:
+                            found.append(ride_id)
+                return found
+
+            found = self._within(window_start, window_end, lat, lng, radius_km)
+            return found + self._unlocated_in(window_start, window_end)
+
+    def on_the_way(self, window_start, window_end, lat, lng, max_detour_minutes):
+        """
+        rideIDs overlapping [window_start, window_end] whose pickup detour to (lat, lng)
+        is at most max_detour_minutes as ranking.rank computes it, plus the rides
+        missing pickup or drop-off coordinates, which ranking keeps too.
+        """
+        with self._lock:
+            reach = self._max_length_km + ranking.drive_km(max_detour_minutes)
+            nearby = self._within(window_start, window_end, lat, lng, reach)
+            found = [ride_id for ride_id in nearby if ride_id not in self._destinations]
+            routed = [ride_id for ride_id in nearby if ride_id in self._destinations]
+            if routed:
+                pickups = [self._rides[ride_id][3:] for ride_id in routed]
+                drop_offs = [self._destinations[ride_id] for ride_id in routed]
+                detour = ranking.detour_km(lat, lng, [p[0] for p in pickups], [p[1] for p in pickups],
+                                           [d[0] for d in drop_offs], [d[1] for d in drop_offs])
+                minutes = ranking.drive_minutes(detour)
+                found.extend(ride_id for ride_id, keep in zip(routed, (minutes <= max_detour_minutes).tolist()) if keep)
+            return found + self._unlocated_in(window_start, window_end)
+
+    def _within(self, window_start, window_end, lat, lng, radius_km):
+        # located rides in the window whose pickup lies in the radius_km box around (lat, lng)
+        first = (window_start - self._max_duration) // TIME_BUCKET
+        last = window_end // TIME_BUCKET
+        lat_deg = radius_km / 111.0
+        lng_deg = float(ranking.lng_degrees(radius_km, lat))
+        lat_reach = math.ceil(lat_deg / CELL_DEG)
+        lng_reach = math.ceil(lng_deg / CELL_DEG)
+        buckets = range(first, last + 1)
+        if (2 * lat_reach + 1) * (2 * lng_reach + 1) * len(buckets) > sum(len(self._buckets.get(b, ())) for b in buckets):
+            # a box this wide visits more cells than the window has rides
+            pools = [self._buckets.get(b, ()) for b in buckets]
+        else:
+            row, col = _cell(lat, lng)
+            pools = [self._grid.get(((row + dr, col + dc), b), ())
+                     for dr in range(-lat_reach, lat_reach + 1)
+                     for dc in range(-lng_reach, lng_reach + 1)
+                     for b in buckets]
+        found = []
+        for pool in pools:
+            for ride_id in pool:
+                _, start, end, ride_lat, ride_lng = self._rides[ride_id]
+                if (start <= window_end and end >= window_start and ride_lat is not None
+                        and abs(ride_lat - lat) <= lat_deg and abs(ride_lng - lng) <= lng_deg):
+                    found.append(ride_id)
+        return found
+
+    def _unlocated_in(self, window_start, window_end):
+        found = []
+        for ride_id in self._unlocated:
+            _, start, end, _, _ = self._rides[ride_id]
+            if start <= window_end and end >= window_start:
+                found.append(ride_id)
+        return found
+
+
+_index = RideIndex()
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """The process-wide index, loaded from the database on first use"""
+    if not _index.loaded:
+        with _index_lock:
+            if not _index.loaded:
+                with connection() as conn:
+                    _index.load(conn)
+    return _index
+
+
+def _is_loaded():
+    # waits for a load in progress, so a change committed during it is not lost
+    with _index_lock:
+        return _index.loaded
+
+
+def refresh_ride(conn, ride_id):
+    if _is_loaded():
+        _index.refresh_ride(conn, ride_id)
+
+
+def refresh_zones(conn, zone_ids):
+    if _is_loaded():
+        _index.refresh_zones(conn, zone_ids)
+
+
+def discard(ride_id):
+    if _is_loaded():
+        _index.discard(ride_id)
@@ -0,0 +1,341 @@
+import bz2
+import heapq
+import math
+import os
+import threading
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+# Offline road routing for ETAs and pickup detours.
+#
+# The road graph comes from an OpenStreetMap extract (.osm or .osm.bz2 XML):
+# every way with a drivable highway tag becomes directed edges between its
+# consecutive nodes, weighted by travel seconds at the way's maxspeed (or a
+# default per highway type). Nodes and edges are kept in flat arrays, the
+# adjacency in CSR form (indptr / indices), and saved next to the extract as
+# .npz so later starts skip the XML parse.
+#
+# Point-to-point queries run A* with the straight-line distance at the fastest
+# edge speed as heuristic. Detours for many rides around one passenger run two
+# Dijkstra searches from the pickup point (one over the reversed graph), each
+# stopping once every ride endpoint is settled or DETOUR_LIMIT_SECONDS is
+# passed, so a request costs two searches whatever the number of candidates.
+# Points off the network are snapped to the nearest node, the snap leg costed
+# at ACCESS_SPEED_KMH (a passenger walks to the pickup node, so it adds nothing
+# to the driver's detour).
+#
+# Set AUBUS_ROAD_GRAPH to an extract (or its .npz) to enable it; without it
+# get_router() returns None and matching keeps using straight-line distances.
+
+ROAD_GRAPH_PATH = os.environ.get("AUBUS_ROAD_GRAPH")
+EARTH_RADIUS_M = 6371008.8
+ACCESS_SPEED_KMH = 15.0
+SNAP_CELL_DEG = 0.005
+DETOUR_LIMIT_SECONDS = 3600.0
+
+# km/h when a way has no usable maxspeed
+HIGHWAY_SPEEDS = {
+    "motorway": 90, "motorway_link": 50, "trunk": 70, "trunk_link": 40,
+    "primary": 50, "primary_link": 35, "secondary": 40, "secondary_link": 30,
+    "tertiary": 35, "tertiary_link": 25, "unclassified": 30, "residential": 25,
+    "living_street": 10, "service": 15, "road": 25,
+}
+ONEWAY_TRUE = {"yes", "true", "1"}
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """Great-circle meters, numpy arrays or floats"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _way_speed(tags):
+    speed = tags.get("maxspeed", "")
+    try:
+        kmh = float(speed.split()[0])
+        return kmh * 1.609 if "mph" in speed else kmh
+    except (ValueError, IndexError):
+        return HIGHWAY_SPEEDS[tags["highway"]]
+
+
+class RoadGraph:
+    def __init__(self, lat, lng, indptr, indices, seconds, meters):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.seconds = np.asarray(seconds, dtype=np.float32)
+        self.meters = np.asarray(meters, dtype=np.float32)
+        # the searches are pure Python, and list indexing is several times faster than numpy scalars
+        self._adjacency = (self.indptr.tolist(), self.indices.tolist(), self.seconds.tolist())
+        self._reversed = None
+        # planar meters for the A* heuristic: x is scaled by the cosine of the latitude farthest from the
+        # equator, so it never exceeds the great-circle distance, and a 0.5% margin covers the curvature
+        cos_min = math.cos(math.radians(float(np.max(np.abs(self.lat))))) if len(self.lat) else 1.0
+        self._x = (np.radians(self.lng) * EARTH_RADIUS_M * cos_min * 0.995).tolist()
+        self._y = (np.radians(self.lat) * EARTH_RADIUS_M * 0.995).tolist()
+        # a hair above the fastest edge so float32 rounding cannot make the A* heuristic overestimate
+        self.max_speed = float(np.max(self.meters / np.maximum(self.seconds, 1e-6))) * 1.001 if len(self.seconds) else 1.0
+        self._build_snap_grid()
+
+    @property
+    def node_count(self):
+        return len(self.lat)
+
+    @property
+    def edge_count(self):
+        return len(self.indices)
+
+    # ---------------- building ----------------
+    @classmethod
+    def from_edges(cls, lat, lng, sources, targets, seconds):
+        """CSR graph from an edge list over nodes 0..len(lat)-1"""
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        order = np.argsort(sources, kind="stable")
+        sources, targets = sources[order], targets[order]
+        seconds = np.asarray(seconds, dtype=np.float64)[order]
+        lat = np.asarray(lat, dtype=float)
+        lng = np.asarray(lng, dtype=float)
+        meters = haversine_m(lat[sources], lng[sources], lat[targets], lng[targets])
+        indptr = np.zeros(len(lat) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(lat)), out=indptr[1:])
+        return cls(lat, lng, indptr, targets, seconds, meters)
+
+    @classmethod
+    def from_osm(cls, path):
+        """Parse an OSM XML extract (optionally bz2-compressed)"""
+        opener = bz2.open if path.endswith(".bz2") else open
+        coords = {}            # OSM node id -> (lat, lng)
+        ways = []              # (node ids, km/h, oneway: 1 forward, -1 backward, 0 both)
+        with opener(path, "rb") as f:
+            for _, elem in ET.iterparse(f, events=("end",)):
+                if elem.tag == "node":
+                    coords[int(elem.get("id"))] = (float(elem.get("lat")), float(elem.get("lon")))
+                elif elem.tag == "way":
+                    tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+                    if (tags.get("highway") in HIGHWAY_SPEEDS and tags.get("area") != "yes"
+                            and tags.get("access") not in ("no", "private")):
+                        oneway = tags.get("oneway", "")
+                        direction = (-1 if oneway == "-1" else
+                                     1 if oneway in ONEWAY_TRUE or tags.get("junction") == "roundabout"
+                                     or tags["highway"] == "motorway" else 0)
+                        ways.append(([int(nd.get("ref")) for nd in elem.iter("nd")], _way_speed(tags), direction))
+                if elem.tag in ("node", "way", "relation"):
+                    elem.clear()
+
+        index = {}
+        sources, targets, speeds = [], [], []
+        for refs, kmh, direction in ways:
+            refs = [ref for ref in refs if ref in coords]
+            for a, b in zip(refs, refs[1:]):
+                a, b = index.setdefault(a, len(index)), index.setdefault(b, len(index))
+                if direction >= 0:
+                    sources.append(a), targets.append(b), speeds.append(kmh)
+                if direction <= 0:
+                    sources.append(b), targets.append(a), speeds.append(kmh)
+        lat = np.empty(len(index))
+        lng = np.empty(len(index))
+        for osm_id, node in index.items():
+            lat[node], lng[node] = coords[osm_id]
+        sources, targets = np.asarray(sources, dtype=np.int64), np.asarray(targets, dtype=np.int64)
+        meters = haversine_m(lat[sources], lng[sources], lat[targets], lng[targets])
+        seconds = meters / (np.asarray(speeds, dtype=float) / 3.6)
+        return cls.from_edges(lat, lng, sources, targets, seconds)
+
+    def save(self, path):
+        np.savez(path, lat=self.lat, lng=self.lng, indptr=self.indptr, indices=self.indices,
+                 seconds=self.seconds, meters=self.meters)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["lat"], data["lng"], data["indptr"], data["indices"], data["seconds"], data["meters"])
+
+    # ---------------- snapping ----------------
+    def _build_snap_grid(self):
+        cells = self._cell_keys(self.lat, self.lng)
+        self._snap_order = np.argsort(cells, kind="stable")
+        self._snap_cells = cells[self._snap_order]
+
+    @staticmethod
+    def _cell_keys(lat, lng):
+        row = np.floor(np.asarray(lat) / SNAP_CELL_DEG).astype(np.int64)
+        col = np.floor(np.asarray(lng) / SNAP_CELL_DEG).astype(np.int64)
+        return row * 1_000_000 + col
+
+    def nearest(self, lat, lng):
+        """(node, meters) of the node closest to lat/lng"""
+        row, col = math.floor(lat / SNAP_CELL_DEG), math.floor(lng / SNAP_CELL_DEG)
+        candidates = []
+        for dr in (-1, 0, 1):
+            keys = (row + dr) * 1_000_000 + col + np.array([-1, 0, 1])
+            lo = np.searchsorted(self._snap_cells, keys, side="left")
+            hi = np.searchsorted(self._snap_cells, keys, side="right")
+            candidates.extend(self._snap_order[a:b] for a, b in zip(lo, hi))
+        candidates = np.concatenate(candidates) if candidates else np.array([], dtype=np.int64)
+        if len(candidates) == 0:          # nothing within a cell or so: look at every node
+            candidates = np.arange(self.node_count)
+        distance = haversine_m(lat, lng, self.lat[candidates], self.lng[candidates])
+        best = int(np.argmin(distance))
+        return int(candidates[best]), float(distance[best])
+
+    # ---------------- searches ----------------
+    def _reverse_adjacency(self):
+        if self._reversed is None:
+            sources = np.repeat(np.arange(self.node_count), np.diff(self.indptr))
+            order = np.argsort(self.indices, kind="stable")
+            indptr = np.zeros(self.node_count + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.indices, minlength=self.node_count), out=indptr[1:])
+            self._reversed = (indptr.tolist(), sources[order].tolist(), self.seconds[order].tolist())
+        return self._reversed
+
+    def route(self, source, target):
+        """(seconds, node path) of the fastest route by A*, (inf, []) if there is none"""
+        indptr, indices, seconds = self._adjacency
+        xs, ys = self._x, self._y
+        target_x, target_y = xs[target], ys[target]
+        inverse_speed = 1.0 / self.max_speed
+        hypot = math.hypot
+        push, pop = heapq.heappush, heapq.heappop
+
+        best = {source: 0.0}
+        previous = {source: -1}
+        heap = [(hypot(xs[source] - target_x, ys[source] - target_y) * inverse_speed, 0.0, source)]
+        while heap:
+            _, cost, node = pop(heap)
+            if node == target:
+                path = [node]
+                while previous[path[-1]] != -1:
+                    path.append(previous[path[-1]])
+                return cost, path[::-1]
+            if cost > best[node]:
+                continue
+            for k in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[k]
+                new_cost = cost + seconds[k]
+                if new_cost < best.get(neighbour, math.inf):
+                    best[neighbour] = new_cost
+                    previous[neighbour] = node
+                    push(heap, (new_cost + hypot(xs[neighbour] - target_x, ys[neighbour] - target_y) * inverse_speed,
+                                new_cost, neighbour))
+        return math.inf, []
+
+    def costs(self, source, targets, reverse=False, limit=math.inf):
+        """
+        Dijkstra from source until every target is settled or costs pass `limit`:
+        {target: seconds} (from each target to source when reverse), inf if not reached.
+        """
+        indptr, indices, seconds = self._reverse_adjacency() if reverse else self._adjacency
+        pending = set(targets)
+        found = {}
+        best = {source: 0.0}
+        heap = [(0.0, source)]
+        push, pop = heapq.heappush, heapq.heappop
+        while heap and pending:
+            cost, node = pop(heap)
+            if cost > best[node]:
+                continue
+            if cost > limit:
+                break
+            if node in pending:
+                pending.discard(node)
+                found[node] = cost
+            for k in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[k]
+                new_cost = cost + seconds[k]
+                if new_cost < best.get(neighbour, math.inf):
+                    best[neighbour] = new_cost
+                    push(heap, (new_cost, neighbour))
+        for node in pending:
+            found[node] = math.inf
+        return found
+
+
+class Router:
+    """ETA and detour estimates on a RoadGraph, for coordinates rather than nodes"""
+
+    def __init__(self, graph, direct_cache_size=20000):
+        self.graph = graph
+        self._direct = {}      # (source node, target node) -> seconds; rides are asked about again and again
+        self._direct_cache_size = direct_cache_size
+        self._lock = threading.Lock()
+
+    def snap(self, lat, lng):
+        """(node, seconds to reach it) for a point"""
+        node, meters = self.graph.nearest(lat, lng)
+        return node, meters / (ACCESS_SPEED_KMH / 3.6)
+
+    def eta(self, origin, destination):
+        """Driving seconds between two (lat, lng) points, inf when the network does not connect them"""
+        source, to_source = self.snap(*origin)
+        target, from_target = self.snap(*destination)
+        return to_source + self._direct_seconds(source, target) + from_target
+
+    def _direct_seconds(self, source, target):
+        with self._lock:
+            cached = self._direct.get((source, target))
+        if cached is None:
+            cached, _ = self.graph.route(source, target)
+            with self._lock:
+                if len(self._direct) >= self._direct_cache_size:
+                    self._direct.clear()
+                self._direct[source, target] = cached
+        return cached
+
+    def detours(self, pickup, sources, destinations, limit=DETOUR_LIMIT_SECONDS):
+        """
+        For rides sources[i] -> destinations[i] ((lat, lng) pairs): arrays of the
+        direct seconds and the extra seconds of going through pickup. inf where a
+        leg is unreachable or longer than `limit`.
+        """
+        pickup_node, pickup_access = self.snap(*pickup)
+        source_nodes, source_access = zip(*(self.snap(*point) for point in sources)) if sources else ((), ())
+        dest_nodes, dest_access = zip(*(self.snap(*point) for point in destinations)) if destinations else ((), ())
+        to_pickup = self.graph.costs(pickup_node, source_nodes, reverse=True, limit=limit)
+        from_pickup = self.graph.costs(pickup_node, dest_nodes, limit=limit)
+
+        direct = np.array([s_access + self._direct_seconds(s, d) + d_access
+                           for s, d, s_access, d_access in zip(source_nodes, dest_nodes, source_access, dest_access)])
+        via = np.array([s_access + to_pickup[s] + from_pickup[d] + d_access
+                        for s, d, s_access, d_access in zip(source_nodes, dest_nodes, source_access, dest_access)])
+        # a direct leg the graph cannot tell leaves the detour unknown too (inf - inf would be NaN)
+        with np.errstate(invalid="ignore"):
+            extra = np.where(np.isfinite(direct), via - direct, np.inf)
+        return direct, extra
+
+
+_router = None
+_router_lock = threading.Lock()
+_router_loaded = False
+
+
+def load_graph(path):
+    """A RoadGraph from an .npz, or from an OSM extract (cached as <extract>.npz)"""
+    if path.endswith(".npz"):
+        return RoadGraph.load(path)
+    cached = path + ".npz"
+    if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+        return RoadGraph.load(cached)
+    graph = RoadGraph.from_osm(path)
+    graph.save(cached)
+    return graph
+
+
+def get_router():
+    """The process-wide Router, or None when no road graph is configured or it cannot be read"""
+    global _router, _router_loaded
+    if not _router_loaded:
+        with _router_lock:
+            if not _router_loaded:
+                if ROAD_GRAPH_PATH:
+                    try:
+                        graph = load_graph(ROAD_GRAPH_PATH)
+                        _router = Router(graph)
+                        print(f"[routing] {graph.node_count} nodes, {graph.edge_count} edges from {ROAD_GRAPH_PATH}")
+                    except (OSError, ET.ParseError, ValueError, KeyError) as e:
+                        print(f"[routing] could not load {ROAD_GRAPH_PATH}: {e}")
+                _router_loaded = True
+    return _router
@@ -0,0 +1,339 @@
+"""
+Bulk seat assignment for pending ride requests.
+
+accept_ride_request fills seats one driver click at a time, first come first
+served. This optimizer looks at every pending Request for rides departing in
+a time window and solves it as one min-cost flow:
+
+    source -> rider (1 seat) -> requested ride (cost) -> sink (free seats)
+
+so that as many passengers as possible get a seat and, among those
+assignments, the total cost is smallest. The cost of putting a rider on a ride
+is the walk to its pickup zone (great-circle distance from the rider's zone,
+in minutes) plus how much later it leaves than the earliest ride the rider
+asked for. Request rows carry no desired departure time, so that earliest
+requested ride stands in for it.
+
+    python seat_optimizer.py --start 420 --end 540            # print the proposal
+    python seat_optimizer.py --start 420 --end 540 --apply    # accept it
+
+Through the gateway (optimize_seats) a driver only sees, and can only apply,
+the proposed assignments on their own rides, for a window of at most
+MAX_GATEWAY_WINDOW minutes; the whole window's proposal is command-line only.
+"""
+import argparse
+import heapq
+import json
+import sqlite3
+
+import numpy as np
+
+import notifications
+import ranking
+import seats
+from db_pool import connection
+from update_personal_info import request_accepted_events
+
+MISSING_WALK_MINUTES = 60   # riders or pickups without coordinates
+COST_SCALE = 1              # costs are integers in whole minutes
+MAX_GATEWAY_WINDOW = 240    # minutes a gateway caller may optimize at once
+
+PENDING_QUERY = '''
+    SELECT req.requestID, req.riderID, req.rideID, r.startTime, zs.zoneX, zs.zoneY,
+           (SELECT zoneX FROM Zone WHERE UserID = req.riderID ORDER BY rowid DESC LIMIT 1),
+           (SELECT zoneY FROM Zone WHERE UserID = req.riderID ORDER BY rowid DESC LIMIT 1),
+           req.status, r.ownerID
+    FROM Ride r
+    JOIN Request req ON req.rideID = r.rideID
+    LEFT JOIN Zone zs ON zs.zoneID = r.sourceID
+    WHERE r.startTime >= ? AND r.startTime <= ?
+'''
+SEATS_QUERY = '''
+    SELECT r.rideID, c.capacity, r.seats_taken
+    FROM Ride r
+    JOIN Car c ON r.carId = c.carId
+    WHERE r.startTime >= ? AND r.startTime <= ?
+'''
+
+
+def assign(edges, capacities):
+    """
+    Choose edges (rider, ride, cost) so every rider gets at most one ride, no
+    ride goes over capacities[ride], the number of riders placed is maximal
+    and the total integer cost is minimal for that number. Returns the indexes
+    of the chosen edges.
+
+    Primal-dual min-cost flow: Dijkstra on reduced costs (Johnson potentials)
+    finds the current shortest path length, then a Dinic phase pushes flow
+    along every path of that length. Runs separately on every connected group
+    of riders and rides.
+    """
+    parent = {}
+
+    def find(node):
+        while parent.setdefault(node, node) != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for rider, ride, _ in edges:
+        if capacities.get(ride, 0) > 0:
+            parent[find(("rider", rider))] = find(("ride", ride))
+    groups = {}
+    for i, (rider, ride, _) in enumerate(edges):
+        if capacities.get(ride, 0) > 0:
+            groups.setdefault(find(("ride", ride)), []).append(i)
+    chosen = []
+    for members in groups.values():
+        chosen.extend(_assign_group(edges, members, capacities))
+    return sorted(chosen)
+
+
+def _assign_group(edges, members, capacities):
+    riders = {}
+    rides = {}
+    for i in members:
+        riders.setdefault(edges[i][0], len(riders))
+        rides.setdefault(edges[i][1], len(rides))
+    source, sink = 0, 1
+    size = 2 + len(riders) + len(rides)
+    # residual graph as parallel lists: head, capacity, cost, reverse arc
+    head, cap, cost, rev = [], [], [], []
+    out = [[] for _ in range(size)]
+
+    def arc(u, v, capacity, weight):
+        forward = len(head)
+        for a, b, c, w, back in ((u, v, capacity, weight, forward + 1), (v, u, 0, -weight, forward)):
+            out[a].append(len(head))
+            head.append(b)
+            cap.append(c)
+            cost.append(w)
+            rev.append(back)
+
+    for rider, node in riders.items():
+        arc(source, 2 + node, 1, 0)
+    for ride, node in rides.items():
+        arc(2 + len(riders) + node, sink, capacities[ride], 0)
+    edge_arc = {}
+    for i in members:
+        rider, ride, weight = edges[i]
+        edge_arc[i] = len(head)
+        arc(2 + riders[rider], 2 + len(riders) + rides[ride], 1, weight)
+
+    potential = [0] * size   # every cost is >= 0, so zero potentials start out valid
+    while _shortest_paths(source, sink, size, out, head, cap, cost, potential):
+        # saturate every shortest path at once: Dinic on the zero reduced-cost arcs
+        while True:
+            level = _levels(source, size, out, head, cap, cost, potential)
+            if level[sink] is None:
+                break
+            nxt = [0] * size
+            while _augment(source, sink, level, nxt, out, head, cap, cost, rev, potential):
+                pass
+    return [i for i in members if cap[edge_arc[i]] == 0]
+
+
+def _shortest_paths(source, sink, size, out, head, cap, cost, potential):
+    """Dijkstra on reduced costs; updates the potentials, False once the sink is unreachable"""
+    dist = [None] * size
+    done = [False] * size
+    dist[source] = 0
+    heap = [(0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if done[u]:
+            continue
+        done[u] = True
+        if u == sink:
+            break
+        for a in out[u]:
+            if cap[a] <= 0:
+                continue
+            v = head[a]
+            nd = d + cost[a] + potential[u] - potential[v]
+            if not done[v] and (dist[v] is None or nd < dist[v]):
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    if not done[sink]:
+        return False
+    # nodes not settled before the sink move by its distance, keeping reduced costs >= 0
+    for v in range(size):
+        potential[v] += dist[v] if done[v] else dist[sink]
+    return True
+
+
+def _levels(source, size, out, head, cap, cost, potential):
+    """BFS levels over the arcs with spare capacity and zero reduced cost"""
+    level = [None] * size
+    level[source] = 0
+    queue = [source]
+    for u in queue:
+        for a in out[u]:
+            v = head[a]
+            if cap[a] > 0 and level[v] is None and cost[a] + potential[u] - potential[v] == 0:
+                level[v] = level[u] + 1
+                queue.append(v)
+    return level
+
+
+def _augment(source, sink, level, nxt, out, head, cap, cost, rev, potential):
+    """Push one unit along a level-increasing zero-cost path, False when none is left"""
+    path = []
+    u = source
+    while u != sink:
+        arcs = out[u]
+        while nxt[u] < len(arcs):
+            a = arcs[nxt[u]]
+            v = head[a]
+            if cap[a] > 0 and level[v] == level[u] + 1 and cost[a] + potential[u] - potential[v] == 0:
+                break
+            nxt[u] += 1
+        else:
+            if u == source:
+                return False
+            level[u] = None          # dead end for the rest of this phase
+            a = path.pop()
+            u = head[rev[a]]
+            nxt[u] += 1
+            continue
+        path.append(a)
+        u = v
+    for a in path:
+        cap[a] -= 1
+        cap[rev[a]] += 1
+    return True
+
+
+def load_problem(conn, window_start, window_end):
+    """Pending requests in the window as assignment edges, plus free seats per ride"""
+    rows = conn.execute(PENDING_QUERY, (window_start, window_end)).fetchall()
+    seats = {ride_id: capacity - taken
+             for ride_id, capacity, taken in conn.execute(SEATS_QUERY, (window_start, window_end))
+             if capacity is not None}
+
+    placed = {row[1] for row in rows if row[8] == 'accepted'}
+    pending = [row for row in rows if row[8] in ('pending', None) and row[1] not in placed]
+    if not pending:
+        return [], [], seats
+
+    def column(j):
+        return np.array([row[j] if row[j] is not None else np.nan for row in pending], dtype=float)
+
+    walk = ranking.great_circle_km(column(6), column(7), column(4), column(5)) / ranking.WALK_SPEED_KMH * 60
+    walk = np.where(np.isnan(walk), MISSING_WALK_MINUTES, walk)
+    earliest = {}
+    for row in pending:
+        earliest[row[1]] = min(earliest.get(row[1], row[3]), row[3])
+    gap = np.array([row[3] - earliest[row[1]] for row in pending], dtype=float)
+    costs = np.rint((walk + gap) * COST_SCALE).astype(int).tolist()
+
+    edges = [(row[1], row[2], weight) for row, weight in zip(pending, costs)]
+    return pending, edges, seats
+
+
+def propose(conn, window_start, window_end):
+    """Optimal assignment for the window, as a list of request dicts"""
+    pending, edges, seats = load_problem(conn, window_start, window_end)
+    return [{"requestID": pending[i][0], "riderID": pending[i][1], "rideID": pending[i][2],
+             "driverID": pending[i][9], "cost_minutes": edges[i][2] / COST_SCALE}
+            for i in assign(edges, seats)]
+
+
+def apply(conn, assignments):
+    """
+    Accept the proposed requests in one transaction. Seats are reserved
+    through seats.reserve_seat inside it, so a request accepted by hand in the
+    meantime is never overbooked; returns the assignments that were applied
+    and the notification events to publish once the connection is released.
+    """
+    applied = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for item in assignments:
+            # the write lock is held, so the status read here cannot go stale before the update
+            row = conn.execute('SELECT status FROM Request WHERE requestID = ?', (item["requestID"],)).fetchone()
+            if row is None or row[0] not in ('pending', None):
+                continue
+            if seats.reserve_seat(conn, item["rideID"], item["riderID"]) not in (seats.RESERVED, seats.ALREADY_SEATED):
+                continue
+            conn.execute("UPDATE Request SET status = 'accepted' WHERE requestID = ?", (item["requestID"],))
+            applied.append(item)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    cur = conn.cursor()
+    events = [event for item in applied
+              for event in request_accepted_events(cur, item["requestID"], item["riderID"], item["driverID"])]
+    return applied, events
+
+
+def parse_window(data):
+    window = data.get("window")
+    try:
+        return int(window[0]), int(window[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def optimize_seats(data):
+    """
+    Gateway handler: {"window": [startMinute, endMinute], "apply": bool, "driver_userid": ...}
+
+    The window is solved as a whole, but only the proposed assignments on rides
+    owned by driver_userid are returned and, with "apply", accepted, the same
+    check accept_ride_request makes. The whole window's proposal and bulk apply
+    for every driver are left to the command line (optimize_window).
+    """
+    window = parse_window(data)
+    if window is None:
+        return {"status": "400", "message": "window must be [startMinute, endMinute]"}
+    if not 0 <= window[1] - window[0] <= MAX_GATEWAY_WINDOW:
+        return {"status": "400", "message": f"window must span 0 to {MAX_GATEWAY_WINDOW} minutes"}
+    driver_userid = data.get("driver_userid")
+    if not driver_userid:
+        return {"status": "400", "message": "Missing driver_userid"}
+    try:
+        with connection() as conn:
+            assignments = [item for item in propose(conn, *window) if item["driverID"] == driver_userid]
+            applied, events = [], []
+            if data.get("apply"):
+                applied, events = apply(conn, assignments)
+        notifications.publish_all(events)
+        message = f"Proposed {len(assignments)} seat assignments on your rides"
+        if data.get("apply"):
+            message += f", applied {len(applied)}"
+        return {"status": "200", "message": message,
+                "data": {"assignments": assignments, "applied": applied}}
+    except sqlite3.Error as e:
+        return {"status": "500", "message": f"Database error: {str(e)}"}
+
+
+def optimize_window(window_start, window_end, apply_all=False):
+    """Proposal for the window, accepted for every driver when apply_all (command line only)"""
+    try:
+        with connection() as conn:
+            assignments = propose(conn, window_start, window_end)
+            events = []
+            if apply_all:
+                assignments, events = apply(conn, assignments)
+        notifications.publish_all(events)
+        verb = "Applied" if apply_all else "Proposed"
+        return {"status": "200", "message": f"{verb} {len(assignments)} seat assignments",
+                "data": {"assignments": assignments, "applied": bool(apply_all)}}
+    except sqlite3.Error as e:
+        return {"status": "500", "message": f"Database error: {str(e)}"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assign pending ride requests to seats in bulk")
+    parser.add_argument("--start", type=int, required=True, help="window start, minutes after midnight")
+    parser.add_argument("--end", type=int, required=True, help="window end, minutes after midnight")
+    parser.add_argument("--apply", action="store_true", help="accept the proposed requests")
+    args = parser.parse_args()
+    response = optimize_window(args.start, args.end, args.apply)
+    print(json.dumps(response, indent=2))
+
+
+if __name__ == "__main__":
+    main()
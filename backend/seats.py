@@ -0,0 +1,39 @@
+# Seat reservation for rides.
+#
+# Ride.seats_taken counts the passengers (Rider rows) of a ride. A seat is
+# taken by one conditional UPDATE that only succeeds while seats_taken is below
+# the car's capacity, and the Rider row is inserted in the same transaction.
+# Callers open that transaction with BEGIN IMMEDIATE, which takes the database
+# write lock up front: concurrent accepts on one ride queue behind each other
+# instead of all reading the same free seat, so a car is never over-booked.
+#
+#     conn.execute("BEGIN IMMEDIATE")
+#     if seats.reserve_seat(conn, ride_id, rider_id) in (seats.RESERVED, seats.ALREADY_SEATED):
+#         ...
+#     conn.commit()
+
+RESERVED = "reserved"
+ALREADY_SEATED = "already_seated"
+FULL = "full"
+NO_CAR = "no_car"
+
+
+def reserve_seat(conn, ride_id, rider_id):
+    """
+    Seat rider_id on ride_id inside the caller's immediate transaction; the
+    caller commits or rolls back. Returns RESERVED, ALREADY_SEATED, FULL or
+    NO_CAR (the ride has no car or the car no capacity).
+    """
+    if conn.execute('SELECT 1 FROM Rider WHERE userID = ? AND rideID = ?', (rider_id, ride_id)).fetchone():
+        return ALREADY_SEATED
+    cur = conn.execute('''
+        UPDATE Ride SET seats_taken = seats_taken + 1
+        WHERE rideID = ? AND seats_taken < (SELECT capacity FROM Car WHERE Car.carId = Ride.carId)
+    ''', (ride_id,))
+    if cur.rowcount != 1:
+        row = conn.execute('''
+            SELECT c.capacity FROM Ride r JOIN Car c ON r.carId = c.carId WHERE r.rideID = ?
+        ''', (ride_id,)).fetchone()
+        return FULL if row and row[0] is not None else NO_CAR
+    conn.execute('INSERT INTO Rider (userID, rideID) VALUES (?, ?)', (rider_id, ride_id))
+    return RESERVED
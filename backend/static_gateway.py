@@ -1,83 +1,151 @@
+import argparse
 import socket
 import threading
 import time
 import json
 import sqlite3
+import db_pool
+import db_schema
+import id_generator
+from db_pool import DB_PATH, connection
+from framing import SocketChannel, is_hello
+import notifications
 from authServer import handle_login, handle_sign_up
 from update_personal_info import personal_info_manager, get_driver_requests, accept_ride_request, send_ride_request_to_driver, check_passenger_accepted_requests
 from rideManagement import give_rides_using_filter, get_IP
+from seat_optimizer import optimize_seats
 from weather import get_weather_info
 
+HOST = "0.0.0.0"
+PORT = 9999
+MAX_HANDLERS = 32   # requests handled at once in threaded mode, like async_gateway.WORKERS
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(("0.0.0.0",9999))
-print("Server started on port 9999 on " + socket.gethostbyname(socket.gethostname()))
+# one thread per connection, but at most MAX_HANDLERS of them run a handler
+# (and hold a pooled connection) at a time; start_server resizes it
+handler_slots = threading.BoundedSemaphore(MAX_HANDLERS)
+
+
+def handle_request(data, client_socket):
+    """Route one decoded gateway request to its handler and return the response dict"""
+    action = data.get("action")
+    if action == "login":
+        return handle_login(data, client_socket)
+    elif action == "sign_up":
+        return handle_sign_up(data, client_socket)
+    elif action == "update_personal_info":
+        return personal_info_manager(data)
+    elif action == "ride_filter":
+        return give_rides_using_filter(data)
+    elif action == "get_ip":
+        return get_IP(data)
+    elif action == "get_weather":
+        return get_weather_info(data)
+    elif action == "get_requests":
+        return get_driver_requests(data)
+    elif action == "accept_ride":
+        return accept_ride_request(data)
+    elif action == "send_ride_request":
+        return send_ride_request_to_driver(data)
+    elif action == "check_passenger_requests":
+        return check_passenger_accepted_requests(data)
+    elif action == "optimize_seats":
+        return optimize_seats(data)
+    elif action == "subscribe":
+        return notifications.handle_subscribe(data, client_socket)
+    elif action == "unsubscribe":
+        return notifications.handle_unsubscribe(data, client_socket)
+    else:
+        return {"status": "400", "message": "Invalid action"}
+
+
+def tag_response(data, response):
+    """Echo the client's request_id so pipelined responses can be matched"""
+    if "request_id" in data and isinstance(response, dict):
+        response = dict(response, request_id=data["request_id"])
+    return response
+
+
+def handle_quit(peer_ip):
+    """Forget the IP registered for this peer before the connection is closed"""
+    try:
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM IpInfos WHERE userCurrentIP=?", (peer_ip,))
+            conn.commit()
+        return {"status": "200", "message": "Connection closed"}
+    except sqlite3.Error as e:
+        return {"status": "500", "message": "Database connection error failed to disconnect properly please try again"}
 
-server.listen()
 
 def handle_client(client_socket):
+    channel = SocketChannel(client_socket)
     try:
         while True:
-            request = client_socket.recv(4096).decode('utf-8')
-            
-            if not request:
+            data = channel.receive()
+
+            if data is None:
                 break
-            data = json.loads(request)
-            action = data.get("action")
-            if action == "login":
-                response = handle_login(data,client_socket)
-            elif action == "sign_up":
-                response = handle_sign_up(data,client_socket)
-            elif action == "update_personal_info":
-                response = personal_info_manager(data)
-            elif action == "ride_filter":
-                response = give_rides_using_filter(data)
-            elif action == "get_ip":
-                response = get_IP(data)
-            elif action == "get_weather":
-                response = get_weather_info(data)
-            elif action == "get_requests":
-                response = get_driver_requests(data)
-            elif action == "accept_ride":
-                response = accept_ride_request(data)
-            elif action == "send_ride_request":
-                response = send_ride_request_to_driver(data)
-            elif action == "check_passenger_requests":
-                response = check_passenger_accepted_requests(data)
-            elif action == "quit":
-                try:
-                    client_socket.send(json.dumps(response).encode('utf-8'))
-                    conn = sqlite3.connect('aubus.db')
-                    cur = conn.cursor()
-                    cur.execute("SELCECT * FROM IpInfos WHERE userCurrentIP=?", (client_socket.getpeername()[0],))
-                    userValidity = cur.fetchone()
-                    if not userValidity:
-                        response = {"status": "200", "message": "Connection closed"}
-                        client_socket.send(json.dumps(response).encode('utf-8'))
-                        break
-                    else:
-                        cur.execute("DELETE FROM IpInfos WHERE userCurrentIP=?", (client_socket.getpeername()[0],))
-                        conn.close()
-                        response = {"status": "200", "message": "Connection closed"}
-                        break
-                except sqlite3.Error as e:
-                    response = {"status": "500", "message": "Database connection error failed to disconnect properly please try again"}
-            else:
-                response = {"status": "400", "message": "Invalid action"}
-            client_socket.send(json.dumps(response).encode('utf-8'))
+            if is_hello(data):
+                channel.negotiate(data)
+                continue
+            if data.get("action") == "quit":
+                with handler_slots:
+                    response = handle_quit(channel.getpeername()[0])
+                channel.send_json(tag_response(data, response))
+                if response["status"] == "200":
+                    break
+                continue
+            # requests on one connection are answered in the order they arrive
+            with handler_slots:
+                response = handle_request(data, channel)
+            channel.send_json(tag_response(data, response))
     except Exception as e:
         error_response = {"status": "500", "message": f"Server error: {str(e)}"}
-        client_socket.send(json.dumps(error_response).encode('utf-8'))
+        try:
+            channel.send_json(error_response)
+        except OSError:
+            pass
 
     finally:
+        notifications.forget(channel)
         client_socket.close()
         print("closing connection")
 
-def start_server():
-    while True:
-        client_socket, addr = server.accept()
-        print(f"Connection from {addr} has been established.")
-        client_handler = threading.Thread(target=handle_client, args=(client_socket,))
-        client_handler.start()
-start_server()
-server.close()
\ No newline at end of file
+def start_server(host=HOST, port=PORT, handlers=None):
+    global handler_slots
+    handlers = handlers or MAX_HANDLERS
+    handler_slots = threading.BoundedSemaphore(handlers)
+    # every running handler can hold a connection, none should wait for another's
+    db_pool.get_pool().reserve(handlers)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    print(f"Server started on port {port} on " + socket.gethostbyname(socket.gethostname()))
+    server.listen()
+    try:
+        while True:
+            client_socket, addr = server.accept()
+            print(f"Connection from {addr} has been established.")
+            client_handler = threading.Thread(target=handle_client, args=(client_socket,))
+            client_handler.start()
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AUBus static gateway")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve sockets from an asyncio event loop instead of one thread per client")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of requests handled at once (in async mode, the size of the executor running them)")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="maximum number of requests handled at once (async mode only)")
+    args = parser.parse_args()
+    db_schema.create_schema(DB_PATH)
+    id_generator.get_generator()   # lease a worker id before the first sign-up needs one
+    if args.use_async:
+        import async_gateway
+        async_gateway.run(HOST, args.port, workers=args.workers, max_concurrency=args.max_concurrency)
+    else:
+        start_server(HOST, args.port, handlers=args.workers)
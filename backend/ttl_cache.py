@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import OrderedDict
+
+# In-process cache for slow upstream lookups (weather, ...).
+#
+# An entry is fresh for `ttl` seconds. For `stale` more seconds it is still
+# served, and the first caller to see it stale starts one background refresh
+# (stale-while-revalidate). Past that the caller has to wait for the loader.
+# Loads are single-flight: concurrent misses on a key share one upstream call,
+# and callers that arrive while it runs wait for its result. Failed loads are
+# not cached; a failed background refresh leaves the stale value in place, and
+# with error_grace a failed load returns the last value if it went stale less
+# than error_grace seconds ago (serve old data while the upstream is down).
+# The least recently used entries go once there are more than max_entries.
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    def __init__(self, ttl, stale=0.0, max_entries=4096, error_grace=0.0, clock=time.monotonic):
+        self.ttl = ttl
+        self.stale = stale
+        self.error_grace = error_grace
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (value, fresh until, stale until)
+        self._inflight = {}             # key -> _Flight
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.served_on_error = 0
+
+    def get(self, key, load):
+        """The cached value for key, calling load() (once, however many callers miss together) when needed"""
+        with self._lock:
+            now = self._clock()
+            entry = self._entries.get(key)
+            if entry is not None and now < entry[2]:
+                self._entries.move_to_end(key)
+                if now < entry[1]:
+                    self.hits += 1
+                    return entry[0]
+                self.stale_hits += 1
+                if key not in self._inflight:
+                    self.refreshes += 1
+                    flight = self._inflight[key] = _Flight()
+                    threading.Thread(target=self._load, args=(key, load, flight), daemon=True).start()
+                return entry[0]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = self._inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if leader:
+            self._load(key, load, flight)
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _load(self, key, load, flight):
+        try:
+            flight.value = load()
+            with self._lock:
+                now = self._clock()
+                self._entries[key] = (flight.value, now + self.ttl, now + self.ttl + self.stale)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+                entry = self._entries.get(key)
+                if entry is not None and self._clock() < entry[2] + self.error_grace:
+                    flight.value = entry[0]
+                    self.served_on_error += 1
+                else:
+                    flight.error = e
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "stale_hits": self.stale_hits,
+                    "misses": self.misses, "coalesced": self.coalesced, "refreshes": self.refreshes,
+                    "errors": self.errors, "served_on_error": self.served_on_error}
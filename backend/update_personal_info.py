@@ -1,6 +1,14 @@
 import json
+import math
 import sqlite3
-import time  
+import time
+from db_pool import connection
+import id_generator
+import notifications
+import ranking
+import ride_index
+import routing
+import seats
 
 
 def personal_info_manager(data):
@@ -19,6 +27,8 @@ def personal_info_manager(data):
         return cancel_ride(data)
     elif req_code == "request_ride":
         return request_ride(data)
+    elif req_code == "request_ride_batch":
+        return request_ride_batch(data)
     elif req_code == "give_all_rides":
         return give_all_rides(data)
     elif req_code == "get_my_rides_detailed":
@@ -49,11 +59,10 @@ def handle_edit_role(data):
     userID = data.get("userID")
     new_role = data.get("new_role")
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        cur.execute('UPDATE "user" SET isDriver=? WHERE userID=?', (new_role == "driver", userID))
-        conn.commit()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute('UPDATE "user" SET isDriver=? WHERE userID=?', (new_role == "driver", userID))
+            conn.commit()
         return {"status": "200", "message": "Role updated successfully"}
     except sqlite3.Error as e:
         return {"status": "400", "message": str("an unexpected error occurred: it seems that the service is down")}
@@ -67,21 +76,19 @@ def handle_edit_name(data):
         return {"status": "400", "message": "UserID and new_name are required"}
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
+        with connection() as conn:
+            cur = conn.cursor()
         
-        # Check if username already exists (excluding current user)
-        cur.execute('SELECT userID FROM "user" WHERE username=? AND userID!=?', (new_name, userID))
-        existing_user = cur.fetchone()
+            # Check if username already exists (excluding current user)
+            cur.execute('SELECT userID FROM "user" WHERE username=? AND userID!=?', (new_name, userID))
+            existing_user = cur.fetchone()
         
-        if existing_user:
-            conn.close()
-            return {"status": "400", "message": "Username already exists"}
+            if existing_user:
+                return {"status": "400", "message": "Username already exists"}
         
-        # Update username
-        cur.execute('UPDATE "user" SET username=? WHERE userID=?', (new_name, userID))
-        conn.commit()
-        conn.close()
+            # Update username
+            cur.execute('UPDATE "user" SET username=? WHERE userID=?', (new_name, userID))
+            conn.commit()
         
         return {"status": "200", "message": "Name updated successfully"}
     
@@ -107,76 +114,73 @@ def add_ride(data):
     startTime = data.get("startTime")
     endTime = data.get("endTime")
     scheduleID = data.get("scheduleID")
-    rideID = str(int(time.time() * 17 * 1000))
 
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
+        rideID = str(id_generator.next_id())
+        with connection() as conn:
+            cur = conn.cursor()
 
-        cur.execute('SELECT * FROM "schedule" WHERE scheduleID=?', (scheduleID,))
-        schedule_row = cur.fetchone()
-        if not schedule_row:
-            cur.execute('INSERT INTO "schedule" (scheduleID) VALUES (?)', (scheduleID,))
+            cur.execute('SELECT * FROM "schedule" WHERE scheduleID=?', (scheduleID,))
+            schedule_row = cur.fetchone()
+            if not schedule_row:
+                cur.execute('INSERT INTO "schedule" (scheduleID) VALUES (?)', (scheduleID,))
+                conn.commit()
+        
+            cur.execute('SELECT * FROM "Car" WHERE ownerID=?', (userID,))
+            car_row = cur.fetchone()
+            if not car_row:
+                return {"status": "400", "message": "User has no cars. Please add a car first in your Profile."}
+        
+            # Verify the specific car exists and belongs to user
+            if carId:
+                cur.execute('SELECT * FROM "Car" WHERE carId=? AND ownerID=?', (carId, userID))
+                specific_car = cur.fetchone()
+                if not specific_car:
+                    return {"status": "400", "message": "Selected car not found or doesn't belong to you"}
+        
+            cur.execute('SELECT * FROM "ride" WHERE scheduleID=?', (scheduleID,))
+            ride_row = cur.fetchall()
+            ride_data = [(ride[5], ride[6]) for ride in ride_row]
+            if ride_row:
+                print(ride_data)
+                if checkIntersection(ride_data, (int(startTime), int(endTime))):
+                    return {"status": "400", "message": "Ride time conflicts with existing schedule"}
+        
+            # Handle zone creation
+            zone0 = str(source[0]) + str(source[1]) if isinstance(source, tuple) else str(source)
+            zone1 = str(destination[0]) + str(destination[1]) if isinstance(destination, tuple) else str(destination)
+        
+            # Create source zone if needed
+            cur.execute('SELECT * FROM "Zone" WHERE zoneID=?', (zone0,))
+            source_row = cur.fetchone()
+            if not source_row:
+                if isinstance(source, tuple) and len(source) == 2:
+                    cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
+                               (zone0, float(source[0]), float(source[1]), "Zone " + zone0, userID))
+                else:
+                    # If source is a string, create zone with default coordinates
+                    cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
+                               (zone0, 33.8958, 35.4787, str(source), userID))
+        
+            # Create destination zone if needed
+            cur.execute('SELECT * FROM "Zone" WHERE zoneID=?', (zone1,))
+            dest_row = cur.fetchone()
+            if not dest_row:
+                if isinstance(destination, tuple) and len(destination) == 2:
+                    cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
+                               (zone1, float(destination[0]), float(destination[1]), "Zone " + zone1, userID))
+                else:
+                    # If destination is a string, use AUB coordinates
+                    cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
+                               (zone1, 33.9006, 35.4812, str(destination), userID))
+        
+            cur.execute(
+                'INSERT INTO "Ride" (rideID, ownerID, carId, sourceID, destinationID, startTime, endTime, scheduleID) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (rideID, userID, carId, zone0, zone1, startTime, endTime, scheduleID)
+            )
             conn.commit()
-        
-        cur.execute('SELECT * FROM "Car" WHERE ownerID=?', (userID,))
-        car_row = cur.fetchone()
-        if not car_row:
-            conn.close()
-            return {"status": "400", "message": "User has no cars. Please add a car first in your Profile."}
-        
-        # Verify the specific car exists and belongs to user
-        if carId:
-            cur.execute('SELECT * FROM "Car" WHERE carId=? AND ownerID=?', (carId, userID))
-            specific_car = cur.fetchone()
-            if not specific_car:
-                conn.close()
-                return {"status": "400", "message": "Selected car not found or doesn't belong to you"}
-        
-        cur.execute('SELECT * FROM "ride" WHERE scheduleID=?', (scheduleID,))
-        ride_row = cur.fetchall()
-        ride_data = [(ride[5], ride[6]) for ride in ride_row]
-        if ride_row:
-            print(ride_data)
-            if checkIntersection(ride_data, (int(startTime), int(endTime))):
-                conn.close()
-                return {"status": "400", "message": "Ride time conflicts with existing schedule"}
-        
-        # Handle zone creation
-        zone0 = str(source[0]) + str(source[1]) if isinstance(source, tuple) else str(source)
-        zone1 = str(destination[0]) + str(destination[1]) if isinstance(destination, tuple) else str(destination)
-        
-        # Create source zone if needed
-        cur.execute('SELECT * FROM "Zone" WHERE zoneID=?', (zone0,))
-        source_row = cur.fetchone()
-        if not source_row:
-            if isinstance(source, tuple) and len(source) == 2:
-                cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
-                           (zone0, float(source[0]), float(source[1]), "Zone " + zone0, userID))
-            else:
-                # If source is a string, create zone with default coordinates
-                cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
-                           (zone0, 33.8958, 35.4787, str(source), userID))
-        
-        # Create destination zone if needed
-        cur.execute('SELECT * FROM "Zone" WHERE zoneID=?', (zone1,))
-        dest_row = cur.fetchone()
-        if not dest_row:
-            if isinstance(destination, tuple) and len(destination) == 2:
-                cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
-                           (zone1, float(destination[0]), float(destination[1]), "Zone " + zone1, userID))
-            else:
-                # If destination is a string, use AUB coordinates
-                cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
-                           (zone1, 33.9006, 35.4812, str(destination), userID))
-        
-        cur.execute(
-            'INSERT INTO "Ride" (rideID, ownerID, carId, sourceID, destinationID, startTime, endTime, scheduleID) '
-            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-            (rideID, userID, carId, zone0, zone1, startTime, endTime, scheduleID)
-        )
-        conn.commit()
-        conn.close()
+            ride_index.refresh_ride(conn, rideID)
         
         return {
             "status": "201",
@@ -193,11 +197,10 @@ def add_ride(data):
             }
         }
 
+    except id_generator.NoWorkerId as e:
+        return id_generator.unavailable(e)
     except sqlite3.Error as e:
         return {"status": "400", "message": f"Database error: {str(e)}"}
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 def edit_ride(data):
     """
@@ -216,76 +219,72 @@ def edit_ride(data):
         return {"status": "400", "message": "Missing required fields"}
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        
-        # Verify the user owns this ride
-        cur.execute('SELECT ownerID, scheduleID FROM Ride WHERE rideID=?', (ride_id,))
-        ride_data = cur.fetchone()
-        
-        if not ride_data:
-            conn.close()
-            return {"status": "404", "message": "Ride not found"}
-        
-        if ride_data[0] != user_id:
-            conn.close()
-            return {"status": "403", "message": "You can only edit your own rides"}
-        
-        # Verify car ownership if car_id is provided
-        if car_id:
-            cur.execute('SELECT ownerID FROM Car WHERE carId=?', (car_id,))
-            car_owner = cur.fetchone()
-            if not car_owner or car_owner[0] != user_id:
-                conn.close()
-                return {"status": "403", "message": "You don't own this car"}
-        
-        # Check for time conflicts with other rides in the same schedule (excluding current ride)
-        cur.execute('SELECT startTime, endTime FROM Ride WHERE scheduleID=? AND rideID!=?', 
-                   (ride_data[1], ride_id))
-        existing_rides = cur.fetchall()
-        
-        if existing_rides:
-            ride_times = [(ride[0], ride[1]) for ride in existing_rides]
-            if checkIntersection(ride_times, (int(start_time), int(end_time))):
-                conn.close()
-                return {"status": "400", "message": "Ride time conflicts with existing schedule"}
-        
-        # Handle zone creation/updates
-        zone0 = str(source[0]) + str(source[1]) if isinstance(source, tuple) else str(source)
-        zone1 = str(destination[0]) + str(destination[1]) if isinstance(destination, tuple) else str(destination)
-        
-        # Create/update source zone
-        cur.execute('SELECT * FROM "Zone" WHERE zoneID=?', (zone0,))
-        source_row = cur.fetchone()
-        if not source_row:
-            if isinstance(source, tuple) and len(source) == 2:
-                cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
-                           (zone0, float(source[0]), float(source[1]), "Zone " + zone0, user_id))
-            else:
-                cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
-                           (zone0, 33.8958, 35.4787, str(source), user_id))
-        
-        # Create/update destination zone
-        cur.execute('SELECT * FROM "Zone" WHERE zoneID=?', (zone1,))
-        dest_row = cur.fetchone()
-        if not dest_row:
-            if isinstance(destination, tuple) and len(destination) == 2:
-                cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
-                           (zone1, float(destination[0]), float(destination[1]), "Zone " + zone1, user_id))
-            else:
-                cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
-                           (zone1, 33.9006, 35.4812, str(destination), user_id))
-        
-        # Update the ride
-        update_query = '''
-            UPDATE Ride 
-            SET carId=?, sourceID=?, destinationID=?, startTime=?, endTime=?
-            WHERE rideID=?
-        '''
-        cur.execute(update_query, (car_id, zone0, zone1, start_time, end_time, ride_id))
+        with connection() as conn:
+            cur = conn.cursor()
+        
+            # Verify the user owns this ride
+            cur.execute('SELECT ownerID, scheduleID FROM Ride WHERE rideID=?', (ride_id,))
+            ride_data = cur.fetchone()
+        
+            if not ride_data:
+                return {"status": "404", "message": "Ride not found"}
+        
+            if ride_data[0] != user_id:
+                return {"status": "403", "message": "You can only edit your own rides"}
+        
+            # Verify car ownership if car_id is provided
+            if car_id:
+                cur.execute('SELECT ownerID FROM Car WHERE carId=?', (car_id,))
+                car_owner = cur.fetchone()
+                if not car_owner or car_owner[0] != user_id:
+                    return {"status": "403", "message": "You don't own this car"}
+        
+            # Check for time conflicts with other rides in the same schedule (excluding current ride)
+            cur.execute('SELECT startTime, endTime FROM Ride WHERE scheduleID=? AND rideID!=?', 
+                       (ride_data[1], ride_id))
+            existing_rides = cur.fetchall()
+        
+            if existing_rides:
+                ride_times = [(ride[0], ride[1]) for ride in existing_rides]
+                if checkIntersection(ride_times, (int(start_time), int(end_time))):
+                    return {"status": "400", "message": "Ride time conflicts with existing schedule"}
+        
+            # Handle zone creation/updates
+            zone0 = str(source[0]) + str(source[1]) if isinstance(source, tuple) else str(source)
+            zone1 = str(destination[0]) + str(destination[1]) if isinstance(destination, tuple) else str(destination)
+        
+            # Create/update source zone
+            cur.execute('SELECT * FROM "Zone" WHERE zoneID=?', (zone0,))
+            source_row = cur.fetchone()
+            if not source_row:
+                if isinstance(source, tuple) and len(source) == 2:
+                    cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
+                               (zone0, float(source[0]), float(source[1]), "Zone " + zone0, user_id))
+                else:
+                    cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
+                               (zone0, 33.8958, 35.4787, str(source), user_id))
+        
+            # Create/update destination zone
+            cur.execute('SELECT * FROM "Zone" WHERE zoneID=?', (zone1,))
+            dest_row = cur.fetchone()
+            if not dest_row:
+                if isinstance(destination, tuple) and len(destination) == 2:
+                    cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
+                               (zone1, float(destination[0]), float(destination[1]), "Zone " + zone1, user_id))
+                else:
+                    cur.execute('INSERT INTO "Zone" (zoneID,zoneX,zoneY,zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
+                               (zone1, 33.9006, 35.4812, str(destination), user_id))
+        
+            # Update the ride
+            update_query = '''
+                UPDATE Ride 
+                SET carId=?, sourceID=?, destinationID=?, startTime=?, endTime=?
+                WHERE rideID=?
+            '''
+            cur.execute(update_query, (car_id, zone0, zone1, start_time, end_time, ride_id))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            ride_index.refresh_ride(conn, ride_id)
         
         return {
             "status": "200",
@@ -305,18 +304,15 @@ def edit_ride(data):
         return {"status": "500", "message": f"Database error: {str(e)}"}
     except Exception as e:
         return {"status": "500", "message": f"Error: {str(e)}"}
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 def remove_ride(data):
     ride_id = data.get("rideID")
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        cur.execute('DELETE FROM Ride WHERE rideID=?', (ride_id,))
-        conn.commit()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute('DELETE FROM Ride WHERE rideID=?', (ride_id,))
+            conn.commit()
+        ride_index.discard(ride_id)
         return {"status": "200", "message": "Ride removed successfully"}
     except sqlite3.Error as e:
         return {"status": "400", "message": str("an unexpected error occurred: it seems that the service is down")}
@@ -334,25 +330,23 @@ def cancel_ride(data):
         return {"status": "400", "message": "Missing rideID or userID"}
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
+        with connection() as conn:
+            cur = conn.cursor()
         
-        # Verify the user owns this ride
-        cur.execute('SELECT ownerID FROM Ride WHERE rideID=?', (ride_id,))
-        ride_owner = cur.fetchone()
+            # Verify the user owns this ride
+            cur.execute('SELECT ownerID FROM Ride WHERE rideID=?', (ride_id,))
+            ride_owner = cur.fetchone()
         
-        if not ride_owner:
-            conn.close()
-            return {"status": "404", "message": "Ride not found"}
+            if not ride_owner:
+                return {"status": "404", "message": "Ride not found"}
         
-        if ride_owner[0] != user_id:
-            conn.close()
-            return {"status": "403", "message": "You can only cancel your own rides"}
+            if ride_owner[0] != user_id:
+                return {"status": "403", "message": "You can only cancel your own rides"}
         
-        # Delete the ride
-        cur.execute('DELETE FROM Ride WHERE rideID=?', (ride_id,))
-        conn.commit()
-        conn.close()
+            # Delete the ride
+            cur.execute('DELETE FROM Ride WHERE rideID=?', (ride_id,))
+            conn.commit()
+        ride_index.discard(ride_id)
         
         return {
             "status": "200",
@@ -364,6 +358,141 @@ def cancel_ride(data):
         return {"status": "500", "message": f"Database error: {str(e)}"}
 
 
+MATCH_WINDOW = 30      # minutes either side of the requested time
+MAX_DETOUR_MINUTES = 10   # default extra driving a pickup may cost the driver
+
+
+def parse_ride_query(data):
+    """(riderID, pickup lat, pickup lng, requested minute, limit) of one request_ride query"""
+    pickup_lat = None
+    pickup_lng = None
+    area = data.get("area")
+    if ',' in str(area):
+        try:
+            parts = str(area).split(',')
+            pickup_lat = float(parts[0])
+            pickup_lng = float(parts[1])
+        except:
+            pass
+    if not (pickup_lat and pickup_lng):
+        pickup_lat = pickup_lng = None
+
+    time_parts = data.get("time").split(':')
+    requested_time = int(time_parts[0]) * 60 + int(time_parts[1])
+    limit = int(data["limit"]) if data.get("limit") else None
+    return data.get("riderID"), pickup_lat, pickup_lng, requested_time, limit
+
+
+def parse_max_detour(data):
+    """The query's max_detour_minutes, MAX_DETOUR_MINUTES when absent"""
+    value = data.get("max_detour_minutes")
+    return MAX_DETOUR_MINUTES if value is None else float(value)
+
+
+def window_candidates(requested_time, pickup_lat, pickup_lng, max_detour):
+    """rideIDs in the requested time window that can pick the passenger up within max_detour minutes"""
+    index = ride_index.get_index()
+    window_start, window_end = requested_time - MATCH_WINDOW, requested_time + MATCH_WINDOW
+    if pickup_lat is None or pickup_lng is None:
+        return index.candidates(window_start, window_end)
+    return index.on_the_way(window_start, window_end, pickup_lat, pickup_lng, max_detour)
+
+
+def load_ride_rows(cur, ride_ids):
+    """Ride rows with driver and zone details for these rideIDs, ordered by rideID"""
+    rides = []
+    for i in range(0, len(ride_ids), 500):
+        chunk = ride_ids[i:i + 500]
+        query = '''
+            SELECT r.rideID, r.ownerID, r.carId, r.sourceID, r.destinationID, 
+                   r.startTime, r.endTime, r.scheduleID,
+                   u.username, u.email,
+                   zs.zoneName as source_name, zs.zoneX as source_lat, zs.zoneY as source_lng,
+                   zd.zoneName as dest_name, zd.zoneX as dest_lat, zd.zoneY as dest_lng
+            FROM Ride r
+            JOIN "user" u ON r.ownerID = u.userID
+            LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
+            LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
+            WHERE r.rideID IN (%s)
+        ''' % ",".join("?" * len(chunk))
+        cur.execute(query, chunk)
+        rides.extend(cur.fetchall())
+    rides.sort(key=lambda ride: ride[0])  # equal scores then rank the same in every caller
+    return rides
+
+
+def ride_coordinates(rides):
+    """Pickup lat/lng columns of ride rows, NaN where the zone has none"""
+    lats = [float(ride[11]) if ride[11] else float("nan") for ride in rides]
+    lngs = [float(ride[12]) if ride[12] else float("nan") for ride in rides]
+    return lats, lngs
+
+
+def ride_destinations(rides):
+    """Drop-off lat/lng columns of ride rows, NaN where the zone has none"""
+    lats = [float(ride[14]) if ride[14] else float("nan") for ride in rides]
+    lngs = [float(ride[15]) if ride[15] else float("nan") for ride in rides]
+    return lats, lngs
+
+
+def ride_candidate(ride, distance_km, walk_minutes, departure_gap, detour_km=None, detour_minutes=None):
+    start_hours = int(ride[5]) // 60
+    start_mins = int(ride[5]) % 60
+    end_hours = int(ride[6]) // 60
+    end_mins = int(ride[6]) % 60
+    return {
+        "rideID": ride[0],
+        "driverID": ride[1],
+        "driverUsername": ride[8],
+        "driverEmail": ride[9],
+        "carId": ride[2],
+        "source": ride[3],
+        "destination": ride[4],
+        "source_name": ride[10],
+        "dest_name": ride[13],
+        "startTime": f"{start_hours:02d}:{start_mins:02d}",
+        "endTime": f"{end_hours:02d}:{end_mins:02d}",
+        "scheduleID": ride[7],
+        "pickup_lat": ride[11],
+        "pickup_lng": ride[12],
+        "dest_lat": ride[14],
+        "dest_lng": ride[15],
+        "distance_km": distance_km,
+        "walk_minutes": walk_minutes,
+        "departure_gap": departure_gap,
+        "detour_km": detour_km,
+        "detour_minutes": detour_minutes
+    }
+
+
+def rank_by_road(router, pickup_lat, pickup_lng, candidates, limit=None, max_detour=None):
+    """
+    Re-rank request_ride candidates by the driver's road detour to pick the passenger
+    up plus the departure gap; sets drive_minutes and detour_minutes from the road
+    graph (None when it cannot tell) and drops rides whose detour exceeds max_detour.
+    """
+    routed = [c for c in candidates if None not in (c["pickup_lat"], c["pickup_lng"], c["dest_lat"], c["dest_lng"])]
+    for candidate in candidates:
+        candidate["drive_minutes"] = None
+    for candidate in routed:
+        candidate["detour_minutes"] = None
+    if routed:
+        direct, detour = router.detours((pickup_lat, pickup_lng),
+                                        [(float(c["pickup_lat"]), float(c["pickup_lng"])) for c in routed],
+                                        [(float(c["dest_lat"]), float(c["dest_lng"])) for c in routed])
+        for candidate, drive, extra in zip(routed, direct.tolist(), detour.tolist()):
+            if math.isfinite(drive):
+                candidate["drive_minutes"] = round(drive / 60, 1)
+            if math.isfinite(extra):
+                candidate["detour_minutes"] = round(max(extra, 0.0) / 60, 1)
+        if max_detour is not None:
+            candidates = [c for c in candidates if c["detour_minutes"] is None or c["detour_minutes"] <= max_detour]
+    # sorted() is stable: candidates the road graph cannot place keep their straight-line order, last
+    candidates = sorted(candidates, key=lambda c: (c["detour_minutes"] is None,
+                                                   (c["detour_minutes"] or 0) + abs(c["departure_gap"])))
+    return candidates[:limit] if limit else candidates
+
+
 def request_ride(data):
 
     rider_id = data.get("riderID")
@@ -376,98 +505,27 @@ def request_ride(data):
         return {"status": "400", "message": "Missing required fields"}
     
     try:
-        pickup_lat = None
-        pickup_lng = None
-        if ',' in str(area):
-            try:
-                parts = str(area).split(',')
-                pickup_lat = float(parts[0])
-                pickup_lng = float(parts[1])
-            except:
-                pass
-        
-        time_parts = time_str.split(':')
-        requested_time = int(time_parts[0]) * 60 + int(time_parts[1])
+        rider_id, pickup_lat, pickup_lng, requested_time, limit = parse_ride_query(data)
+        max_detour = parse_max_detour(data)
         print(requested_time)
-        
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        query = '''
-            SELECT r.rideID, r.ownerID, r.carId, r.sourceID, r.destinationID, 
-                   r.startTime, r.endTime, r.scheduleID,
-                   u.username, u.email,
-                   zs.zoneName as source_name, zs.zoneX as source_lat, zs.zoneY as source_lng,
-                   zd.zoneName as dest_name, zd.zoneX as dest_lat, zd.zoneY as dest_lng
-            FROM Ride r
-            JOIN "user" u ON r.ownerID = u.userID
-            LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
-            LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
-            WHERE r.startTime <= ? AND r.endTime >= ?
-        '''
-        
-        time_window_start = requested_time - 30
-        time_window_end = requested_time + 30
-        
-        cur.execute(query, (time_window_end, time_window_start))
-        rides = cur.fetchall()
-        print(rides)
-        conn.close()
-        
-        candidates = []
-        for ride in rides:
-            if ride[1] == rider_id:
-                continue
-            
-            source_name = ride[10] or ""
-            dest_name = ride[13] or ""
-            
-            # if direction == "to_aub":
-            #     if "AUB" not in dest_name.upper() and "33.9" not in str(ride[14]):
-            #         continue
-            # else:  
-            #     if "AUB" not in source_name.upper() and "33.9" not in str(ride[11]):
-            #         continue
-            
-            distance_km = None
-            if pickup_lat and pickup_lng and ride[11] and ride[12]:
-                lat_diff = abs(pickup_lat - float(ride[11]))
-                lng_diff = abs(pickup_lng - float(ride[12]))
-                distance_km = ((lat_diff ** 2 + lng_diff ** 2) ** 0.5) * 111
-                
-                if distance_km > 5:
-                    continue
-            
-            start_hours = int(ride[5]) // 60
-            start_mins = int(ride[5]) % 60
-            end_hours = int(ride[6]) // 60
-            end_mins = int(ride[6]) % 60
-            
-            candidate = {
-                "rideID": ride[0],
-                "driverID": ride[1],
-                "driverUsername": ride[8],
-                "driverEmail": ride[9],
-                "carId": ride[2],
-                "source": ride[3],
-                "destination": ride[4],
-                "source_name": ride[10],
-                "dest_name": ride[13],
-                "startTime": f"{start_hours:02d}:{start_mins:02d}",
-                "endTime": f"{end_hours:02d}:{end_mins:02d}",
-                "scheduleID": ride[7],
-                "pickup_lat": ride[11],
-                "pickup_lng": ride[12],
-                "dest_lat": ride[14],
-                "dest_lng": ride[15],
-                "distance_km": round(distance_km, 2) if distance_km else None
-            }
-            candidates.append(candidate)
-        
+
+        ride_ids = window_candidates(requested_time, pickup_lat, pickup_lng, max_detour)
+        with connection() as conn:
+            rides = load_ride_rows(conn.cursor(), ride_ids)
+        
+        rides = [ride for ride in rides if ride[1] != rider_id]
+        lats, lngs = ride_coordinates(rides)
+        # with a road graph every ride in range is re-ranked by detour, so the limit applies after that
+        router = routing.get_router() if pickup_lat is not None and pickup_lng is not None else None
+        dest_lats, dest_lngs = ride_destinations(rides)
+        ranked = ranking.rank(pickup_lat, pickup_lng, lats, lngs, [int(ride[5]) for ride in rides],
+                              requested_time, k=None if router else limit, dest_lats=dest_lats, dest_lngs=dest_lngs,
+                              max_detour_minutes=max_detour)
+        candidates = [ride_candidate(rides[i], *values, *detour)
+                      for (i, *values), detour in zip(ranking.ranked_rows(ranked), ranking.detour_rows(ranked))]
+        if router:
+            candidates = rank_by_road(router, pickup_lat, pickup_lng, candidates, limit, max_detour)
         print(candidates)
-        if any(c.get('distance_km') for c in candidates):
-            candidates.sort(key=lambda x: x.get('distance_km') or 999)
-        else:
-            candidates.sort(key=lambda x: x.get('startTime', ''))
         
         return {
             "status": "200",
@@ -484,6 +542,77 @@ def request_ride(data):
         return {"status": "500", "message": f"Error: {str(e)}"}
 
 
+def request_ride_batch(data):
+    """
+    Many request_ride queries at once ("queries": list of request_ride payloads).
+    The rides are loaded once and every passenger is matched in one vectorized
+    pass, then re-ranked by road detour like request_ride when a road graph is
+    loaded; "results" holds one request_ride-shaped response per query, in order.
+    """
+    queries = data.get("queries")
+    if not isinstance(queries, list) or not queries:
+        return {"status": "400", "message": "Missing queries"}
+
+    results = [None] * len(queries)
+    parsed = []
+    for position, query in enumerate(queries):
+        if not isinstance(query, dict) or not all([query.get("riderID"), query.get("area"),
+                                                   query.get("time"), query.get("direction")]):
+            results[position] = {"status": "400", "message": "Missing required fields"}
+            continue
+        try:
+            parsed.append((position,) + parse_ride_query(query) + (parse_max_detour(query),))
+        except (ValueError, IndexError, AttributeError) as e:
+            results[position] = {"status": "400", "message": f"Invalid query: {str(e)}"}
+
+    try:
+        if not parsed:
+            return {"status": "200", "message": "Matched 0 queries", "data": {"results": results}}
+
+        # the rides any query can match, loaded once; the matrix pass does the per-query filtering
+        ride_ids = sorted({ride_id for _, _, lat, lng, requested_time, _, max_detour in parsed
+                           for ride_id in window_candidates(requested_time, lat, lng, max_detour)})
+        with connection() as conn:
+            rides = load_ride_rows(conn.cursor(), ride_ids)
+
+        nan = float("nan")
+        lats, lngs = ride_coordinates(rides)
+        dest_lats, dest_lngs = ride_destinations(rides)
+        limits = [limit for _, _, _, _, _, limit, _ in parsed]
+        router = routing.get_router()
+        rankings = ranking.rank_batch(
+            [lat if lat is not None else nan for _, _, lat, _, _, _, _ in parsed],
+            [lng if lng is not None else nan for _, _, _, lng, _, _, _ in parsed],
+            [requested_time for _, _, _, _, requested_time, _, _ in parsed],
+            [rider_id for _, rider_id, _, _, _, _, _ in parsed],
+            lats, lngs, [int(ride[5]) for ride in rides], [int(ride[6]) for ride in rides],
+            [ride[1] for ride in rides], MATCH_WINDOW,
+            k=None if router or any(limit is None for limit in limits) else max(limits),
+            dest_lats=dest_lats, dest_lngs=dest_lngs,
+            max_detour_minutes=[max_detour for *_, max_detour in parsed])
+
+        for (position, _, lat, lng, _, limit, max_detour), ranked in zip(parsed, rankings):
+            # as in request_ride, the limit applies after the road re-rank
+            routed = router is not None and lat is not None and lng is not None
+            order = ranked.order[:limit] if limit and not routed else ranked.order
+            candidates = [ride_candidate(rides[i], *values, *detour)
+                          for (i, *values), detour in zip(ranking.ranked_rows(ranked, order),
+                                                          ranking.detour_rows(ranked, order))]
+            if routed:
+                candidates = rank_by_road(router, lat, lng, candidates, limit, max_detour)
+            results[position] = {
+                "status": "200",
+                "message": f"Found {len(candidates)} matching rides",
+                "data": {"candidates": candidates, "count": len(candidates)}
+            }
+        return {"status": "200", "message": f"Matched {len(parsed)} queries", "data": {"results": results}}
+
+    except sqlite3.Error as e:
+        return {"status": "500", "message": f"Database error: {str(e)}"}
+    except Exception as e:
+        return {"status": "500", "message": f"Error: {str(e)}"}
+
+
 
 def get_my_rides_detailed(data):
     """
@@ -496,26 +625,25 @@ def get_my_rides_detailed(data):
         return {"status": "400", "message": "Missing userID"}
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        
-        query = '''
-            SELECT r.rideID, r.carId, r.sourceID, r.destinationID,
-                   r.startTime, r.endTime, r.scheduleID,
-                   zs.zoneName as source_name, zs.zoneX as source_lat, zs.zoneY as source_lng,
-                   zd.zoneName as dest_name, zd.zoneX as dest_lat, zd.zoneY as dest_lng,
-                   c.cartype, c.carPlate, c.capacity
-            FROM Ride r
-            LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
-            LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
-            LEFT JOIN Car c ON r.carId = c.carId
-            WHERE r.ownerID = ?
-            ORDER BY r.startTime
-        '''
-        
-        cur.execute(query, (user_id,))
-        rides = cur.fetchall()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+        
+            query = '''
+                SELECT r.rideID, r.carId, r.sourceID, r.destinationID,
+                       r.startTime, r.endTime, r.scheduleID,
+                       zs.zoneName as source_name, zs.zoneX as source_lat, zs.zoneY as source_lng,
+                       zd.zoneName as dest_name, zd.zoneX as dest_lat, zd.zoneY as dest_lng,
+                       c.cartype, c.carPlate, c.capacity
+                FROM Ride r
+                LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
+                LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
+                LEFT JOIN Car c ON r.carId = c.carId
+                WHERE r.ownerID = ?
+                ORDER BY r.startTime
+            '''
+        
+            cur.execute(query, (user_id,))
+            rides = cur.fetchall()
         
         rides_list = []
         for ride in rides:
@@ -563,11 +691,10 @@ def get_my_rides_detailed(data):
 def give_all_rides(data):
     userID = data.get("userID")
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM Ride WHERE ownerID=?', (userID,))
-        rides = cur.fetchall()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM Ride WHERE ownerID=?', (userID,))
+            rides = cur.fetchall()
         rides_list = []
         for ride in rides:
             rides_list.append({
@@ -587,11 +714,10 @@ def give_all_rides(data):
 def give_user_personal_informations(data):
     userID  = data.get("userID")
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        cur.execute('SELECT username, email, isDriver, aubID FROM "user" WHERE userID=?', (userID,))
-        user = cur.fetchone()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT username, email, isDriver, aubID FROM "user" WHERE userID=?', (userID,))
+            user = cur.fetchone()
         if user is None:
             return {"status": "404", "message": "User not found"}
         user_info = {
@@ -607,11 +733,10 @@ def give_user_personal_informations(data):
 def get_rating(data):
     userID = data.get("userID")
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        cur.execute('SELECT score, comment FROM Rating WHERE rateeID=?', (userID,))
-        ratings = cur.fetchall()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT score, comment FROM Rating WHERE rateeID=?', (userID,))
+            ratings = cur.fetchall()
         ratings_list = []
         average_score = 0
         for rating in ratings:
@@ -640,73 +765,68 @@ def submit_rating(data):
         return {"status": "400", "message": "Missing required fields"}
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        
-        # Convert usernames to user IDs
-        cur.execute('SELECT userID FROM "user" WHERE username=?', (rater_username,))
-        rater_result = cur.fetchone()
-        if not rater_result:
-            conn.close()
-            return {"status": "400", "message": "Rater user not found"}
-        rater_id = rater_result[0]
-        
-        cur.execute('SELECT userID FROM "user" WHERE username=?', (ratee_username,))
-        ratee_result = cur.fetchone()
-        if not ratee_result:
-            conn.close()
-            return {"status": "400", "message": "Ratee user not found"}
-        ratee_id = ratee_result[0]
-        
-        print(f"[BACKEND DEBUG] Converted to IDs: rater_id={rater_id}, ratee_id={ratee_id}")
-        
-        # Check if rating already exists for this ride
-        cur.execute('SELECT ratingID FROM Rating WHERE raterID=? AND rateeID=? AND rideID=?', 
-                   (rater_id, ratee_id, ride_id))
-        existing_rating = cur.fetchone()
-        
-        if existing_rating:
-            conn.close()
-            return {"status": "400", "message": "You have already rated this user for this ride"}
-        
-        # For chat-based ratings (fallback ride IDs), skip ride validation
-        # For real rides, validate they exist in the system
-        if not ride_id.startswith('chat_ride_'):
-            # Verify the ride exists in the Ride table
-            cur.execute('SELECT rideID FROM Ride WHERE rideID = ?', (ride_id,))
-            ride_exists = cur.fetchone()
-            if not ride_exists:
-                conn.close()
-                return {"status": "400", "message": "Ride not found in system"}
-        
-        # Convert score to integer (database expects INTEGER)
-        try:
-            score_int = int(float(score))  # Convert to float then to int
-            if score_int < 0 or score_int > 5:
-                conn.close()
-                return {"status": "400", "message": "Score must be between 0 and 5"}
-        except (ValueError, TypeError):
-            conn.close()
-            return {"status": "400", "message": "Invalid score format"}
+        with connection() as conn:
+            cur = conn.cursor()
+        
+            # Convert usernames to user IDs
+            cur.execute('SELECT userID FROM "user" WHERE username=?', (rater_username,))
+            rater_result = cur.fetchone()
+            if not rater_result:
+                return {"status": "400", "message": "Rater user not found"}
+            rater_id = rater_result[0]
+        
+            cur.execute('SELECT userID FROM "user" WHERE username=?', (ratee_username,))
+            ratee_result = cur.fetchone()
+            if not ratee_result:
+                return {"status": "400", "message": "Ratee user not found"}
+            ratee_id = ratee_result[0]
+        
+            print(f"[BACKEND DEBUG] Converted to IDs: rater_id={rater_id}, ratee_id={ratee_id}")
+        
+            # Check if rating already exists for this ride
+            cur.execute('SELECT ratingID FROM Rating WHERE raterID=? AND rateeID=? AND rideID=?', 
+                       (rater_id, ratee_id, ride_id))
+            existing_rating = cur.fetchone()
+        
+            if existing_rating:
+                return {"status": "400", "message": "You have already rated this user for this ride"}
+        
+            # For chat-based ratings (fallback ride IDs), skip ride validation
+            # For real rides, validate they exist in the system
+            if not ride_id.startswith('chat_ride_'):
+                # Verify the ride exists in the Ride table
+                cur.execute('SELECT rideID FROM Ride WHERE rideID = ?', (ride_id,))
+                ride_exists = cur.fetchone()
+                if not ride_exists:
+                    return {"status": "400", "message": "Ride not found in system"}
+        
+            # Convert score to integer (database expects INTEGER)
+            try:
+                score_int = int(float(score))  # Convert to float then to int
+                if score_int < 0 or score_int > 5:
+                    return {"status": "400", "message": "Score must be between 0 and 5"}
+            except (ValueError, TypeError):
+                return {"status": "400", "message": "Invalid score format"}
         
-        # Insert new rating
-        rating_id = f"rating_{int(time.time()*1000)}"
-        print(f"[BACKEND DEBUG] Inserting rating: ratingID={rating_id}, raterID={rater_id}, rateeID={ratee_id}, rideID={ride_id}, score={score_int}")
+            # Insert new rating
+            rating_id = f"rating_{id_generator.next_id()}"
+            print(f"[BACKEND DEBUG] Inserting rating: ratingID={rating_id}, raterID={rater_id}, rateeID={ratee_id}, rideID={ride_id}, score={score_int}")
         
-        cur.execute('INSERT INTO Rating (ratingID, raterID, rateeID, rideID, score, comment) VALUES (?, ?, ?, ?, ?, ?)',
-                   (rating_id, rater_id, ratee_id, ride_id, score_int, comment))
+            cur.execute('INSERT INTO Rating (ratingID, raterID, rateeID, rideID, score, comment) VALUES (?, ?, ?, ?, ?, ?)',
+                       (rating_id, rater_id, ratee_id, ride_id, score_int, comment))
         
-        conn.commit()
+            conn.commit()
         
-        # Verify the rating was inserted
-        cur.execute('SELECT * FROM Rating WHERE ratingID=?', (rating_id,))
-        inserted_rating = cur.fetchone()
-        print(f"[BACKEND DEBUG] Rating inserted: {inserted_rating is not None}")
+            # Verify the rating was inserted
+            cur.execute('SELECT * FROM Rating WHERE ratingID=?', (rating_id,))
+            inserted_rating = cur.fetchone()
+            print(f"[BACKEND DEBUG] Rating inserted: {inserted_rating is not None}")
         
-        conn.close()
         
         return {"status": "200", "message": "Rating submitted successfully"}
     
+    except id_generator.NoWorkerId as e:
+        return id_generator.unavailable(e)
     except sqlite3.Error as e:
         print(f"[BACKEND DEBUG] Database error: {str(e)}")
         return {"status": "500", "message": f"Database error: {str(e)}"}
@@ -719,26 +839,30 @@ def update_zone(data):
     zoneY = data.get("zoneY")
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        
-        # Check if zone exists for user
-        cur.execute('SELECT zoneID FROM Zone WHERE UserID=?', (userID,))
-        existing_zone = cur.fetchone()
-        
-        if existing_zone:
-            # Update existing zone
-            cur.execute('UPDATE Zone SET zoneName=?, zoneX=?, zoneY=? WHERE UserID=?', (zone, float(zoneX), float(zoneY), userID))
-        else:
-            # Create new zone entry
-            zone_id = f"zone_{int(time.time()*1000)}"
-            cur.execute('INSERT INTO Zone (zoneID, zoneX, zoneY, zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
-                       (zone_id, float(zoneX), float(zoneY), zone, userID))
+        with connection() as conn:
+            cur = conn.cursor()
+        
+            # Check if zone exists for user
+            cur.execute('SELECT zoneID FROM Zone WHERE UserID=?', (userID,))
+            existing_zone = cur.fetchone()
+        
+            if existing_zone:
+                # Update existing zone
+                cur.execute('UPDATE Zone SET zoneName=?, zoneX=?, zoneY=? WHERE UserID=?', (zone, float(zoneX), float(zoneY), userID))
+                conn.commit()
+                cur.execute('SELECT zoneID FROM Zone WHERE UserID=?', (userID,))
+                ride_index.refresh_zones(conn, [row[0] for row in cur.fetchall()])
+            else:
+                # Create new zone entry
+                zone_id = f"zone_{id_generator.next_id()}"
+                cur.execute('INSERT INTO Zone (zoneID, zoneX, zoneY, zoneName, UserID) VALUES (?, ?, ?, ?, ?)', 
+                           (zone_id, float(zoneX), float(zoneY), zone, userID))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         return {"status": "200", "message": "Zone updated successfully"}
     
+    except id_generator.NoWorkerId as e:
+        return id_generator.unavailable(e)
     except sqlite3.Error as e:
         return {"status": "400", "message": f"Database error: {str(e)}"}
 
@@ -747,11 +871,10 @@ def get_zone(data):
     userID = data.get("userID")
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        cur.execute('SELECT zoneName FROM Zone WHERE UserID=?', (userID,))
-        zone_result = cur.fetchone()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT zoneName FROM Zone WHERE UserID=?', (userID,))
+            zone_result = cur.fetchone()
         
         if zone_result:
             return {"status": "200", "data": {"zoneName": zone_result[0]}}
@@ -766,11 +889,10 @@ def get_cars(data):
     userID = data.get("userID")
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        cur.execute('SELECT carId, cartype, carPlate, capacity FROM Car WHERE ownerID=?', (userID,))
-        cars = cur.fetchall()
-        conn.close()
+        with connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT carId, cartype, carPlate, capacity FROM Car WHERE ownerID=?', (userID,))
+            cars = cur.fetchall()
         
         cars_list = []
         for car in cars:
@@ -794,26 +916,26 @@ def add_car(data):
     capacity = data.get("capacity")
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
+        with connection() as conn:
+            cur = conn.cursor()
         
-        # Check if car plate already exists
-        cur.execute('SELECT carId FROM Car WHERE carPlate=?', (car_plate,))
-        existing_car = cur.fetchone()
+            # Check if car plate already exists
+            cur.execute('SELECT carId FROM Car WHERE carPlate=?', (car_plate,))
+            existing_car = cur.fetchone()
         
-        if existing_car:
-            conn.close()
-            return {"status": "400", "message": "Car with this plate already exists"}
+            if existing_car:
+                return {"status": "400", "message": "Car with this plate already exists"}
         
-        # Create new car
-        car_id = f"car_{int(time.time()*1000)}"
-        cur.execute('INSERT INTO Car (carId, cartype, carPlate, capacity, ownerID) VALUES (?, ?, ?, ?, ?)',
-                   (car_id, car_type, car_plate, capacity, userID))
+            # Create new car
+            car_id = f"car_{id_generator.next_id()}"
+            cur.execute('INSERT INTO Car (carId, cartype, carPlate, capacity, ownerID) VALUES (?, ?, ?, ?, ?)',
+                       (car_id, car_type, car_plate, capacity, userID))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         return {"status": "200", "message": "Car added successfully", "carId": car_id}
     
+    except id_generator.NoWorkerId as e:
+        return id_generator.unavailable(e)
     except sqlite3.Error as e:
         return {"status": "400", "message": f"Database error: {str(e)}"}
     
@@ -826,31 +948,28 @@ def update_car(data):
     capacity = data.get("capacity")
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
+        with connection() as conn:
+            cur = conn.cursor()
         
-        # Check if user owns this car
-        cur.execute('SELECT ownerID FROM Car WHERE carId=?', (car_id,))
-        car_owner = cur.fetchone()
+            # Check if user owns this car
+            cur.execute('SELECT ownerID FROM Car WHERE carId=?', (car_id,))
+            car_owner = cur.fetchone()
         
-        if not car_owner or car_owner[0] != userID:
-            conn.close()
-            return {"status": "403", "message": "You don't own this car"}
+            if not car_owner or car_owner[0] != userID:
+                return {"status": "403", "message": "You don't own this car"}
         
-        # Check if new plate already exists (excluding current car)
-        cur.execute('SELECT carId FROM Car WHERE carPlate=? AND carId!=?', (car_plate, car_id))
-        existing_car = cur.fetchone()
+            # Check if new plate already exists (excluding current car)
+            cur.execute('SELECT carId FROM Car WHERE carPlate=? AND carId!=?', (car_plate, car_id))
+            existing_car = cur.fetchone()
         
-        if existing_car:
-            conn.close()
-            return {"status": "400", "message": "Car with this plate already exists"}
+            if existing_car:
+                return {"status": "400", "message": "Car with this plate already exists"}
         
-        # Update car
-        cur.execute('UPDATE Car SET cartype=?, carPlate=?, capacity=? WHERE carId=?', 
-                   (car_type, car_plate, capacity, car_id))
+            # Update car
+            cur.execute('UPDATE Car SET cartype=?, carPlate=?, capacity=? WHERE carId=?', 
+                       (car_type, car_plate, capacity, car_id))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         return {"status": "200", "message": "Car updated successfully"}
     
     except sqlite3.Error as e:
@@ -862,52 +981,214 @@ def remove_car(data):
     car_id = data.get("carId")
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
+        with connection() as conn:
+            cur = conn.cursor()
         
-        # Check if user owns this car
-        cur.execute('SELECT ownerID FROM Car WHERE carId=?', (car_id,))
-        car_owner = cur.fetchone()
+            # Check if user owns this car
+            cur.execute('SELECT ownerID FROM Car WHERE carId=?', (car_id,))
+            car_owner = cur.fetchone()
         
-        if not car_owner or car_owner[0] != userID:
-            conn.close()
-            return {"status": "403", "message": "You don't own this car"}
+            if not car_owner or car_owner[0] != userID:
+                return {"status": "403", "message": "You don't own this car"}
         
-        # Check if car is used in any rides
-        cur.execute('SELECT rideID FROM Ride WHERE carId=?', (car_id,))
-        active_rides = cur.fetchall()
+            # Check if car is used in any rides
+            cur.execute('SELECT rideID FROM Ride WHERE carId=?', (car_id,))
+            active_rides = cur.fetchall()
         
-        if active_rides:
-            conn.close()
-            return {"status": "400", "message": "Cannot remove car that has active rides"}
+            if active_rides:
+                return {"status": "400", "message": "Cannot remove car that has active rides"}
         
-        # Remove car
-        cur.execute('DELETE FROM Car WHERE carId=?', (car_id,))
+            # Remove car
+            cur.execute('DELETE FROM Car WHERE carId=?', (car_id,))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         return {"status": "200", "message": "Car removed successfully"}
     
     except sqlite3.Error as e:
         return {"status": "400", "message": f"Database error: {str(e)}"}
 
 
+def parse_cursor(data):
+    """The "since" cursor of a delta request, None when the full list is wanted"""
+    since = data.get("since")
+    return None if since is None else int(since)
+
+
+def changelog_window(cur, since):
+    """
+    (cursor, full) for a list request: the newest ChangeLog seq, and whether the
+    full list must be sent because `since` is absent, ahead of the log (the
+    database was replaced) or older than the pruned part of it. Writers are
+    serialized, so every change up to the returned cursor is already committed.
+    """
+    cur.execute('SELECT MAX(seq) FROM ChangeLog')
+    cursor = cur.fetchone()[0] or 0
+    if since is None or since > cursor:
+        return cursor, True
+    cur.execute('SELECT MIN(seq) FROM ChangeLog')
+    oldest = cur.fetchone()[0]
+    return cursor, oldest is not None and since < oldest - 1
+
+
+def split_delta(changes, visible):
+    """
+    Sort the changed requestIDs into inserted/updated/deleted. `changes` maps
+    requestID -> True if it was inserted since the cursor, `visible` holds the
+    current list entries of the changed requests.
+    """
+    inserted, updated = [], []
+    for item in visible:
+        (inserted if changes.get(item["requestID"]) else updated).append(item)
+    shown = {item["requestID"] for item in visible}
+    deleted = sorted(request_id for request_id in changes if request_id not in shown)
+    return {"inserted": inserted, "updated": updated, "deleted": deleted}
+
+
+def driver_request_item(row):
+    """One get_requests entry from a driver request row"""
+    area = f"{row[9]} → {row[10]}" if row[9] and row[10] else "Unknown route"
+    return {
+        "requestID": row[0],
+        "riderID": row[1],
+        "rideID": row[2],
+        "status": row[3] or "pending",
+        "reqTime": row[4] or "N/A",
+        "rider_username": row[5],
+        "rider_email": row[6],
+        "area": area
+    }
+
+
+def accepted_request_item(row):
+    """One check_passenger_requests entry from an accepted request row"""
+    route = f"{row[7]} → {row[8]}" if row[7] and row[8] else "Unknown route"
+    return {
+        "requestID": row[0],
+        "rideID": row[1],
+        "status": row[2],
+        "driver_username": row[3],
+        "driver_email": row[4],
+        "driver_ip": row[9] or "Not available",
+        "route": route
+    }
+
+
+def request_sent_events(cur, request_id, driver_id):
+    """Events announcing a new request to the driver's subscribed connections, published after commit"""
+    if not notifications.wants("driver", driver_id):
+        return []
+    cur.execute('''
+        SELECT req.requestID, req.riderID, req.rideID, req.status, req.requestTime,
+               u.username as rider_username, u.email as rider_email,
+               r.sourceID, r.destinationID,
+               zs.zoneName as source_name, zd.zoneName as dest_name
+        FROM Request req
+        JOIN Ride r ON req.rideID = r.rideID
+        JOIN "user" u ON req.riderID = u.userID
+        LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
+        LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
+        WHERE req.requestID = ?
+    ''', (request_id,))
+    row = cur.fetchone()
+    return [("driver", driver_id, "ride_request", driver_request_item(row))] if row else []
+
+
+def request_accepted_events(cur, request_id, rider_id, driver_id):
+    """Events telling the passenger their request was accepted and the driver's sessions that it left the queue"""
+    events = []
+    if notifications.wants("driver", driver_id):
+        events.append(("driver", driver_id, "request_updated", {"requestID": request_id, "status": "accepted"}))
+    if not notifications.wants("rider", rider_id):
+        return events
+    cur.execute('''
+        SELECT req.requestID, req.rideID, req.status,
+               u.username as driver_username, u.email as driver_email,
+               r.sourceID, r.destinationID,
+               zs.zoneName as source_name, zd.zoneName as dest_name,
+               ip.userCurrentIP as driver_ip
+        FROM Request req
+        JOIN Ride r ON req.rideID = r.rideID
+        JOIN "user" u ON r.ownerID = u.userID
+        LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
+        LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
+        LEFT JOIN IpInfos ip ON u.userID = ip.userID
+        WHERE req.requestID = ?
+    ''', (request_id,))
+    row = cur.fetchone()
+    if row:
+        events.append(("rider", rider_id, "request_accepted", accepted_request_item(row)))
+    return events
+
+
 def get_driver_requests(data):
+
     """
     Get all pending ride requests for a driver
-    Returns list of requests with rider info and ride details
+    Returns list of requests with rider info and ride details.
+    With "since": <cursor> only the requests inserted/updated/deleted after
+    that cursor are returned; every response carries the cursor to send next.
     """
     driver_userid = data.get("driver_userid")
     
     if not driver_userid:
         return {"status": "400", "message": "Missing driver_userid"}
+    try:
+        since = parse_cursor(data)
+    except (TypeError, ValueError):
+        return {"status": "400", "message": "since must be an integer cursor"}
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
+        with connection() as conn:
+            cur = conn.cursor()
+            cursor, full = changelog_window(cur, since)
+        
+            if not full:
+                return get_driver_request_changes(cur, driver_userid, since, cursor)
+        
+            # Get all pending requests for rides owned by this driver
+            query = '''
+                SELECT req.requestID, req.riderID, req.rideID, req.status, req.requestTime,
+                       u.username as rider_username, u.email as rider_email,
+                       r.sourceID, r.destinationID,
+                       zs.zoneName as source_name, zd.zoneName as dest_name
+                FROM Request req
+                JOIN Ride r ON req.rideID = r.rideID
+                JOIN "user" u ON req.riderID = u.userID
+                LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
+                LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
+                WHERE r.ownerID = ? AND (req.status = 'pending' OR req.status IS NULL)
+                ORDER BY req.requestTime DESC
+            '''
+        
+            cur.execute(query, (driver_userid,))
+            rows = cur.fetchall()
+        
+            requests = [driver_request_item(row) for row in rows]
         
-        # Get all pending requests for rides owned by this driver
-        query = '''
+        return {
+            "status": "200",
+            "requests": requests,
+            "count": len(requests),
+            "cursor": cursor,
+            "full": True
+        }
+    
+    except sqlite3.Error as e:
+        return {"status": "500", "message": f"Database error: {str(e)}"}
+
+
+def get_driver_request_changes(cur, driver_userid, since, cursor):
+    """get_requests delta: the driver's requests that changed in (since, cursor]"""
+    cur.execute('''
+        SELECT rowKey, MAX(op = 'insert')
+        FROM ChangeLog
+        WHERE ownerID = ? AND seq > ? AND seq <= ? AND tableName = 'Request'
+        GROUP BY rowKey
+    ''', (driver_userid, since, cursor))
+    changes = dict(cur.fetchall())
+    visible = []
+    if changes:
+        cur.execute('''
             SELECT req.requestID, req.riderID, req.rideID, req.status, req.requestTime,
                    u.username as rider_username, u.email as rider_email,
                    r.sourceID, r.destinationID,
@@ -917,36 +1198,16 @@ def get_driver_requests(data):
             JOIN "user" u ON req.riderID = u.userID
             LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
             LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
-            WHERE r.ownerID = ? AND (req.status = 'pending' OR req.status IS NULL)
+            WHERE req.requestID IN (
+                SELECT rowKey FROM ChangeLog
+                WHERE ownerID = ? AND seq > ? AND seq <= ? AND tableName = 'Request'
+            )
+            AND r.ownerID = ? AND (req.status = 'pending' OR req.status IS NULL)
             ORDER BY req.requestTime DESC
-        '''
-        
-        cur.execute(query, (driver_userid,))
-        rows = cur.fetchall()
-        
-        requests = []
-        for row in rows:
-            area = f"{row[9]} → {row[10]}" if row[9] and row[10] else "Unknown route"
-            requests.append({
-                "requestID": row[0],
-                "riderID": row[1],
-                "rideID": row[2],
-                "status": row[3] or "pending",
-                "reqTime": row[4] or "N/A",
-                "rider_username": row[5],
-                "rider_email": row[6],
-                "area": area
-            })
-        
-        conn.close()
-        return {
-            "status": "200",
-            "requests": requests,
-            "count": len(requests)
-        }
-    
-    except sqlite3.Error as e:
-        return {"status": "500", "message": f"Database error: {str(e)}"}
+        ''', (driver_userid, since, cursor, driver_userid))
+        visible = [driver_request_item(row) for row in cur.fetchall()]
+    delta = split_delta(changes, visible)
+    return {"status": "200", "cursor": cursor, "full": False, "count": len(changes), **delta}
 
 
 def accept_ride_request(data):
@@ -961,82 +1222,67 @@ def accept_ride_request(data):
         return {"status": "400", "message": "Missing required fields"}
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
-        
-        # Verify the request exists and belongs to a ride owned by this driver
-        cur.execute('''
-            SELECT req.requestID, req.riderID, req.rideID, r.ownerID
-            FROM Request req
-            JOIN Ride r ON req.rideID = r.rideID
-            WHERE req.requestID = ?
-        ''', (request_id,))
-        
-        request_data = cur.fetchone()
-        
-        if not request_data:
-            conn.close()
-            return {"status": "404", "message": "Request not found"}
-        
-        if request_data[3] != driver_userid:
-            conn.close()
-            return {"status": "403", "message": "You don't own this ride"}
-        
-        rider_id = request_data[1]
-        ride_id = request_data[2]
-        
-        # Check ride capacity before accepting
-        cur.execute('''
-            SELECT c.capacity, r.carId
-            FROM Ride r
-            JOIN Car c ON r.carId = c.carId
-            WHERE r.rideID = ?
-        ''', (ride_id,))
-        
-        capacity_data = cur.fetchone()
-        
-        if not capacity_data:
-            conn.close()
-            return {"status": "400", "message": "Car information not found for this ride"}
-        
-        max_capacity = capacity_data[0]
-        
-        # Count current riders (excluding driver)
-        cur.execute('SELECT COUNT(*) FROM Rider WHERE rideID = ?', (ride_id,))
-        current_riders = cur.fetchone()[0]
-        
-        if current_riders >= max_capacity:
-            conn.close()
-            return {
-                "status": "400", 
-                "message": f"Ride is at full capacity ({max_capacity} passengers)"
-            }
-        
-        # Update request status to accepted
-        cur.execute('UPDATE Request SET status = ? WHERE requestID = ?', 
-                   ('accepted', request_id))
+        with connection() as conn:
+            cur = conn.cursor()
+            # take the write lock now: the seat check and the accept must not interleave with another accept
+            cur.execute("BEGIN IMMEDIATE")
+        
+            # Verify the request exists and belongs to a ride owned by this driver
+            cur.execute('''
+                SELECT req.requestID, req.riderID, req.rideID, r.ownerID, c.capacity
+                FROM Request req
+                JOIN Ride r ON req.rideID = r.rideID
+                LEFT JOIN Car c ON r.carId = c.carId
+                WHERE req.requestID = ?
+            ''', (request_id,))
+        
+            request_data = cur.fetchone()
+        
+            if not request_data:
+                conn.rollback()
+                return {"status": "404", "message": "Request not found"}
+        
+            if request_data[3] != driver_userid:
+                conn.rollback()
+                return {"status": "403", "message": "You don't own this ride"}
+        
+            rider_id = request_data[1]
+            ride_id = request_data[2]
+            max_capacity = request_data[4]
+        
+            # Reserve a seat (no-op if the rider already has one on this ride)
+            seat = seats.reserve_seat(conn, ride_id, rider_id)
+        
+            if seat == seats.NO_CAR:
+                conn.rollback()
+                return {"status": "400", "message": "Car information not found for this ride"}
+        
+            if seat == seats.FULL:
+                conn.rollback()
+                return {
+                    "status": "400", 
+                    "message": f"Ride is at full capacity ({max_capacity} passengers)"
+                }
         
-        # Add rider to the ride in Rider table
-        try:
-            cur.execute('INSERT INTO Rider (userID, rideID) VALUES (?, ?)', 
-                       (rider_id, ride_id))
-        except sqlite3.IntegrityError:
-            # Rider already added to this ride
-            pass
+            # Update request status to accepted
+            cur.execute('UPDATE Request SET status = ? WHERE requestID = ?', 
+                       ('accepted', request_id))
         
-        # Get passenger details for P2P chat
-        cur.execute('''
-            SELECT u.username, u.email, ip.userCurrentIP
-            FROM "user" u
-            LEFT JOIN IpInfos ip ON u.userID = ip.userID
-            WHERE u.userID = ?
-        ''', (rider_id,))
+            # Get passenger details for P2P chat
+            cur.execute('''
+                SELECT u.username, u.email, ip.userCurrentIP
+                FROM "user" u
+                LEFT JOIN IpInfos ip ON u.userID = ip.userID
+                WHERE u.userID = ?
+            ''', (rider_id,))
         
-        passenger_data = cur.fetchone()
+            passenger_data = cur.fetchone()
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            events = request_accepted_events(cur, request_id, rider_id, driver_userid)
         
+        # pushed once the pooled connection is back in the pool
+        notifications.publish_all(events)
         if passenger_data:
             return {
                 "status": "200",
@@ -1068,56 +1314,54 @@ def send_ride_request_to_driver(data):
         return {"status": "400", "message": "Missing required fields"}
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
+        with connection() as conn:
+            cur = conn.cursor()
         
-        # Verify the ride exists
-        cur.execute('SELECT rideID, ownerID FROM Ride WHERE rideID = ?', (ride_id,))
-        ride_data = cur.fetchone()
+            # Verify the ride exists
+            cur.execute('SELECT rideID, ownerID FROM Ride WHERE rideID = ?', (ride_id,))
+            ride_data = cur.fetchone()
         
-        if not ride_data:
-            conn.close()
-            return {"status": "404", "message": "Ride not found"}
+            if not ride_data:
+                return {"status": "404", "message": "Ride not found"}
         
-        driver_id = ride_data[1]
+            driver_id = ride_data[1]
         
-        # Check if request already exists
-        cur.execute('''
-            SELECT requestID, status FROM Request 
-            WHERE riderID = ? AND rideID = ?
-        ''', (rider_id, ride_id))
-        
-        existing_request = cur.fetchone()
-        
-        if existing_request:
-            if existing_request[1] == 'accepted':
-                conn.close()
-                return {"status": "400", "message": "You already have an accepted request for this ride"}
-            elif existing_request[1] == 'pending':
-                conn.close()
-                return {"status": "400", "message": "You already sent a request for this ride"}
-        
-        # Generate unique request ID
-        import uuid
-        import time
-        request_id = f"REQ_{rider_id}_{ride_id}_{int(time.time())}"
-        current_timestamp = int(time.time())
-        
-        # Create new request
-        cur.execute('''
-            INSERT INTO Request (requestID, riderID, rideID, status, requestTime)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (request_id, rider_id, ride_id, 'pending', current_timestamp))
+            # Check if request already exists
+            cur.execute('''
+                SELECT requestID, status FROM Request 
+                WHERE riderID = ? AND rideID = ?
+            ''', (rider_id, ride_id))
+        
+            existing_request = cur.fetchone()
+        
+            if existing_request:
+                if existing_request[1] == 'accepted':
+                    return {"status": "400", "message": "You already have an accepted request for this ride"}
+                elif existing_request[1] == 'pending':
+                    return {"status": "400", "message": "You already sent a request for this ride"}
         
-        conn.commit()
-        conn.close()
+            # Generate unique request ID
+            request_id = f"REQ_{id_generator.next_id()}"
+            current_timestamp = int(time.time())
+        
+            # Create new request
+            cur.execute('''
+                INSERT INTO Request (requestID, riderID, rideID, status, requestTime)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (request_id, rider_id, ride_id, 'pending', current_timestamp))
+        
+            conn.commit()
+            events = request_sent_events(cur, request_id, driver_id)
         
+        notifications.publish_all(events)
         return {
             "status": "200",
             "message": "Ride request sent successfully",
             "requestID": request_id
         }
     
+    except id_generator.NoWorkerId as e:
+        return id_generator.unavailable(e)
     except sqlite3.Error as e:
         return {"status": "500", "message": f"Database error: {str(e)}"}
 
@@ -1125,19 +1369,73 @@ def send_ride_request_to_driver(data):
 def check_passenger_accepted_requests(data):
     """
     Check if any of passenger's requests have been accepted by drivers
-    Returns list of newly accepted requests with driver info
+    Returns list of newly accepted requests with driver info.
+    With "since": <cursor> only the accepted requests inserted/updated/deleted
+    after that cursor are returned, like get_requests.
     """
     rider_id = data.get("riderID")
     
     if not rider_id:
         return {"status": "400", "message": "Missing riderID"}
+    try:
+        since = parse_cursor(data)
+    except (TypeError, ValueError):
+        return {"status": "400", "message": "since must be an integer cursor"}
     
     try:
-        conn = sqlite3.connect('aubus.db')
-        cur = conn.cursor()
+        with connection() as conn:
+            cur = conn.cursor()
+            cursor, full = changelog_window(cur, since)
+        
+            if not full:
+                return get_accepted_request_changes(cur, rider_id, since, cursor)
+        
+            # Get all accepted requests for this passenger
+            query = '''
+                SELECT req.requestID, req.rideID, req.status,
+                       u.username as driver_username, u.email as driver_email,
+                       r.sourceID, r.destinationID,
+                       zs.zoneName as source_name, zd.zoneName as dest_name,
+                       ip.userCurrentIP as driver_ip
+                FROM Request req
+                JOIN Ride r ON req.rideID = r.rideID
+                JOIN "user" u ON r.ownerID = u.userID
+                LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
+                LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
+                LEFT JOIN IpInfos ip ON u.userID = ip.userID
+                WHERE req.riderID = ? AND req.status = 'accepted'
+                ORDER BY req.requestTime DESC
+            '''
+        
+            cur.execute(query, (rider_id,))
+            rows = cur.fetchall()
+        
+            accepted_requests = [accepted_request_item(row) for row in rows]
         
-        # Get all accepted requests for this passenger
-        query = '''
+        return {
+            "status": "200",
+            "accepted_requests": accepted_requests,
+            "count": len(accepted_requests),
+            "cursor": cursor,
+            "full": True
+        }
+    
+    except sqlite3.Error as e:
+        return {"status": "500", "message": f"Database error: {str(e)}"}
+
+
+def get_accepted_request_changes(cur, rider_id, since, cursor):
+    """check_passenger_requests delta: the passenger's requests that changed in (since, cursor]"""
+    cur.execute('''
+        SELECT rowKey, MAX(op = 'insert')
+        FROM ChangeLog
+        WHERE riderID = ? AND seq > ? AND seq <= ? AND tableName = 'Request'
+        GROUP BY rowKey
+    ''', (rider_id, since, cursor))
+    changes = dict(cur.fetchall())
+    visible = []
+    if changes:
+        cur.execute('''
             SELECT req.requestID, req.rideID, req.status,
                    u.username as driver_username, u.email as driver_email,
                    r.sourceID, r.destinationID,
@@ -1149,32 +1447,13 @@ def check_passenger_accepted_requests(data):
             LEFT JOIN Zone zs ON r.sourceID = zs.zoneID
             LEFT JOIN Zone zd ON r.destinationID = zd.zoneID
             LEFT JOIN IpInfos ip ON u.userID = ip.userID
-            WHERE req.riderID = ? AND req.status = 'accepted'
+            WHERE req.requestID IN (
+                SELECT rowKey FROM ChangeLog
+                WHERE riderID = ? AND seq > ? AND seq <= ? AND tableName = 'Request'
+            )
+            AND req.riderID = ? AND req.status = 'accepted'
             ORDER BY req.requestTime DESC
-        '''
-        
-        cur.execute(query, (rider_id,))
-        rows = cur.fetchall()
-        
-        accepted_requests = []
-        for row in rows:
-            route = f"{row[7]} → {row[8]}" if row[7] and row[8] else "Unknown route"
-            accepted_requests.append({
-                "requestID": row[0],
-                "rideID": row[1],
-                "status": row[2],
-                "driver_username": row[3],
-                "driver_email": row[4],
-                "driver_ip": row[9] or "Not available",
-                "route": route
-            })
-        
-        conn.close()
-        return {
-            "status": "200",
-            "accepted_requests": accepted_requests,
-            "count": len(accepted_requests)
-        }
-    
-    except sqlite3.Error as e:
-        return {"status": "500", "message": f"Database error: {str(e)}"}
\ No newline at end of file
+        ''', (rider_id, since, cursor, rider_id))
+        visible = [accepted_request_item(row) for row in cur.fetchall()]
+    delta = split_delta(changes, visible)
+    return {"status": "200", "cursor": cursor, "full": False, "count": len(changes), **delta}
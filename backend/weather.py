@@ -1,8 +1,39 @@
 import json
+import math
+import os
 import sqlite3
+import sys
 import time
 import requests
 
+# http_client is shared with the frontend and lives in ../common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import http_client
+from ttl_cache import TTLCache
+
+# Weather lookups go through a cache keyed by a CELL_DEG grid cell (about
+# 1 km): everyone clicking around campus shares one OpenWeatherMap call per
+# cell every WEATHER_TTL seconds. For WEATHER_STALE more seconds the last
+# reading is served at once while one refresh runs in the background, and
+# concurrent misses for the same cell wait for a single upstream call. While
+# OpenWeatherMap fails (or http_client's breaker has it cut off), the last
+# reading of a cell keeps being served for up to WEATHER_ERROR_GRACE seconds.
+
+WEATHER_URL = os.environ.get("AUBUS_WEATHER_URL", "https://api.openweathermap.org/data/2.5/weather")
+WEATHER_TIMEOUT = 5.0
+WEATHER_TTL = 600
+WEATHER_STALE = 1800
+WEATHER_ERROR_GRACE = 6 * 3600
+CELL_DEG = 0.01
+
+
+class WeatherError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
 def get_weather_api_key():
     try:
         with open('.env', 'r') as f:
@@ -16,6 +47,25 @@ def get_weather_api_key():
 
 WEATHER_API_KEY = get_weather_api_key()
 
+weather_cache = TTLCache(WEATHER_TTL, WEATHER_STALE, error_grace=WEATHER_ERROR_GRACE)
+
+
+def weather_cell(latitude, longitude):
+    return (math.floor(latitude / CELL_DEG), math.floor(longitude / CELL_DEG))
+
+
+def fetch_weather(latitude, longitude):
+    """One OpenWeatherMap call; raises WeatherError so that failures are never cached"""
+    params = {"lat": latitude, "lon": longitude, "appid": WEATHER_API_KEY, "units": "metric"}
+    try:
+        response = http_client.get(WEATHER_URL, params=params, timeout=WEATHER_TIMEOUT)
+    except requests.RequestException as e:
+        raise WeatherError("500", f"Error connecting to weather service: {str(e)}")
+    if response.status_code != 200:
+        raise WeatherError(str(response.status_code), "Failed to retrieve weather data")
+    return response.json()
+
+
 def get_weather_info(data):
     latitude = data.get("latitude")
     longitude = data.get("longitude")
@@ -24,14 +74,12 @@ def get_weather_info(data):
     if latitude is None or longitude is None:
         return {"status": "400", "message": "Missing latitude or longitude"}
     try:
-        url = f"https://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={WEATHER_API_KEY}&units=metric"
-        response = requests.get(url)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return {"status": str(response.status_code), "message": "Failed to retrieve weather data"}
-    except requests.RequestException as e:
-        return {"status": "500", "message": f"Error connecting to weather service: {str(e)}"}
-
-
-
+        cell = weather_cell(float(latitude), float(longitude))
+    except (TypeError, ValueError):
+        return {"status": "400", "message": "latitude and longitude must be numbers"}
+    # ask for the middle of the cell, so the cached reading does not depend on who missed first
+    center = ((cell[0] + 0.5) * CELL_DEG, (cell[1] + 0.5) * CELL_DEG)
+    try:
+        return weather_cache.get(cell, lambda: fetch_weather(*center))
+    except WeatherError as e:
+        return {"status": e.status, "message": e.message}
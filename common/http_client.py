@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Outbound HTTP for the external APIs (OpenWeatherMap, Google Maps).
+#
+# One requests.Session per process keeps connections to each host alive, so
+# repeated calls skip the TCP and TLS handshakes. Per host:
+#   - at most MAX_PER_HOST calls run at once; a caller waits up to
+#     SLOT_TIMEOUT seconds for a slot and then fails fast,
+#   - every call has a (connect, read) timeout,
+#   - a circuit breaker watches the last BREAKER_WINDOW calls. When at least
+#     BREAKER_MIN_CALLS of them ran and BREAKER_THRESHOLD of them failed
+#     (connection errors, timeouts, 5xx, 429), it opens and every call fails at
+#     once for BREAKER_OPEN_SECONDS. Then one trial call is let through: if it
+#     succeeds the breaker closes, otherwise it stays open for another period.
+# Failing fast raises UpstreamUnavailable, a requests.RequestException, so
+# callers that already handle requests errors need no change; callers with a
+# cache serve their last good value instead.
+
+MAX_PER_HOST = 8
+SLOT_TIMEOUT = 2.0
+TIMEOUT = (3.05, 10.0)
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_THRESHOLD = 0.5
+BREAKER_OPEN_SECONDS = 30.0
+
+
+class UpstreamUnavailable(requests.RequestException):
+    """The call was not attempted: the host's circuit is open or all its slots are busy"""
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS, threshold=BREAKER_THRESHOLD,
+                 open_seconds=BREAKER_OPEN_SECONDS, clock=time.monotonic):
+        self.min_calls = min_calls
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._results = deque(maxlen=window)   # True for a good call
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._trial_running = False
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow(self):
+        """True if a call may go out now"""
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.open_seconds:
+                self._state = self.HALF_OPEN
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def cancel(self):
+        """The call allow() let through was not made after all"""
+        with self._lock:
+            self._trial_running = False
+
+    def record(self, ok):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._trial_running = False
+                if ok:
+                    self._state = self.CLOSED
+                    self._results.clear()
+                else:
+                    self._state, self._opened_at = self.OPEN, self._clock()
+                return
+            self._results.append(ok)
+            failures = self._results.count(False)
+            if (self._state == self.CLOSED and len(self._results) >= self.min_calls
+                    and failures >= self.threshold * len(self._results)):
+                self._state, self._opened_at = self.OPEN, self._clock()
+
+
+class HttpClient:
+    def __init__(self, max_per_host=MAX_PER_HOST, timeout=TIMEOUT, slot_timeout=SLOT_TIMEOUT,
+                 breaker_factory=CircuitBreaker):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.slot_timeout = slot_timeout
+        self._breaker_factory = breaker_factory
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max_per_host, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._hosts = {}   # host -> (semaphore, breaker)
+        self.calls = 0
+        self.failures = 0
+
+    def _host(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = (threading.BoundedSemaphore(self.max_per_host), self._breaker_factory())
+            return host, self._hosts[host]
+
+    def breaker(self, url):
+        return self._host(url)[1][1]
+
+    def get(self, url, params=None, timeout=None):
+        host, (slots, breaker) = self._host(url)
+        if not breaker.allow():
+            raise UpstreamUnavailable(f"{host} is failing, not calling it for now")
+        if not slots.acquire(timeout=self.slot_timeout):
+            breaker.cancel()
+            raise UpstreamUnavailable(f"too many calls to {host} in progress")
+        if breaker.state == breaker.OPEN:   # it opened while this call waited for a slot
+            slots.release()
+            raise UpstreamUnavailable(f"{host} is failing, not calling it for now")
+        try:
+            response = self.session.get(url, params=params, timeout=timeout or self.timeout)
+        except Exception:
+            breaker.record(False)
+            with self._lock:
+                self.calls += 1
+                self.failures += 1
+            raise
+        finally:
+            slots.release()
+        ok = response.status_code < 500 and response.status_code != 429
+        breaker.record(ok)
+        with self._lock:
+            self.calls += 1
+            self.failures += not ok
+        return response
+
+    def stats(self):
+        with self._lock:
+            hosts = dict(self._hosts)
+            calls, failures = self.calls, self.failures
+        return {"calls": calls, "failures": failures,
+                "hosts": {host: {"state": breaker.state, "rejected": breaker.rejected}
+                          for host, (_, breaker) in hosts.items()}}
+
+
+client = HttpClient()
+
+
+def get(url, params=None, timeout=None):
+    return client.get(url, params=params, timeout=timeout)
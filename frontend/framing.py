@@ -0,0 +1,74 @@
+import json
+import struct
+
+# Client side of the gateway wire protocol (see backend/framing.py).
+# A connection starts in legacy mode (bare JSON); sending a hello switches it
+# to length-prefixed frames: 4-byte big-endian length + UTF-8 JSON body.
+
+FRAMING = "length_prefixed"
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+def encode_frame(obj):
+    body = json.dumps(obj).encode('utf-8')
+    if len(body) > MAX_FRAME_SIZE:
+        raise FrameError(f"frame of {len(body)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(body)) + body
+
+
+def send_frame(sock, obj):
+    sock.sendall(encode_frame(obj))
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            if data:
+                raise FrameError("connection closed in the middle of a frame")
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock):
+    """Read one framed message, None if the connection was closed cleanly"""
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise FrameError(f"frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+    body = recv_exactly(sock, length)
+    if body is None:
+        raise FrameError("connection closed in the middle of a frame")
+    return json.loads(body.decode('utf-8'))
+
+
+def recv_legacy(sock, chunk_size=16384):
+    """Read one bare JSON message, however many recv() calls it takes"""
+    data = b""
+    while True:
+        chunk = sock.recv(chunk_size)
+        if not chunk:
+            if not data:
+                return None
+            return json.loads(data.decode('utf-8'))
+        data += chunk
+        try:
+            return json.loads(data.decode('utf-8'))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            continue
+
+
+def negotiate(sock):
+    """Ask the gateway for framing, True if the connection is now framed"""
+    sock.sendall(json.dumps({"action": "hello", "framing": FRAMING}).encode('utf-8'))
+    reply = recv_legacy(sock)
+    return bool(reply) and reply.get("status") == "200" and reply.get("framing") == FRAMING
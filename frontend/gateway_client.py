@@ -0,0 +1,260 @@
+import itertools
+import json
+import socket
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import framing
+
+# Long-lived, pipelined connections to the static gateway.
+#
+# Every request gets a "request_id" that the gateway echoes back, so several
+# requests can be in flight on one connection and responses are matched no
+# matter in which order they come back. A reader thread owns the receiving
+# side of the socket; senders only hold the write lock while writing a frame.
+#
+# Frames without a request_id that carry an "event" are server pushes for a
+# subscription (see backend/notifications.py); they go to the subscriber's
+# callback, on the reader thread.
+
+POOL_SIZE = 2
+CONNECT_TIMEOUT = 5
+RECONNECT_BACKOFF = (0.0, 0.5, 1.0, 2.0, 5.0)
+
+
+class GatewayConnection:
+    """One persistent connection to the gateway"""
+
+    def __init__(self, host, port, timeout=8):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.framed = False
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()          # connection state and pending map
+        self._write_lock = threading.Lock()    # one frame on the wire at a time
+        self._failures = 0
+        self._next_attempt = 0.0
+        self._topics = None
+        self._on_event = None
+
+    # ---------------- connection management ----------------
+    def _ensure_connected(self):
+        with self._lock:
+            if self.sock is not None:
+                return self.sock
+            now = time.monotonic()
+            if now < self._next_attempt:
+                raise ConnectionError("gateway unreachable, retrying shortly")
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.settimeout(self.timeout)
+                framed = framing.negotiate(sock)
+                sock.settimeout(None)
+            except OSError:
+                self._failures += 1
+                delay = RECONNECT_BACKOFF[min(self._failures, len(RECONNECT_BACKOFF) - 1)]
+                self._next_attempt = now + delay
+                raise
+            self._failures = 0
+            self.sock = sock
+            self.framed = framed
+            if framed:
+                threading.Thread(target=self._reader_loop, args=(sock,), daemon=True).start()
+            return sock
+
+    def _drop(self, sock, error):
+        """Forget a broken socket and fail every request still waiting on it"""
+        with self._lock:
+            if self.sock is not sock:
+                return
+            self.sock = None
+            pending, self._pending = self._pending, {}
+        try:
+            sock.shutdown(socket.SHUT_RDWR)   # wakes the reader thread and sends FIN now
+        except OSError:
+            pass
+        try:
+            sock.close()
+        except OSError:
+            pass
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"gateway connection lost: {error}"))
+        if self._topics is not None:
+            self._emit({"event": "subscription_lost", "data": {"error": str(error)}})
+            threading.Thread(target=self._resubscribe_loop, daemon=True).start()
+
+    def _reader_loop(self, sock):
+        try:
+            while True:
+                message = framing.recv_frame(sock)
+                if message is None:
+                    raise ConnectionError("closed by server")
+                request_id = message.pop("request_id", None) if isinstance(message, dict) else None
+                if request_id is None and isinstance(message, dict) and "event" in message:
+                    self._emit(message)
+                    continue
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except (OSError, ValueError, framing.FrameError) as e:
+            self._drop(sock, e)
+
+    def close(self):
+        self._topics = None
+        with self._lock:
+            sock = self.sock
+        if sock is not None:
+            self._drop(sock, "closed by client")
+
+    # ---------------- subscriptions ----------------
+    def _emit(self, event):
+        callback = self._on_event
+        if callback is not None:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"[gateway_client] event callback failed: {e}")
+
+    def subscribe(self, topics, on_event):
+        """
+        Ask the gateway to push events for topics ([["driver", id], ["rider", id]])
+        to on_event(event). The subscription is renewed after reconnects, with a
+        "subscription_lost" / "subscribed" event around the gap. Returns the
+        gateway's response; anything but status 200 means no pushes (e.g. a gateway
+        without framing), and the caller should keep polling.
+        """
+        response = self.request({"action": "subscribe", "topics": topics})
+        if response.get("status") == "200":
+            self._topics = topics
+            self._on_event = on_event
+        return response
+
+    def _resubscribe_loop(self):
+        while self._topics is not None:
+            try:
+                response = self.request({"action": "subscribe", "topics": self._topics})
+            except (OSError, TimeoutError):
+                time.sleep(RECONNECT_BACKOFF[min(self._failures, len(RECONNECT_BACKOFF) - 1)] or 0.5)
+                continue
+            if response.get("status") == "200":
+                self._emit({"event": "subscribed", "data": {"topics": self._topics}})
+            else:
+                self._topics = None   # e.g. the gateway came back without framing
+            return
+
+    # ---------------- requests ----------------
+    def submit(self, payload):
+        """Send a request without waiting for it, returns a Future of the response"""
+        sock = self._ensure_connected()
+        if not self.framed:
+            # gateway without framing: one request at a time, answered in order
+            future = Future()
+            with self._write_lock:
+                try:
+                    sock.settimeout(self.timeout)
+                    sock.sendall(json.dumps(payload).encode('utf-8'))
+                    response = framing.recv_legacy(sock)
+                    sock.settimeout(None)
+                except (OSError, ValueError) as e:
+                    self._drop(sock, e)
+                    raise ConnectionError(f"gateway connection lost: {e}")
+            if response is None:
+                self._drop(sock, "closed by server")
+                raise ConnectionError("gateway connection lost: closed by server")
+            future.set_result(response)
+            return future
+
+        request_id = next(self._ids)
+        message = dict(payload, request_id=request_id)
+        future = Future()
+        with self._lock:
+            self._pending[request_id] = future
+        try:
+            with self._write_lock:
+                framing.send_frame(sock, message)
+        except OSError as e:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            self._drop(sock, e)
+            raise ConnectionError(f"gateway connection lost: {e}")
+        return future
+
+    def request(self, payload, timeout=None):
+        """Send a request and wait for its response"""
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            future = self.submit(payload)
+        except ConnectionError:
+            # the socket may simply have gone stale while idle; reconnect once
+            future = self.submit(payload)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            raise TimeoutError(f"no response from gateway after {timeout}s")
+
+
+class GatewayPool:
+    """A few persistent connections to one gateway, used round-robin"""
+
+    def __init__(self, host, port, size=POOL_SIZE, timeout=8):
+        self.connections = [GatewayConnection(host, port, timeout) for _ in range(max(1, size))]
+        self._next = itertools.cycle(self.connections)
+        self._lock = threading.Lock()
+
+    def connection(self):
+        with self._lock:
+            return next(self._next)
+
+    def submit(self, payload):
+        return self.connection().submit(payload)
+
+    def request(self, payload, timeout=None):
+        return self.connection().request(payload, timeout)
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+
+
+_pools = {}
+_subscribers = []
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port, timeout=8):
+    """Process-wide pool for (host, port)"""
+    with _pools_lock:
+        pool = _pools.get((host, port))
+        if pool is None:
+            pool = _pools[(host, port)] = GatewayPool(host, port, timeout=timeout)
+        return pool
+
+
+def subscribe(host, port, topics, on_event, timeout=8):
+    """Open a dedicated connection that receives pushed events, returns (connection, response)"""
+    conn = GatewayConnection(host, port, timeout)
+    with _pools_lock:
+        _subscribers.append(conn)
+    try:
+        response = conn.subscribe(topics, on_event)
+    except (OSError, TimeoutError) as e:
+        response = {"status": "500", "message": f"Connection error: {str(e)}"}
+    if response.get("status") != "200":
+        conn.close()
+    return conn, response
+
+
+def close_all():
+    with _pools_lock:
+        pools = list(_pools.values()) + list(_subscribers)
+        _pools.clear()
+        _subscribers.clear()
+    for pool in pools:
+        pool.close()
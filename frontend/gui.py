@@ -15,6 +15,8 @@ import tempfile
 import folium
 import threading
 import time
+import gateway_client
+import p2p_management
 from datetime import datetime
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, 
@@ -60,13 +62,8 @@ GOOGLE_API_KEY = get_GGM_api_key()
 def send_request_to_gateway(payload, host=GATEWAY_HOST, port=GATEWAY_PORT, timeout=8):
     """Send JSON request to gateway server and return response"""
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(timeout)
-        s.connect((host, port))
-        s.send(json.dumps(payload).encode('utf-8'))
-        data = s.recv(16384).decode('utf-8')
-        s.close()
-        return json.loads(data)
+        # persistent, pipelined connections shared by the whole process
+        return gateway_client.get_pool(host, port, timeout=timeout).request(payload, timeout=timeout)
     except json.JSONDecodeError:
         return {"status": "500", "message": "Invalid JSON response from server"}
     except Exception as e:
@@ -95,11 +92,13 @@ class P2PChatDialog(QDialog):
         self.management_port = management_port
         
         # P2P state
-        self.mgmt_sock = None
+        self.mgmt = None
         self.p2p_listener = None
         self.p2p_port = None
         self.p2p_conn = None
         self.p2p_lock = threading.Lock()
+        self.relayed = False     # chatting through the management server
+        self.offline = False     # peer not online yet: messages are kept by the server
         self.running = False
         self.peer_name = None
         self.peer_ip = None
@@ -228,7 +227,7 @@ class P2PChatDialog(QDialog):
         try:
             conn, addr = self.p2p_listener.accept()
             with self.p2p_lock:
-                if self.p2p_conn:
+                if self.p2p_conn or self.relayed:
                     conn.close()
                     return
                 self.p2p_conn = conn
@@ -241,58 +240,63 @@ class P2PChatDialog(QDialog):
     def _management_register_and_listen(self):
         """Register with management server and wait for peer info"""
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(6.0)
-            s.connect((self.management_server, self.management_port))
-            s.settimeout(None)
-            self.mgmt_sock = s
-            
-            payload = {
-                "UserID": self.my_username,
-                "P2P_Port": self.p2p_port,
-                "DestinationID": self.peer_username
-            }
-            s.sendall(json.dumps(payload).encode())
-            
-            raw = s.recv(8192)
-            if raw:
-                resp = json.loads(raw.decode())
+            self.mgmt = p2p_management.ManagementConnection(
+                self.management_server, self.management_port, self.my_username, self.p2p_port, self.peer_username,
+                ride_id=self.ride_id)
+            resp = self.mgmt.register()
+            if resp:
                 if resp.get("status") == "200" and resp.get("destination_ip"):
                     self._handle_peer_info(
                         resp["destination_ip"],
                         resp["destination_port"],
                         resp.get("destination_name")
                     )
+                elif self.mgmt.framed:
+                    self._wait_offline()
                 else:
                     self.status_update.emit("Waiting for peer...")
             
             # Listen for peer updates
-            while self.running and self.mgmt_sock:
-                try:
-                    raw = self.mgmt_sock.recv(8192)
-                    if not raw:
-                        break
-                    msg = json.loads(raw.decode())
-                    
-                    if msg.get("destination_ip"):
-                        self._handle_peer_info(
-                            msg["destination_ip"],
-                            msg["destination_port"],
-                            msg.get("destination_name")
-                        )
-                    elif msg.get("type") == "connection_request":
-                        self._handle_peer_info(
-                            msg["source_ip"],
-                            msg["source_port"],
-                            msg.get("source_name")
-                        )
-                except:
+            for msg in self.mgmt.messages():
+                if not self.running:
                     break
+                if msg.get("type") == "relay":
+                    self._handle_relayed(msg.get("payload") or {})
+                elif msg.get("type") == "stored_messages":
+                    peer_name = self.peer_name or self.peer_username
+                    for stored in msg.get("messages", []):
+                        sent_at = datetime.fromtimestamp(stored["at"]).strftime("%H:%M")
+                        self.message_received.emit(f"{peer_name} ({sent_at}): {stored['payload'].get('text', '')}")
+                elif msg.get("type") == "relay_error":
+                    self.status_update.emit(f"Relay error: {msg.get('message')}")
+                elif msg.get("type") == "destination_offline":
+                    self.relayed = False
+                    if self.mgmt.framed:
+                        self._wait_offline()
+                elif msg.get("destination_ip"):
+                    self._handle_peer_info(
+                        msg["destination_ip"],
+                        msg["destination_port"],
+                        msg.get("destination_name")
+                    )
+                elif msg.get("type") == "connection_request":
+                    self._handle_peer_info(
+                        msg["source_ip"],
+                        msg["source_port"],
+                        msg.get("source_name")
+                    )
         except Exception as e:
             self.status_update.emit(f"Connection error: {e}")
     
+    def _wait_offline(self):
+        """Let the user write to a peer that is not online; the server keeps the messages"""
+        self.offline = True
+        self.status_update.emit(f"Waiting for {self.peer_username}, messages will be delivered when they connect")
+        self.connection_established.emit()
+
     def _handle_peer_info(self, ip, port, name):
         """Handle received peer information"""
+        self.offline = False
         with self.p2p_lock:
             if self.p2p_conn:
                 return
@@ -329,17 +333,48 @@ class P2PChatDialog(QDialog):
             self.connection_established.emit()
             self._p2p_recv_loop(cli)
         except Exception as e:
+            self._start_relay(e)
+
+    def _start_relay(self, error):
+        """Chat through the management server when the peer cannot be reached directly"""
+        if not self.mgmt or not self.mgmt.framed:
+            self.status_update.emit(f"Connection failed: {error}")
+            return
+        with self.p2p_lock:
+            if self.p2p_conn or self.relayed:
+                return
+            self.relayed = True
+        try:
+            self.mgmt.relay({"type": "open"})
+        except OSError as e:
+            self.relayed = False
             self.status_update.emit(f"Connection failed: {e}")
+            return
+        self.status_update.emit("Connected (relayed through server)")
+        self.connection_established.emit()
+
+    def _handle_relayed(self, payload):
+        """A message the peer sent through the management server"""
+        if payload.get("type") == "open":
+            with self.p2p_lock:
+                if self.p2p_conn or self.relayed:
+                    return
+                self.relayed = True
+            self.status_update.emit("Connected (relayed through server)")
+            self.connection_established.emit()
+        elif payload.get("type") == "chat":
+            peer_name = self.peer_name or self.peer_username
+            self.message_received.emit(f"{peer_name}: {payload.get('text', '')}")
     
     def _p2p_recv_loop(self, conn):
         """Receive messages from peer"""
         try:
             while self.running:
-                data = conn.recv(4096)
-                if not data:
+                text = p2p_management.recv_chat(conn)
+                if text is None:
                     break
                 peer_name = self.peer_name or self.peer_username
-                self.message_received.emit(f"{peer_name}: {data.decode()}")
+                self.message_received.emit(f"{peer_name}: {text}")
         except:
             pass
         finally:
@@ -352,13 +387,22 @@ class P2PChatDialog(QDialog):
         if not msg:
             return
         
+        if self.relayed or self.offline:
+            try:
+                self.mgmt.relay(p2p_management.chat_message(msg))
+                self.display_message(f"You: {msg}")
+                self.message_input.clear()
+            except Exception as e:
+                self.status_update.emit(f"Send error: {e}")
+            return
+
         with self.p2p_lock:
             if not self.p2p_conn:
                 self.status_update.emit("Not connected")
                 return
             
             try:
-                self.p2p_conn.sendall(msg.encode())
+                p2p_management.send_chat(self.p2p_conn, msg)
                 self.display_message(f"You: {msg}")
                 self.message_input.clear()
             except Exception as e:
@@ -529,12 +573,9 @@ class P2PChatDialog(QDialog):
     
     def _cleanup_mgmt(self):
         """Cleanup management connection"""
-        if self.mgmt_sock:
-            try:
-                self.mgmt_sock.close()
-            except:
-                pass
-            self.mgmt_sock = None
+        if self.mgmt:
+            self.mgmt.close()
+            self.mgmt = None
     
     def closeEvent(self, event):
         """Handle window close"""
@@ -574,6 +615,10 @@ class MapBridge(QObject):
         print(f"[JS Console] {msg}")
         self.consoleMessage.emit(str(msg))
 
+class GatewayEvents(QObject):
+    """Carries events pushed by the gateway from the client's reader thread to the GUI thread"""
+    received = pyqtSignal(dict)
+
 # ============================================================================
 # PROFILE WINDOW
 # ============================================================================
@@ -1642,6 +1687,9 @@ class AUBusUltimateGUI(QMainWindow):
         self.current_request_id = None
         self.pending_requests = []
         self.notified_accepted_requests = set()  # Track which requests we've already notified about
+        # Change-log cursors: after the first full list the gateway only sends deltas
+        self.requests_cursor = None
+        self.accepted_cursor = None
         
         # Map bridge
         self.map_bridge = MapBridge()
@@ -1656,6 +1704,12 @@ class AUBusUltimateGUI(QMainWindow):
         self.passenger_check_timer = QTimer()
         self.passenger_check_timer.timeout.connect(self.check_passenger_accepted_requests)
         
+        # Events pushed by the gateway replace both timers while subscribed
+        self.gateway_events = GatewayEvents()
+        self.gateway_events.received.connect(self.on_gateway_event)
+        self.subscription = None
+        self.live_updates = False
+        
         self.init_ui()
         # Delay map initialization to ensure UI is ready
         QTimer.singleShot(500, self.init_map)
@@ -2752,6 +2806,8 @@ class AUBusUltimateGUI(QMainWindow):
                 "email": data_login.get("email"),
                 "isDriver": bool(is_driver)  # Ensure it's boolean
             }
+            self.requests_cursor = None
+            self.accepted_cursor = None
             
             # Register IP
             try:
@@ -2783,6 +2839,8 @@ class AUBusUltimateGUI(QMainWindow):
                 self.tabs.setCurrentIndex(2)
                 # Start checking for accepted requests for passengers
                 self.passenger_check_timer.start(10000)  # Check every 10 seconds
+            # pushed notifications stop the polling timers if the gateway supports them
+            self.start_live_updates()
 
             self.tabs.setTabEnabled(0, False)
             
@@ -3011,14 +3069,22 @@ class AUBusUltimateGUI(QMainWindow):
             "action": "get_requests",
             "driver_userid": self.user["userID"]
         }
+        if self.requests_cursor is not None:
+            payload["since"] = self.requests_cursor
         
         response = send_request_to_gateway(payload)
         
+        if response.get("status") == "200" and response.get("full") is False:
+            self.apply_request_delta(response)
+            self.requests_cursor = response.get("cursor")
+            return
+        
         self.requests_list.clear()
         
         if response.get("status") == "200":
             requests = response.get("requests", [])
             self.pending_requests = requests
+            self.requests_cursor = response.get("cursor")
             
             # Check for new requests
             new_request_count = len(requests)
@@ -3030,21 +3096,136 @@ class AUBusUltimateGUI(QMainWindow):
             self.last_request_count = new_request_count
             
             for req in requests:
-                req_id = req.get("requestID", "")
-                rider_id = req.get("riderID", "")
-                area = req.get("area", "")
-                req_time = req.get("reqTime", "")
-                
-                item_text = f"🎫 {req_id} | 👤 Rider: {rider_id} | 📍 {area} | ⏰ {req_time}"
-                item = QListWidgetItem(item_text)
-                item.setData(Qt.UserRole, req)
-                self.requests_list.addItem(item)
+                self.add_request_item(req)
             
             self.status_bar.showMessage(f"Found {len(requests)} pending requests")
         else:
             self.last_request_count = 0
+            self.requests_cursor = None
             self.status_bar.showMessage("No pending requests")
-
+    
+    def apply_request_delta(self, response):
+        """Apply a get_requests delta to requests_list instead of rebuilding it"""
+        for req_id in response.get("deleted", []):
+            self.remove_request_item(req_id)
+        
+        for req in response.get("updated", []):
+            row = self.request_item_row(req.get("requestID"))
+            if row >= 0:
+                self.set_request_item(self.requests_list.item(row), req)
+                self.pending_requests = [req if r.get("requestID") == req.get("requestID") else r
+                                         for r in self.pending_requests]
+            else:   # pending again, or missed earlier
+                self.pending_requests.insert(0, req)
+                self.add_request_item(req, row=0)
+        
+        # inserted requests come newest first; the newest ends up on top
+        new_count = 0
+        for req in reversed(response.get("inserted", [])):
+            row = self.request_item_row(req.get("requestID"))
+            if row >= 0:   # already shown by a pushed event
+                self.set_request_item(self.requests_list.item(row), req)
+                continue
+            new_count += 1
+            self.pending_requests.insert(0, req)
+            self.add_request_item(req, row=0)
+        
+        if new_count:
+            self.show_request_notification(new_count)
+        self.last_request_count = self.requests_list.count()
+        self.status_bar.showMessage(f"Found {self.last_request_count} pending requests")
+    
+    def add_request_item(self, req, row=None):
+        """Show one pending request in requests_list"""
+        item = QListWidgetItem()
+        self.set_request_item(item, req)
+        if row is None:
+            self.requests_list.addItem(item)
+        else:
+            self.requests_list.insertItem(row, item)
+    
+    def set_request_item(self, item, req):
+        """Fill a requests_list item from a request dict"""
+        req_id = req.get("requestID", "")
+        rider_id = req.get("riderID", "")
+        area = req.get("area", "")
+        req_time = req.get("reqTime", "")
+        
+        item.setText(f"🎫 {req_id} | 👤 Rider: {rider_id} | 📍 {area} | ⏰ {req_time}")
+        item.setData(Qt.UserRole, req)
+    
+    def request_item_row(self, req_id):
+        """Row of a request in requests_list, -1 if it is not shown"""
+        for row in range(self.requests_list.count()):
+            req = self.requests_list.item(row).data(Qt.UserRole) or {}
+            if req.get("requestID") == req_id:
+                return row
+        return -1
+    
+    def remove_request_item(self, req_id):
+        """Drop a request from requests_list, True if it was shown"""
+        row = self.request_item_row(req_id)
+        if row < 0:
+            return False
+        self.requests_list.takeItem(row)
+        self.pending_requests = [r for r in self.pending_requests if r.get("requestID") != req_id]
+        return True
+    
+    # ========== LIVE UPDATES (gateway push) ==========
+    def start_live_updates(self):
+        """Subscribe to this user's request events on a dedicated gateway connection"""
+        if not self.user:
+            return
+        kind = "driver" if self.user.get("isDriver") else "rider"
+        self.subscription, response = gateway_client.subscribe(
+            GATEWAY_HOST, GATEWAY_PORT, [[kind, self.user["userID"]]], self.gateway_events.received.emit)
+        if response.get("status") == "200":
+            self.set_live_updates(True)
+        else:
+            print(f"[live updates] not available, polling instead: {response.get('message')}")
+    
+    def set_live_updates(self, enabled):
+        """Switch between pushed events and the 10s polling timers"""
+        self.live_updates = enabled
+        is_driver = self.user and self.user.get("isDriver")
+        if enabled:
+            self.refresh_timer.stop()
+            self.passenger_check_timer.stop()
+            # catch up on anything that happened while we were not subscribed
+            if is_driver:
+                if self.auto_refresh_checkbox.isChecked():
+                    self.refresh_requests()
+            else:
+                self.check_passenger_accepted_requests()
+            self.status_bar.showMessage("Live updates on 🔔")
+        else:
+            if is_driver:
+                if self.auto_refresh_checkbox.isChecked():
+                    self.refresh_timer.start(10000)
+            elif self.user:
+                self.passenger_check_timer.start(10000)
+            self.status_bar.showMessage("Live updates lost, polling every 10s")
+    
+    def on_gateway_event(self, event):
+        """Apply one pushed event (runs on the GUI thread)"""
+        kind = event.get("event")
+        data = event.get("data") or {}
+        if kind == "ride_request":
+            if not self.remove_request_item(data.get("requestID")):
+                self.last_request_count = getattr(self, "last_request_count", 0) + 1
+                self.show_request_notification(1)
+            self.pending_requests.insert(0, data)
+            self.add_request_item(data, row=0)
+            self.status_bar.showMessage(f"New request from {data.get('rider_username', 'a passenger')}")
+        elif kind == "request_updated":
+            if self.remove_request_item(data.get("requestID")):
+                self.last_request_count = max(0, getattr(self, "last_request_count", 0) - 1)
+        elif kind == "request_accepted":
+            self.notify_request_accepted(data)
+        elif kind == "subscription_lost":
+            self.set_live_updates(False)
+        elif kind == "subscribed":
+            self.set_live_updates(True)
     
     def accept_selected_request(self, item):
         """Accept a ride request and open P2P chat"""
@@ -3106,8 +3287,11 @@ class AUBusUltimateGUI(QMainWindow):
             if not hasattr(self, 'last_request_count'):
                 self.last_request_count = 0
             
-            self.refresh_timer.start(10000)
             self.refresh_requests()
+            if self.live_updates:
+                self.status_bar.showMessage("Live updates enabled")
+                return
+            self.refresh_timer.start(10000)
             self.status_bar.showMessage("Auto-refresh enabled (10s)")
         else:
             self.refresh_timer.stop()
@@ -3393,39 +3577,50 @@ class AUBusUltimateGUI(QMainWindow):
             "action": "check_passenger_requests",
             "riderID": self.user["userID"]
         }
+        if self.accepted_cursor is not None:
+            payload["since"] = self.accepted_cursor
         
         response = send_request_to_gateway(payload)
         
         if response.get("status") == "200":
-            accepted_requests = response.get("accepted_requests", [])
+            self.accepted_cursor = response.get("cursor")
+            if response.get("full") is False:
+                # a delta: only requests accepted (or changed) since the last check
+                accepted_requests = response.get("inserted", []) + response.get("updated", [])
+            else:
+                accepted_requests = response.get("accepted_requests", [])
             
             # Check for new accepted requests
             for req in accepted_requests:
-                req_id = req.get("requestID")
-                ride_id = req.get('rideID')
-                
-                # Only notify if we haven't notified about this request before
-                if req_id not in self.notified_accepted_requests:
-                    self.notified_accepted_requests.add(req_id)
-                    driver_username = req.get("driver_username", "Unknown")
-                    
-                    # Show notification
-                    msg = f"🎉 Your ride request has been accepted!\n\n"
-                    msg += f"Driver: {driver_username}\n"
-                    msg += f"Email: {req.get('driver_email', 'N/A')}\n"
-                    msg += f"Route: {req.get('route', 'N/A')}\n"
-                    msg += f"Ride ID: {req.get('rideID', 'N/A')}\n\n"
-                    msg += f"Opening chat window with driver..."
-                    
-                    QMessageBox.information(self, "Request Accepted!", msg)
-                    self.status_bar.showMessage(f"Request accepted by {driver_username} ✅")
-                    
-                    # Open P2P chat with driver
-                    QTimer.singleShot(500, lambda: self.open_p2p_chat(
-                        driver_username, 
-                        ride_id=ride_id,
-                        management_server=GATEWAY_HOST
-                    ))
+                self.notify_request_accepted(req)
+    
+    def notify_request_accepted(self, req):
+        """Tell the passenger about an accepted request once and open the chat with the driver"""
+        req_id = req.get("requestID")
+        ride_id = req.get('rideID')
+        
+        # Only notify if we haven't notified about this request before
+        if req_id not in self.notified_accepted_requests:
+            self.notified_accepted_requests.add(req_id)
+            driver_username = req.get("driver_username", "Unknown")
+            
+            # Show notification
+            msg = f"🎉 Your ride request has been accepted!\n\n"
+            msg += f"Driver: {driver_username}\n"
+            msg += f"Email: {req.get('driver_email', 'N/A')}\n"
+            msg += f"Route: {req.get('route', 'N/A')}\n"
+            msg += f"Ride ID: {req.get('rideID', 'N/A')}\n\n"
+            msg += f"Opening chat window with driver..."
+            
+            QMessageBox.information(self, "Request Accepted!", msg)
+            self.status_bar.showMessage(f"Request accepted by {driver_username} ✅")
+            
+            # Open P2P chat with driver
+            QTimer.singleShot(500, lambda: self.open_p2p_chat(
+                driver_username, 
+                ride_id=ride_id,
+                management_server=GATEWAY_HOST
+            ))
 
     
     def show_route_to_driver(self):
@@ -3753,6 +3948,7 @@ def main():
     app = QApplication(sys.argv)
     app.setApplicationName("AUBus Ultimate")
     app.setStyle('Fusion')
+    app.aboutToQuit.connect(gateway_client.close_all)
     
     window = AUBusUltimateGUI()
     window.show()
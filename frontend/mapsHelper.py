@@ -1,7 +1,18 @@
 # maps_helpers.py
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import requests
 
+import maps_cache
+
+
+# http_client is shared with the backend and lives in ../common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import http_client
+
 API_KEY = os.environ.get("GOOGLE_MAPS_API_KEY")
 if not API_KEY:
     API_KEY = None
@@ -9,42 +20,119 @@ if not API_KEY:
 GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
 DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
 DISTANCE_MATRIX_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+# Distance Matrix limits per request: 25 origins, 25 destinations, 100 elements
+MATRIX_MAX_ORIGINS = 10
+MATRIX_MAX_DESTINATIONS = 10
+MATRIX_WORKERS = 4
 
 def geocode_address(address):
     if not API_KEY:
         return None
+    point = maps_cache.get_cache().lookup("geocode", maps_cache.geocode_key(address),
+                                          lambda: _geocode_address(address))
+    return tuple(point) if point else None
+
+def _geocode_address(address):
     params = {"address": address, "key": API_KEY}
-    r = requests.get(GEOCODE_URL, params=params, timeout=10)
+    r = http_client.get(GEOCODE_URL, params=params, timeout=10)
     data = r.json()
     if data.get("status") == "OK" and data.get("results"):
         loc = data["results"][0]["geometry"]["location"]
         return loc["lat"], loc["lng"]
     return None
 
+def _is_ok(data):
+    return bool(data) and data.get("status") == "OK"
+
 def reverse_geocode(lat, lng):
     if not API_KEY:
         return None
-    params = {"latlng": f"{lat},{lng}", "key": API_KEY}
-    r = requests.get(GEOCODE_URL, params=params, timeout=10)
-    return r.json()
+    # the cached answer is for the rounded point, so ask Google for that point too
+    latlng = maps_cache.coord_key(lat, lng)
+    params = {"latlng": latlng, "key": API_KEY}
+    return maps_cache.get_cache().lookup("reverse", maps_cache.reverse_key(lat, lng),
+                                         lambda: http_client.get(GEOCODE_URL, params=params, timeout=10).json(),
+                                         cacheable=_is_ok)
 
 def get_directions(origin_lat, origin_lng, dest_lat, dest_lng, mode="driving"):
     if not API_KEY:
         return None
     params = {
-        "origin": f"{origin_lat},{origin_lng}",
-        "destination": f"{dest_lat},{dest_lng}",
+        "origin": maps_cache.coord_key(origin_lat, origin_lng),
+        "destination": maps_cache.coord_key(dest_lat, dest_lng),
         "mode": mode,
         "key": API_KEY
     }
-    r = requests.get(DIRECTIONS_URL, params=params, timeout=10)
-    return r.json()
+    key = maps_cache.directions_key(origin_lat, origin_lng, dest_lat, dest_lng, mode)
+    return maps_cache.get_cache().lookup("directions", key,
+                                         lambda: http_client.get(DIRECTIONS_URL, params=params, timeout=10).json(),
+                                         cacheable=_is_ok)
 
 def distance_matrix(origins, destinations, mode="driving"):
+    """
+    (durations in seconds, distances in meters) as len(origins) x len(destinations)
+    float arrays, NaN where Google has no route or the tile failed. Large matrices
+    are split into tiles within Google's per-request limits and fetched in parallel;
+    cells already in the maps cache are not asked again.
+    """
     if not API_KEY:
         return None
-    origins_str = "|".join(f"{lat},{lng}" for lat,lng in origins)
-    dests_str = "|".join(f"{lat},{lng}" for lat,lng in destinations)
-    params = {"origins": origins_str, "destinations": dests_str, "mode": mode, "key": API_KEY}
-    r = requests.get(DISTANCE_MATRIX_URL, params=params, timeout=10)
-    return r.json()
+    origin_keys = [maps_cache.coord_key(lat, lng) for lat, lng in origins]
+    dest_keys = [maps_cache.coord_key(lat, lng) for lat, lng in destinations]
+    # each distinct point once: riders often share a pickup zone
+    rows = list(dict.fromkeys(origin_keys))
+    cols = list(dict.fromkeys(dest_keys))
+    durations = np.full((len(rows), len(cols)), np.nan)
+    distances = np.full((len(rows), len(cols)), np.nan)
+
+    cache = maps_cache.get_cache()
+    keys = {(i, j): maps_cache.matrix_key(o, d, mode) for i, o in enumerate(rows) for j, d in enumerate(cols)}
+    cached = cache.get_many("matrix", keys.values())
+    missing = np.ones((len(rows), len(cols)), dtype=bool)
+    for (i, j), key in keys.items():
+        if key in cached:
+            durations[i, j], distances[i, j] = cached[key]
+            missing[i, j] = False
+
+    # a tile asks for every missing cell of a block of rows and columns
+    tiles = []
+    for r0 in range(0, len(rows), MATRIX_MAX_ORIGINS):
+        for c0 in range(0, len(cols), MATRIX_MAX_DESTINATIONS):
+            block = missing[r0:r0 + MATRIX_MAX_ORIGINS, c0:c0 + MATRIX_MAX_DESTINATIONS]
+            if block.any():
+                tile_rows = [r0 + i for i in np.flatnonzero(block.any(axis=1))]
+                tile_cols = [c0 + j for j in np.flatnonzero(block.any(axis=0))]
+                tiles.append((tile_rows, tile_cols))
+
+    def fetch(tile):
+        tile_rows, tile_cols = tile
+        params = {"origins": "|".join(rows[i] for i in tile_rows),
+                  "destinations": "|".join(cols[j] for j in tile_cols), "mode": mode, "key": API_KEY}
+        data = http_client.get(DISTANCE_MATRIX_URL, params=params, timeout=10).json()
+        if data.get("status") != "OK":
+            raise ValueError(f"distance matrix status {data.get('status')}")
+        found = []
+        for i, row in zip(tile_rows, data.get("rows", [])):
+            for j, element in zip(tile_cols, row.get("elements", [])):
+                if element.get("status") == "OK":
+                    found.append((i, j, element["duration"]["value"], element["distance"]["value"]))
+        return found
+
+    fetched = []
+    if tiles:
+        with ThreadPoolExecutor(max_workers=min(MATRIX_WORKERS, len(tiles))) as pool:
+            futures = [pool.submit(fetch, tile) for tile in tiles]
+            for future in futures:
+                try:
+                    fetched.extend(future.result())
+                except (requests.RequestException, ValueError) as e:
+                    print(f"[mapsHelper] distance matrix tile failed: {e}")
+    for i, j, duration, distance in fetched:
+        durations[i, j], distances[i, j] = duration, distance
+    cache.put_many("matrix", [(keys[i, j], [duration, distance]) for i, j, duration, distance in fetched])
+
+    # back to the caller's order, duplicates included
+    row_of = {key: i for i, key in enumerate(rows)}
+    col_of = {key: j for j, key in enumerate(cols)}
+    index = np.ix_([row_of[key] for key in origin_keys], [col_of[key] for key in dest_keys])
+    return durations[index], distances[index]
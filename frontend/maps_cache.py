@@ -0,0 +1,273 @@
+"""
+On-disk cache for the Google Maps lookups in mapsHelper.
+
+Geocoding, reverse geocoding and directions keep returning the same answers
+for the same few campus gates and neighborhoods, so results are kept in a
+small SQLite file next to the GUI (AUBUS_MAPS_CACHE overrides the path):
+
+    geocode   "geocode:<address>"  lower-cased, punctuation and extra spaces removed
+    reverse   "reverse:<lat>,<lng>"  rounded to COORD_DIGITS (about 11 m)
+    directions "directions:<mode>:<origin>:<destination>"  same rounding
+    matrix    "matrix:<mode>:<origin>:<destination>"  one distance matrix cell
+
+Each kind has its own TTL; expired entries are ignored and overwritten. When
+the stored results pass MAX_BYTES, the least recently used ones are removed.
+Hits and misses per kind are counted in the file too, so the hit rate covers
+every GUI session, not just the current one. Only successful answers are
+stored; a failed or empty lookup is asked again next time.
+
+    python maps_cache.py warm     # preload the AUB gates and nearby neighborhoods
+    python maps_cache.py stats
+    python maps_cache.py clear
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = os.environ.get("AUBUS_MAPS_CACHE",
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), "maps_cache.db"))
+MAX_BYTES = 16 * 1024 * 1024
+COORD_DIGITS = 4
+TTL = {
+    "geocode": 30 * 86400,
+    "reverse": 30 * 86400,
+    "directions": 86400,        # traffic and road works change routes
+    "matrix": 86400,
+}
+
+# Common pickup and drop-off points, preloaded by `python maps_cache.py warm`
+AUB_LOCATIONS = [
+    "AUB Main Gate, Bliss Street, Beirut, Lebanon",
+    "AUB Medical Gate, Beirut, Lebanon",
+    "AUB Sea Gate, Beirut, Lebanon",
+    "AUB Tibat Gate, Beirut, Lebanon",
+    "Hamra Street, Beirut, Lebanon",
+    "Ras Beirut, Lebanon",
+    "Manara, Beirut, Lebanon",
+    "Raouche, Beirut, Lebanon",
+    "Verdun, Beirut, Lebanon",
+    "Achrafieh, Beirut, Lebanon",
+    "Gemmayzeh, Beirut, Lebanon",
+    "Mar Mikhael, Beirut, Lebanon",
+    "Badaro, Beirut, Lebanon",
+    "Jnah, Beirut, Lebanon",
+    "Dora, Lebanon",
+    "Jounieh, Lebanon",
+    "Aley, Lebanon",
+    "Baabda, Lebanon",
+]
+AUB_MAIN_GATE = AUB_LOCATIONS[0]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS MapsCache (
+    cacheKey TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expiresAt REAL NOT NULL,
+    lastUsed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_mapscache_lastused ON MapsCache(lastUsed);
+CREATE TABLE IF NOT EXISTS MapsCacheStats (
+    kind TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def normalize_address(address):
+    return " ".join(re.sub(r"[^\w\s]", " ", str(address).lower()).split())
+
+
+def coord_key(lat, lng):
+    return f"{round(float(lat), COORD_DIGITS):.{COORD_DIGITS}f},{round(float(lng), COORD_DIGITS):.{COORD_DIGITS}f}"
+
+
+def geocode_key(address):
+    return f"geocode:{normalize_address(address)}"
+
+
+def reverse_key(lat, lng):
+    return f"reverse:{coord_key(lat, lng)}"
+
+
+def directions_key(origin_lat, origin_lng, dest_lat, dest_lng, mode):
+    return f"directions:{mode}:{coord_key(origin_lat, origin_lng)}:{coord_key(dest_lat, dest_lng)}"
+
+
+def matrix_key(origin, destination, mode):
+    """origin and destination as coord_key strings"""
+    return f"matrix:{mode}:{origin}:{destination}"
+
+
+class MapsCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_BYTES, ttl=None, clock=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = dict(TTL, **(ttl or {}))
+        self._clock = clock
+        self._lock = threading.Lock()
+        # the GUI calls mapsHelper from worker threads; the lock serializes them on one connection
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM MapsCache").fetchone()[0]
+
+    def _count(self, kind, column):
+        self._conn.execute("INSERT OR IGNORE INTO MapsCacheStats (kind) VALUES (?)", (kind,))
+        self._conn.execute(f"UPDATE MapsCacheStats SET {column} = {column} + 1 WHERE kind = ?", (kind,))
+
+    def get(self, kind, key):
+        """The stored value for key, or None if it is missing or expired"""
+        with self._lock:
+            now = self._clock()
+            row = self._conn.execute("SELECT value, expiresAt FROM MapsCache WHERE cacheKey = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                self._count(kind, "misses")
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE MapsCache SET lastUsed = ? WHERE cacheKey = ?", (now, key))
+            self._count(kind, "hits")
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def get_many(self, kind, keys):
+        """{key: value} for the keys that are stored and fresh, in one transaction"""
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            now = self._clock()
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT cacheKey, value FROM MapsCache WHERE expiresAt > ? "
+                    f"AND cacheKey IN ({','.join('?' * len(chunk))})", (now, *chunk)).fetchall()
+                found.update(rows)
+            self._conn.executemany("UPDATE MapsCache SET lastUsed = ? WHERE cacheKey = ?",
+                                   ((now, key) for key in found))
+            self._conn.execute("INSERT OR IGNORE INTO MapsCacheStats (kind) VALUES (?)", (kind,))
+            self._conn.execute("UPDATE MapsCacheStats SET hits = hits + ?, misses = misses + ? WHERE kind = ?",
+                               (len(found), len(keys) - len(found), kind))
+            self._conn.commit()
+        return {key: json.loads(value) for key, value in found.items()}
+
+    def put(self, kind, key, value):
+        self.put_many(kind, [(key, value)])
+
+    def put_many(self, kind, items):
+        """Store (key, value) pairs in one transaction"""
+        rows = [(key, json.dumps(value, separators=(",", ":"))) for key, value in items]
+        with self._lock:
+            now = self._clock()
+            for key, text in rows:
+                old = self._conn.execute("SELECT size FROM MapsCache WHERE cacheKey = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO MapsCache (cacheKey, kind, value, size, expiresAt, lastUsed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, kind, text, len(text), now + self.ttl[kind], now))
+                self._bytes += len(text) - (old[0] if old else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # least recently used first, in batches, until the results fit again; called with the lock held
+        while self._bytes > self.max_bytes:
+            rows = self._conn.execute("SELECT cacheKey, size FROM MapsCache ORDER BY lastUsed LIMIT 64").fetchall()
+            if not rows:
+                self._bytes = 0
+                return
+            for key, size in rows:
+                if self._bytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM MapsCache WHERE cacheKey = ?", (key,))
+                self._bytes -= size
+
+    def lookup(self, kind, key, load, cacheable=lambda value: value is not None):
+        """The cached value for key, else load() (stored when cacheable)"""
+        value = self.get(kind, key)
+        if value is not None:
+            return value
+        value = load()
+        if cacheable(value):
+            self.put(kind, key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM MapsCache")
+            self._conn.execute("DELETE FROM MapsCacheStats")
+            self._conn.commit()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            entries = dict(self._conn.execute("SELECT kind, COUNT(*) FROM MapsCache GROUP BY kind").fetchall())
+            counts = self._conn.execute("SELECT kind, hits, misses FROM MapsCacheStats").fetchall()
+            total = self._bytes
+        kinds = {}
+        for kind, hits, misses in counts:
+            kinds[kind] = {"entries": entries.get(kind, 0), "hits": hits, "misses": misses,
+                           "hit_rate": round(hits / (hits + misses), 3) if hits + misses else 0.0}
+        for kind, count in entries.items():
+            kinds.setdefault(kind, {"entries": count, "hits": 0, "misses": 0, "hit_rate": 0.0})
+        return {"path": self.path, "bytes": total, "max_bytes": self.max_bytes, "kinds": kinds}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = MapsCache()
+    return _cache
+
+
+def warm(locations=AUB_LOCATIONS, hub=AUB_MAIN_GATE):
+    """Geocode every location and cache directions between it and the hub, both ways"""
+    import mapsHelper
+    if not mapsHelper.API_KEY:
+        raise SystemExit("GOOGLE_MAPS_API_KEY is not set")
+    points = {}
+    for address in locations:
+        point = mapsHelper.geocode_address(address)
+        if point is None:
+            print(f"[maps_cache] could not geocode {address!r}")
+            continue
+        points[address] = point
+        mapsHelper.reverse_geocode(*point)
+    if hub in points:
+        for address, point in points.items():
+            if address != hub:
+                mapsHelper.get_directions(*point, *points[hub])
+                mapsHelper.get_directions(*points[hub], *point)
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cache of Google Maps lookups")
+    parser.add_argument("command", choices=("warm", "stats", "clear"))
+    args = parser.parse_args()
+    if args.command == "warm":
+        points = warm()
+        print(f"[maps_cache] warmed {len(points)} of {len(AUB_LOCATIONS)} locations")
+    elif args.command == "clear":
+        get_cache().clear()
+    print(json.dumps(get_cache().stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 import sys
 import socket
 import threading
-import json
+import time
+import p2p_management
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QLineEdit, QPushButton, QTextEdit, QLabel, QMessageBox
@@ -23,12 +24,14 @@ class P2PChatGUI(QMainWindow):
         # runtime state
         self.username = None
         self.dest_name = None
-        self.mgmt_sock = None
+        self.mgmt = None
         self.mgmt_thread = None
         self.p2p_listener = None
         self.p2p_port = None
         self.p2p_conn = None
         self.p2p_lock = threading.Lock()
+        self.relayed = False     # chatting through the management server
+        self.offline = False     # peer not online yet: messages are kept by the server
         self.listening_thread = None
         self.running = False
 
@@ -210,12 +213,20 @@ class P2PChatGUI(QMainWindow):
         msg = self.message_input.text().strip()
         if not msg:
             return
+        if self.relayed or self.offline:
+            try:
+                self.mgmt.relay(p2p_management.chat_message(msg))
+                self.display_message(f"You: {msg}")
+                self.message_input.clear()
+            except Exception as e:
+                self.signals.status_update.emit("Send error: " + str(e))
+            return
         with self.p2p_lock:
             if not self.p2p_conn:
                 self.signals.status_update.emit("Not connected")
                 return
             try:
-                self.p2p_conn.sendall(msg.encode())
+                p2p_management.send_chat(self.p2p_conn, msg)
                 self.display_message(f"You: {msg}")
                 self.message_input.clear()
             except Exception as e:
@@ -240,7 +251,7 @@ class P2PChatGUI(QMainWindow):
         try:
             conn, addr = self.p2p_listener.accept()
             with self.p2p_lock:
-                if self.p2p_conn:
+                if self.p2p_conn or self.relayed:
                     try: conn.close()
                     except: pass
                     return
@@ -253,54 +264,62 @@ class P2PChatGUI(QMainWindow):
 
     def _management_register_and_listen(self):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(6.0)
-            s.connect((MANAGEMENT_SERVER, MANAGEMENT_PORT))
-            s.settimeout(None)
-            self.mgmt_sock = s
-            payload = {"UserID": self.username, "P2P_Port": self.p2p_port, "DestinationID": self.dest_name}
-            s.sendall(json.dumps(payload).encode())
-            raw = s.recv(8192)
-            if not raw:
+            self.mgmt = p2p_management.ManagementConnection(
+                MANAGEMENT_SERVER, MANAGEMENT_PORT, self.username, self.p2p_port, self.dest_name)
+            resp = self.mgmt.register()
+            if not resp:
                 self.signals.status_update.emit("Management server closed")
                 self._cleanup_mgmt()
                 return
-            resp = json.loads(raw.decode())
             if resp.get("status") == "200" and resp.get("destination_ip"):
                 dest_ip = resp["destination_ip"]
                 dest_port = resp["destination_port"]
                 self._handle_peer_info(dest_ip, dest_port, resp.get("destination_name"))
+            elif self.mgmt.framed:
+                self._wait_offline()
             else:
                 self.signals.status_update.emit("Registered, waiting for peer...")
 
-            while self.running and self.mgmt_sock:
-                try:
-                    raw = self.mgmt_sock.recv(8192)
-                    if not raw:
-                        break
-                    try:
-                        msg = json.loads(raw.decode())
-                    except Exception:
-                        continue
-                    if msg.get("message") == "destination_now_online" or msg.get("status") == "200" and msg.get("destination_ip"):
-                        dest_ip = msg.get("destination_ip")
-                        dest_port = msg.get("destination_port")
-                        dest_name = msg.get("destination_name") or self.dest_name
-                        self._handle_peer_info(dest_ip, dest_port, dest_name)
-                    elif msg.get("type") == "connection_request":
-                        src_ip = msg.get("source_ip")
-                        src_port = msg.get("source_port")
-                        src_name = msg.get("source_name") or msg.get("from")
-                        self._handle_peer_info(src_ip, src_port, src_name)
-                except Exception:
+            for msg in self.mgmt.messages():
+                if not self.running:
                     break
+                if msg.get("type") == "relay":
+                    self._handle_relayed(msg.get("payload") or {})
+                elif msg.get("type") == "relay_error":
+                    self.signals.status_update.emit("Relay error: " + str(msg.get("message")))
+                elif msg.get("type") == "stored_messages":
+                    who = getattr(self, "peer_name", None) or self.dest_name or "Peer"
+                    for stored in msg.get("messages", []):
+                        sent_at = time.strftime("%H:%M", time.localtime(stored["at"]))
+                        self.signals.message_received.emit(f"{who} ({sent_at}): {stored['payload'].get('text', '')}")
+                elif msg.get("type") == "destination_offline":
+                    self.relayed = False
+                    if self.mgmt.framed:
+                        self._wait_offline()
+                elif msg.get("message") == "destination_now_online" or msg.get("status") == "200" and msg.get("destination_ip"):
+                    dest_ip = msg.get("destination_ip")
+                    dest_port = msg.get("destination_port")
+                    dest_name = msg.get("destination_name") or self.dest_name
+                    self._handle_peer_info(dest_ip, dest_port, dest_name)
+                elif msg.get("type") == "connection_request":
+                    src_ip = msg.get("source_ip")
+                    src_port = msg.get("source_port")
+                    src_name = msg.get("source_name") or msg.get("from")
+                    self._handle_peer_info(src_ip, src_port, src_name)
         except Exception as e:
             self.signals.status_update.emit("Management error: " + str(e))
             self._cleanup_mgmt()
         finally:
             self._cleanup_mgmt()
 
+    def _wait_offline(self):
+        # the peer is not online: let the user write anyway, the server keeps the messages
+        self.offline = True
+        self.signals.status_update.emit("Waiting for peer, messages will be delivered when they connect")
+        self.signals.connection_established.emit()
+
     def _handle_peer_info(self, ip, port, name):
+        self.offline = False
         with self.p2p_lock:
             if self.p2p_conn:
                 return
@@ -330,16 +349,46 @@ class P2PChatGUI(QMainWindow):
             self.signals.connection_established.emit()
             self._p2p_recv_loop(cli, incoming=False)
         except Exception as e:
+            self._start_relay(e)
+
+    def _start_relay(self, error):
+        # the peer cannot be reached directly: chat through the management server
+        if not self.mgmt or not self.mgmt.framed:
+            self.signals.status_update.emit("Outgoing connect failed: " + str(error))
+            return
+        with self.p2p_lock:
+            if self.p2p_conn or self.relayed:
+                return
+            self.relayed = True
+        try:
+            self.mgmt.relay({"type": "open"})
+        except OSError as e:
+            self.relayed = False
             self.signals.status_update.emit("Outgoing connect failed: " + str(e))
+            return
+        self.signals.status_update.emit("Connected (relayed through server)")
+        self.signals.connection_established.emit()
+
+    def _handle_relayed(self, payload):
+        if payload.get("type") == "open":
+            with self.p2p_lock:
+                if self.p2p_conn or self.relayed:
+                    return
+                self.relayed = True
+            self.signals.status_update.emit("Connected (relayed through server)")
+            self.signals.connection_established.emit()
+        elif payload.get("type") == "chat":
+            who = getattr(self, "peer_name", None) or self.dest_name or "Peer"
+            self.signals.message_received.emit(f"{who}: {payload.get('text', '')}")
 
     def _p2p_recv_loop(self, conn, incoming):
         try:
             while self.running:
-                data = conn.recv(4096)
-                if not data:
+                text = p2p_management.recv_chat(conn)
+                if text is None:
                     break
                 who = getattr(self, "peer_name", "Peer") or "Peer"
-                self.signals.message_received.emit(f"{who}: {data.decode()}")
+                self.signals.message_received.emit(f"{who}: {text}")
         except Exception:
             pass
         finally:
@@ -358,16 +407,13 @@ class P2PChatGUI(QMainWindow):
                 self.p2p_conn = None
 
     def _cleanup_mgmt(self):
-        if self.mgmt_sock:
-            try:
-                self.mgmt_sock.shutdown(socket.SHUT_RDWR)
-            except: pass
-            try:
-                self.mgmt_sock.close()
-            except: pass
-            self.mgmt_sock = None
+        if self.mgmt:
+            self.mgmt.close()
+            self.mgmt = None
 
     def _cleanup_all(self):
+        self.relayed = False
+        self.offline = False
         self._close_p2p_conn()
         if self.p2p_listener:
             try:
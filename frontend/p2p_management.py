@@ -0,0 +1,130 @@
+import json
+import socket
+import threading
+
+import framing
+
+# Client side of the P2P management server (backend/p2p_server.py).
+#
+# The connection asks for length-prefixed framing, registers with
+# "heartbeat": true and then pings the server every heartbeat_interval seconds
+# it was given, so the server can tell a live but quiet peer from a dead one.
+# A server that predates framing rejects the hello and closes; the connection
+# is then opened again in bare JSON mode, without heartbeats.
+#
+# Chat messages are framed JSON too, {"type": "chat", "text": ...}, whether
+# they go over the direct connection between the peers or, when that cannot
+# be opened, through the server with relay(). A peer that falls back to the
+# relay first sends {"type": "open"} so the other side stops waiting for the
+# direct connection and switches as well. Relaying needs a framed connection.
+# Chat sent through the server while the peer is offline is kept there and
+# delivered to it in one "stored_messages" batch when it registers for the
+# same ride.
+
+
+class ManagementConnection:
+    def __init__(self, host, port, username, p2p_port, destination, ride_id=None, timeout=6.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.p2p_port = p2p_port
+        self.destination = destination
+        self.ride_id = ride_id
+        self.timeout = timeout
+        self.sock = None
+        self.framed = False
+        self.heartbeat_interval = None
+        self._send_lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.settimeout(self.timeout)
+        return sock
+
+    def register(self):
+        """Connect and register, return the server's first reply"""
+        sock = self._connect()
+        try:
+            self.framed = framing.negotiate(sock)
+        except (OSError, ValueError):
+            self.framed = False
+        if not self.framed:
+            sock.close()
+            sock = self._connect()
+        self.sock = sock
+        payload = {"UserID": self.username, "P2P_Port": self.p2p_port, "DestinationID": self.destination}
+        if self.ride_id is not None:
+            payload["RideID"] = self.ride_id
+        if self.framed:
+            payload["heartbeat"] = True
+        self.send(payload)
+        reply = self.receive()
+        sock.settimeout(None)
+        if reply and reply.get("heartbeat_interval"):
+            self.heartbeat_interval = float(reply["heartbeat_interval"])
+            threading.Thread(target=self._heartbeat, daemon=True).start()
+        return reply
+
+    def send(self, obj):
+        with self._send_lock:
+            if self.framed:
+                framing.send_frame(self.sock, obj)
+            else:
+                self.sock.sendall(json.dumps(obj).encode('utf-8'))
+
+    def relay(self, payload):
+        """Send a payload to the partner through the server"""
+        self.send({"type": "relay", "payload": payload})
+
+    def receive(self):
+        """Next message from the server, None once it has closed"""
+        if self.framed:
+            return framing.recv_frame(self.sock)
+        return framing.recv_legacy(self.sock, 8192)
+
+    def messages(self):
+        """Messages from the server until it closes, heartbeat replies left out"""
+        while not self._closed.is_set():
+            try:
+                message = self.receive()
+            except (OSError, ValueError, framing.FrameError):
+                return
+            if message is None:
+                return
+            if message.get("type") != "pong":
+                yield message
+
+    def _heartbeat(self):
+        while not self._closed.wait(self.heartbeat_interval):
+            try:
+                self.send({"type": "ping"})
+            except OSError:
+                return
+
+    def close(self):
+        self._closed.set()
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+
+def chat_message(text):
+    return {"type": "chat", "text": text}
+
+
+def send_chat(sock, text):
+    """Send one chat message over a direct peer connection"""
+    framing.send_frame(sock, chat_message(text))
+
+
+def recv_chat(sock):
+    """Next chat text from a direct peer connection, None once it has closed"""
+    while True:
+        message = framing.recv_frame(sock)
+        if message is None:
+            return None
+        if message.get("type") == "chat":
+            return str(message.get("text", ""))